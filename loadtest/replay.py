@@ -0,0 +1,312 @@
+"""
+Load-test harness for GoDutch. Replays a corpus of recorded uploads against
+the web-app at a configurable concurrency and arrival rate and reports
+throughput, latency percentiles and error rates per stage.
+
+By default both Flask apps run in this process on local ports, sharing an
+in-memory mongomock database, so no MONGO_URI is needed (Tesseract still is).
+Pass --target to load an already running web-app instead.
+
+Record a corpus by running the web-app with UPLOAD_RECORD_DIR set; every
+upload is saved there as an image plus a JSON manifest of its form fields.
+"""
+
+# pylint: disable=import-outside-toplevel
+
+import argparse
+import importlib.util
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEB_APP_DIR = os.path.join(ROOT, "web-app")
+ML_CLIENT_DIR = os.path.join(ROOT, "machine-learning-client")
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers (None if empty)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class Stats:
+    """Thread-safe latency and error bookkeeping per stage"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+
+    def record(self, stage, seconds, ok):
+        """Record one observation of a stage"""
+        with self._lock:
+            self._samples.setdefault(stage, []).append((seconds, ok))
+
+    def summary(self, elapsed):
+        """Per-stage count, throughput, error rate and latency percentiles"""
+        with self._lock:
+            samples = {stage: list(values) for stage, values in self._samples.items()}
+
+        report = {}
+        for stage, values in sorted(samples.items()):
+            latencies = [seconds * 1000 for seconds, _ in values]
+            errors = sum(1 for _, ok in values if not ok)
+            report[stage] = {
+                "count": len(values),
+                "errors": errors,
+                "error_rate": errors / len(values),
+                "throughput": len(values) / elapsed if elapsed > 0 else 0.0,
+                "p50_ms": percentile(latencies, 0.50),
+                "p95_ms": percentile(latencies, 0.95),
+                "p99_ms": percentile(latencies, 0.99),
+            }
+        return report
+
+
+class TimingMiddleware:  # pylint: disable=too-few-public-methods
+    """WSGI middleware that records server-side latency per route"""
+
+    def __init__(self, app, service, stats):
+        self.app = app
+        self.service = service
+        self.stats = stats
+
+    def __call__(self, environ, start_response):
+        stage = f"{self.service} {environ.get('PATH_INFO', '')}"
+        status = {}
+
+        def capture(status_line, headers, exc_info=None):
+            status["code"] = int(status_line.split()[0])
+            return start_response(status_line, headers, exc_info)
+
+        start = time.perf_counter()
+        body = self.app(environ, capture)
+        try:
+            yield from body
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+            self.stats.record(
+                stage, time.perf_counter() - start, status.get("code", 500) < 400
+            )
+
+
+def load_corpus(directory):
+    """Load the upload manifests of a corpus directory"""
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(directory, name), encoding="utf-8") as fp:
+            manifest = json.load(fp)
+        with open(os.path.join(directory, manifest["image"]), "rb") as fp:
+            manifest["data"] = fp.read()
+        corpus.append(manifest)
+    if not corpus:
+        raise ValueError(f"No upload manifests found in {directory}")
+    return corpus
+
+
+def _load_module(name, path):
+    """Import a module from a file under a unique name"""
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # Flask finds templates and static files through sys.modules
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def use_scratch_dir(scratch):
+    """
+    Point everything the services write (journal, uploads, result pages)
+    into the scratch directory, so runs leave nothing in the repo
+    """
+    os.environ.setdefault("MONGO_DBNAME", "dutch_pay")
+    os.environ.setdefault("MONGO_DB", "dutch_pay")
+    os.environ["RECEIPT_JOURNAL"] = os.path.join(scratch, "receipt-journal.jsonl")
+    os.environ["UPLOAD_DIR"] = os.path.join(scratch, "uploads")
+    os.environ["SHARED_UPLOAD_DIR"] = os.environ["UPLOAD_DIR"]
+    os.environ["UPLOAD_SWEEP_MINUTES"] = "0"
+    os.environ.pop("UPLOAD_RECORD_DIR", None)
+
+
+def start_local_services(stats):
+    """
+    Run the ML client and the web-app in this process on free local ports,
+    both backed by one shared mongomock database. Returns the web-app URL
+    """
+    import mongomock
+    import pymongo
+    import pymongo.mongo_client
+    from werkzeug.serving import make_server
+
+    shared_client = mongomock.MongoClient()
+
+    def standin_client(*_args, **_kwargs):
+        return shared_client
+
+    pymongo.MongoClient = standin_client
+    pymongo.mongo_client.MongoClient = standin_client
+
+    use_scratch_dir(tempfile.mkdtemp(prefix="godutch-loadtest-"))
+    sys.path[:0] = [ML_CLIENT_DIR, WEB_APP_DIR]
+
+    ml_module = _load_module("godutch_ml_app", os.path.join(ML_CLIENT_DIR, "app.py"))
+    ml_server = make_server(
+        "127.0.0.1",
+        0,
+        TimingMiddleware(ml_module.app_setup(), "ml", stats),
+        threaded=True,
+    )
+    os.environ["ML_CLIENT"] = "127.0.0.1"
+    os.environ["ML_CLIENT_PORT"] = str(ml_server.port)
+
+    web_module = _load_module("godutch_web_app", os.path.join(WEB_APP_DIR, "app.py"))
+    web_server = make_server(
+        "127.0.0.1",
+        0,
+        TimingMiddleware(web_module.app_setup(), "web", stats),
+        threaded=True,
+    )
+
+    for server in (ml_server, web_server):
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{web_server.port}"
+
+
+def replay_upload(base_url, manifest, scheduled, stats, timeout):
+    """
+    Submit one upload and follow it to completion. Latencies are measured
+    from the scheduled arrival time so queueing in the harness is counted
+    """
+    with requests.Session() as session:
+        files = {
+            "upload-receipt": (
+                manifest.get("filename", manifest["image"]),
+                manifest["data"],
+            )
+        }
+        try:
+            response = session.post(
+                base_url + "/upload",
+                data=manifest["form"],
+                files=files,
+                timeout=timeout,
+            )
+        except requests.RequestException:
+            stats.record("client upload", time.perf_counter() - scheduled, False)
+            stats.record("client end-to-end", time.perf_counter() - scheduled, False)
+            return
+        stats.record(
+            "client upload",
+            time.perf_counter() - scheduled,
+            response.status_code in (200, 202),
+        )
+
+        status = "error"
+        deadline = scheduled + timeout
+        while response.status_code in (200, 202) and time.perf_counter() < deadline:
+            try:
+                poll = session.get(
+                    base_url + "/result/status?wait=25", timeout=timeout
+                ).json()
+            except (requests.RequestException, ValueError):
+                break
+            if poll["status"] != "pending":
+                status = poll["status"]
+                break
+        stats.record(
+            "client end-to-end", time.perf_counter() - scheduled, status == "done"
+        )
+
+
+def run(base_url, corpus, options, stats):
+    """
+    Replay options.requests uploads drawn round-robin from the corpus.
+    Arrivals are Poisson at options.rate per second (all at once if 0),
+    with at most options.concurrency uploads in flight
+    """
+    rng = random.Random(options.seed)
+    start = time.perf_counter()
+    arrival = start
+    with ThreadPoolExecutor(max_workers=options.concurrency) as executor:
+        for i in range(options.requests):
+            if options.rate > 0:
+                arrival += rng.expovariate(options.rate)
+                time.sleep(max(0.0, arrival - time.perf_counter()))
+            executor.submit(
+                replay_upload,
+                base_url,
+                corpus[i % len(corpus)],
+                max(arrival, start),
+                stats,
+                options.timeout,
+            )
+    return time.perf_counter() - start
+
+
+def format_report(report, elapsed):
+    """Render the summary as a plain-text table"""
+
+    def ms(value):
+        return "-" if value is None else f"{value:.0f}"
+
+    lines = [
+        f"elapsed: {elapsed:.1f} s",
+        f"{'stage':<24}{'count':>7}{'err%':>7}{'req/s':>8}"
+        f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}",
+    ]
+    for stage, row in report.items():
+        lines.append(
+            f"{stage:<24}{row['count']:>7}{100 * row['error_rate']:>6.1f}%"
+            f"{row['throughput']:>8.2f}{ms(row['p50_ms']):>9}"
+            f"{ms(row['p95_ms']):>9}{ms(row['p99_ms']):>9}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    """Command line options"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("corpus", help="directory of recorded uploads")
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--rate", type=float, default=1.0, help="arrivals per second, 0 for a burst"
+    )
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--target", help="URL of a running web-app to load instead")
+    parser.add_argument("--json", help="also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the load test and print the report"""
+    options = parse_args(argv)
+    corpus = load_corpus(options.corpus)
+    stats = Stats()
+    base_url = options.target or start_local_services(stats)
+
+    elapsed = run(base_url, corpus, options, stats)
+    report = stats.summary(elapsed)
+    print(format_report(report, elapsed))
+    if options.json:
+        with open(options.json, "w", encoding="utf-8") as fp:
+            json.dump({"elapsed": elapsed, "stages": report}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
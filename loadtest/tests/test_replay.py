@@ -0,0 +1,73 @@
+"""
+Tests for the load-test harness helpers
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# pylint: disable=wrong-import-position
+from replay import Stats, load_corpus, percentile, use_scratch_dir
+
+
+def test_percentile():
+    """Nearest-rank percentiles"""
+    values = list(range(1, 101))
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.95) == 95
+    assert percentile(values, 0.99) == 99
+    assert percentile([7], 0.99) == 7
+    assert percentile([], 0.5) is None
+
+
+def test_stats_summary():
+    """Error rates and throughput are computed per stage"""
+    stats = Stats()
+    stats.record("web /upload", 0.1, True)
+    stats.record("web /upload", 0.3, False)
+    stats.record("ml /submit", 0.2, True)
+
+    report = stats.summary(2.0)
+    assert report["web /upload"]["count"] == 2
+    assert report["web /upload"]["error_rate"] == 0.5
+    assert report["web /upload"]["throughput"] == 1.0
+    assert report["ml /submit"]["p50_ms"] == pytest.approx(200)
+
+
+def test_load_corpus(tmp_path):
+    """Manifests are loaded together with their images"""
+    (tmp_path / "abc.png").write_bytes(b"image")
+    (tmp_path / "abc.json").write_text(
+        json.dumps({"image": "abc.png", "filename": "r.png", "form": {"tip": "1"}})
+    )
+    corpus = load_corpus(tmp_path)
+    assert corpus[0]["data"] == b"image"
+    assert corpus[0]["form"] == {"tip": "1"}
+
+    (tmp_path / "empty").mkdir()
+    with pytest.raises(ValueError):
+        load_corpus(tmp_path / "empty")
+
+
+def test_use_scratch_dir(monkeypatch, tmp_path):
+    """Uploads and the journal of a local run stay out of the repo"""
+    for name in (
+        "UPLOAD_DIR",
+        "SHARED_UPLOAD_DIR",
+        "RECEIPT_JOURNAL",
+        "UPLOAD_SWEEP_MINUTES",
+        "MONGO_DB",
+        "MONGO_DBNAME",
+    ):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("UPLOAD_RECORD_DIR", str(tmp_path / "corpus"))
+
+    use_scratch_dir(str(tmp_path))
+    assert os.environ["UPLOAD_DIR"] == str(tmp_path / "uploads")
+    assert os.environ["SHARED_UPLOAD_DIR"] == os.environ["UPLOAD_DIR"]
+    assert os.environ["RECEIPT_JOURNAL"].startswith(str(tmp_path))
+    assert "UPLOAD_RECORD_DIR" not in os.environ
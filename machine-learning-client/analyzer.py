@@ -1,20 +1,100 @@
 """
-This module processes receipt images, extracts text with pytesseract,
+This module processes receipt images, extracts text with an OCR engine,
 and parses dish names with corresponding prices.
 """
 
 # pylint: disable=no-member
 
+import io
+import os
 import re
 import difflib
 import cv2
-import pytesseract
 import numpy
+from PIL import Image
 from db import store_receipt_info
+import merchants
+import ocr_engines
+import ledger
+
+PRICE_PATTERN = re.compile(r"([\d]+[,.][\d]{2})\s*$")
+TOTAL_PATTERN = re.compile(r"total", re.IGNORECASE)  # subtotal and total lines
+
+# Memory a single receipt may use while decoding; larger images are decoded
+# at reduced resolution. Each grayscale pixel costs one byte, and OCR builds
+# a few more copies of the same size from it
+OCR_MEMORY_BUDGET_MB = float(os.getenv("OCR_MEMORY_BUDGET_MB", "64"))
+BYTES_PER_PIXEL = 4
+REDUCED_DECODE_FLAGS = [
+    (1, cv2.IMREAD_GRAYSCALE),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+]
+
+# When results are streamed, the receipt is OCR'd in horizontal bands of
+# about this many rows, cut where a row holds no text
+OCR_BAND_ROWS = int(os.getenv("OCR_BAND_ROWS", "600"))
+INK_THRESHOLD = 128  # gray level below which a pixel counts as text
+
+# Lines with digits and a word read below this confidence are cropped,
+# enlarged and read again on their own instead of re-reading the page
+OCR_MIN_CONFIDENCE = float(os.getenv("OCR_MIN_CONFIDENCE", "60"))
+RETRY_SCALE = 2
+RETRY_MARGIN = 4  # pixels kept around a line when it is cropped
+MAX_RETRY_LINES = 20  # per receipt
+RETRY_CONFIG = "--psm 6"  # the stacked crops are read as one block of lines
+RETRY_GAP = 16  # blank rows between stacked crops
+
+
+def image_dimensions(data):
+    """Read (width, height) from the image header without decoding pixels"""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return img.size
+    except Image.DecompressionBombError:
+        # too big for Pillow to even open; treat it as the largest size
+        return (Image.MAX_IMAGE_PIXELS, Image.MAX_IMAGE_PIXELS)
+    except (OSError, ValueError):
+        return None
+
+
+def decode_image(data, memory_budget_mb=None):
+    """
+    Decode the image straight to grayscale. When the full resolution would
+    not fit in the memory budget, decode at 1/2, 1/4 or 1/8 resolution
+    (JPEG decodes those natively; other formats are scaled by OpenCV)
+    """
+    if memory_budget_mb is None:
+        memory_budget_mb = OCR_MEMORY_BUDGET_MB
+    max_pixels = memory_budget_mb * 1024 * 1024 / BYTES_PER_PIXEL
+
+    factor, flag = REDUCED_DECODE_FLAGS[0]
+    size = image_dimensions(data)
+    if size is not None:
+        for factor, flag in REDUCED_DECODE_FLAGS:
+            if size[0] * size[1] / (factor * factor) <= max_pixels:
+                break
+
+    img = cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8), flag)
+    if img is None:
+        raise ValueError("Could not decode the receipt image")
+
+    # even 1/8 resolution was too big: scale down the rest of the way
+    if img.size > max_pixels:
+        scale = (max_pixels / img.size) ** 0.5
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    if factor > 1:
+        print(f"Decoded receipt at 1/{factor} resolution:", img.shape)
+    return img
 
 
 def process_image(raw_img):
     """Convert the input image to grayscale for better OCR performance."""
+    if raw_img.ndim == 2:
+        return raw_img  # already decoded as grayscale
+
     processed_img = cv2.cvtColor(
         raw_img, cv2.COLOR_BGR2GRAY
     )  # pylint: disable=no-member
@@ -22,6 +102,284 @@ def process_image(raw_img):
     return processed_img
 
 
+def ocr_lines(img, offset=0, config=""):
+    """
+    Run OCR on the image and group the recognized words into lines, keeping
+    each line's bounding box (rows shifted by offset) and its words
+    """
+    data = ocr_engines.current().image_to_data(img, config)
+    lines = {}
+
+    for i, text in enumerate(data["text"]):
+        if not text.strip():
+            continue
+        key = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        word = {
+            "text": text,
+            "conf": float(data["conf"][i]),
+            "left": data["left"][i],
+            "top": data["top"][i] + offset,
+            "width": data["width"][i],
+            "height": data["height"][i],
+        }
+        lines.setdefault(key, []).append(word)
+
+    result = []
+    for words in lines.values():
+        result.append(
+            {
+                "text": " ".join(word["text"] for word in words),
+                "top": min(word["top"] for word in words),
+                "bottom": max(word["top"] + word["height"] for word in words),
+                "words": words,
+            }
+        )
+    return result
+
+
+def mean_confidence(line):
+    """Average confidence of the words of a line"""
+    return sum(word["conf"] for word in line["words"]) / len(line["words"])
+
+
+def needs_retry(line):
+    """Whether a line may hold a misread price worth reading again"""
+    if not line.get("words") or not any(ch.isdigit() for ch in line["text"]):
+        return False
+    return min(word["conf"] for word in line["words"]) < OCR_MIN_CONFIDENCE
+
+
+def line_crop(gray_img, line):
+    """
+    Enlarged, binarized crop of a line with its left and top in the page,
+    or None if the line has no area
+    """
+    height, width = gray_img.shape[:2]
+    left = max(0, min(word["left"] for word in line["words"]) - RETRY_MARGIN)
+    right = min(
+        width,
+        max(word["left"] + word["width"] for word in line["words"]) + RETRY_MARGIN,
+    )
+    top = max(0, line["top"] - RETRY_MARGIN)
+    bottom = min(height, line["bottom"] + RETRY_MARGIN)
+    if right <= left or bottom <= top:
+        return None
+
+    crop = cv2.resize(
+        gray_img[top:bottom, left:right],
+        None,
+        fx=RETRY_SCALE,
+        fy=RETRY_SCALE,
+        interpolation=cv2.INTER_CUBIC,
+    )
+    _, crop = cv2.threshold(crop, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return crop, left, top
+
+
+def page_word(word, left, top):
+    """A word read from an enlarged crop, in the coordinates of the page"""
+    return {
+        "text": word["text"],
+        "conf": word["conf"],
+        "left": left + word["left"] // RETRY_SCALE,
+        "top": top + word["top"] // RETRY_SCALE,
+        "width": word["width"] // RETRY_SCALE,
+        "height": word["height"] // RETRY_SCALE,
+    }
+
+
+def stack_crops(crops):
+    """
+    Stack crops into one white image, RETRY_GAP rows apart. Returns the
+    image and the rows each crop spans in it
+    """
+    width = max(crop.shape[1] for crop in crops)
+    parts, spans, row = [], [], 0
+    for crop in crops:
+        if parts:
+            parts.append(numpy.full((RETRY_GAP, width), 255, numpy.uint8))
+            row += RETRY_GAP
+        padded = numpy.full((crop.shape[0], width), 255, numpy.uint8)
+        padded[:, : crop.shape[1]] = crop
+        parts.append(padded)
+        spans.append((row, row + crop.shape[0]))
+        row += crop.shape[0]
+    return numpy.vstack(parts), spans
+
+
+def reread_lines(gray_img, lines):  # pylint: disable=too-many-locals
+    """
+    OCR lines again from enlarged, binarized crops of the page. The crops
+    are stacked into one image and read in a single OCR call, so the engine
+    (a tesseract process with pytesseract) is started once, not per line.
+    Returns the new reading of each line in page coordinates, or None where
+    nothing was read
+    """
+    crops = []
+    for index, line in enumerate(lines):
+        crop = line_crop(gray_img, line)
+        if crop is not None:
+            crops.append((index, *crop))
+    if not crops:
+        return [None] * len(lines)
+
+    stacked, spans = stack_crops([crop for _, crop, _, _ in crops])
+    words = [[] for _ in lines]
+    for reread in ocr_lines(stacked, config=RETRY_CONFIG):
+        for word in reread["words"]:
+            middle = word["top"] + word["height"] // 2
+            for (index, _, left, top), (start, end) in zip(crops, spans):
+                if start <= middle < end:
+                    word = dict(word, top=word["top"] - start)
+                    words[index].append(page_word(word, left, top))
+                    break
+
+    rereads = []
+    for line, line_words in zip(lines, words):
+        if not line_words:
+            rereads.append(None)
+            continue
+        line_words.sort(key=lambda word: word["left"])
+        rereads.append(
+            {
+                "text": " ".join(word["text"] for word in line_words),
+                "top": line["top"],
+                "bottom": line["bottom"],
+                "words": line_words,
+            }
+        )
+    return rereads
+
+
+def retry_budget():
+    """Lines that may still be re-read for one receipt"""
+    return {"lines": MAX_RETRY_LINES}
+
+
+def refine_lines(gray_img, lines, budget=None):
+    """
+    Read low-confidence lines with digits again and keep whichever reading
+    Tesseract is more confident about. Pass the same budget for every part
+    of a receipt so at most MAX_RETRY_LINES lines of it are re-read
+    """
+    budget = retry_budget() if budget is None else budget
+    doubtful = [index for index, line in enumerate(lines) if needs_retry(line)]
+    doubtful = doubtful[: max(budget["lines"], 0)]
+    if not doubtful:
+        return list(lines)
+    budget["lines"] -= len(doubtful)
+
+    refined = list(lines)
+    rereads = reread_lines(gray_img, [lines[index] for index in doubtful])
+    for index, reread in zip(doubtful, rereads):
+        line = lines[index]
+        if reread is not None and mean_confidence(reread) > mean_confidence(line):
+            print(
+                f"Re-read low confidence line: {line['text']!r} -> {reread['text']!r}"
+            )
+            refined[index] = reread
+    return refined
+
+
+def quiet_row(gray_img, target, reach):
+    """Row within reach of target holding the least text (closest on ties)"""
+    low = max(1, target - reach)
+    high = min(gray_img.shape[0] - 1, target + reach)
+    if high <= low:
+        return target
+    ink = (gray_img[low:high] < INK_THRESHOLD).sum(axis=1)
+    rows = low + numpy.flatnonzero(ink == ink.min())
+    return int(rows[numpy.argmin(numpy.abs(rows - target))])
+
+
+def band_bounds(gray_img, top, bottom, band_rows=None):
+    """
+    Split rows top..bottom into bands of about band_rows rows, cutting at
+    the emptiest row near each boundary so text lines are not split
+    """
+    band_rows = max(OCR_BAND_ROWS if band_rows is None else band_rows, 8)
+    bounds = []
+    while bottom - top > band_rows + band_rows // 4:
+        cut = quiet_row(gray_img, top + band_rows, band_rows // 4)
+        bounds.append((top, cut))
+        top = cut
+    bounds.append((top, bottom))
+    return bounds
+
+
+def ocr_rows(gray_img, top, bottom, on_band=None, budget=None):
+    """
+    OCR rows top..bottom of the image, re-reading doubtful lines within the
+    receipt's retry budget. With an on_band callback the rows are read band
+    by band and each band's lines are handed over as soon as they are
+    recognized
+    """
+    budget = retry_budget() if budget is None else budget
+    if bottom <= top:
+        return []
+    if on_band is None:
+        lines = ocr_lines(gray_img[top:bottom], offset=top)
+        return refine_lines(gray_img, lines, budget)
+
+    lines = []
+    for band_top, band_bottom in band_bounds(gray_img, top, bottom):
+        band = refine_lines(
+            gray_img,
+            ocr_lines(gray_img[band_top:band_bottom], offset=band_top),
+            budget,
+        )
+        on_band(band)
+        lines.extend(band)
+    return lines
+
+
+def has_total(lines):
+    """Whether a priced subtotal or total line has been read"""
+    return any(
+        TOTAL_PATTERN.search(line["text"]) and PRICE_PATTERN.search(line["text"])
+        for line in lines
+    )
+
+
+def read_receipt_lines(gray_img, on_band=None):
+    """
+    OCR the receipt; for merchants we have seen before the header and the
+    page from the cached item region down are read, skipping what lies
+    between them unless no subtotal or total turns up. Other receipts are
+    read whole. Returns the lines, the merchant and its template (None for
+    unknown merchants). on_band is passed to ocr_rows to stream lines while
+    the rest of the receipt is being read
+    """
+    height = gray_img.shape[0]
+    header_bottom = max(1, int(height * merchants.HEADER_FRACTION))
+    # cut the header on a blank row so no line is read half in each part
+    header_bottom = quiet_row(gray_img, header_bottom, header_bottom // 4)
+    header_lines = ocr_lines(gray_img[:header_bottom])
+    merchant = merchants.detect_merchant([line["text"] for line in header_lines])
+    template = merchants.get_template(merchant)
+    budget = retry_budget()
+
+    lines = refine_lines(gray_img, header_lines, budget)
+    if on_band is not None:
+        on_band(lines)
+    top = header_bottom
+    if template is not None:
+        # the region is only a hint: receipts of the same merchant can be
+        # longer or framed differently, so the page is read to its end
+        region_top, region_bottom = merchants.region_rows(template, height)
+        top = min(max(region_top, header_bottom), height)
+        rest = ocr_rows(gray_img, top, region_bottom, on_band, budget)
+        if not has_total(rest) and region_bottom < height:
+            rest += ocr_rows(gray_img, max(region_bottom, top), height, on_band, budget)
+        if not has_total(rest):
+            print("Merchant template found no total, reading the whole receipt")
+            rest = ocr_rows(gray_img, header_bottom, top, on_band, budget) + rest
+        return lines + rest, merchant, template
+
+    lines = lines + ocr_rows(gray_img, top, height, on_band, budget)
+    return lines, merchant, template
+
+
 def sanitize_string(dish):
     """Remove unnecessary characters from dish name"""
     index_start = 0
@@ -66,13 +424,10 @@ def filter_dishes(entries):
     return dishes, charges
 
 
-def parse_processed_lines(lines):
-    """Separate and parse dishes and prices from lines"""
-    pattern = re.compile(r"([\d]+[,.][\d]{2})\s*$")
-    entries = []
-
+def iter_entries(lines):
+    """Yield a dish and price entry for every priced line, as lines arrive"""
     for line in lines:
-        match = pattern.search(line)
+        match = PRICE_PATTERN.search(line)
         if match:
             price_string = match.group(1).replace(",", ".")  # Replace , with .
             try:
@@ -84,9 +439,28 @@ def parse_processed_lines(lines):
             if dish:
                 dish = sanitize_string(dish)
 
-                entries.append({"dish": dish, "price": price_float})
+                yield {"dish": dish, "price": price_float}
 
-    return entries
+
+def parse_processed_lines(lines):
+    """Separate and parse dishes and prices from lines"""
+    return list(iter_entries(lines))
+
+
+def report_dishes(on_partial):
+    """
+    Band callback for read_receipt_lines that parses every band as soon as
+    it is read and passes all dishes found so far to on_partial
+    """
+    found = []
+
+    def on_band(lines):
+        dishes, _ = filter_dishes(iter_entries(line["text"] for line in lines))
+        if dishes:
+            found.extend(dishes)
+            on_partial(list(found))
+
+    return on_band
 
 
 def normalize_text(text):
@@ -112,12 +486,69 @@ def normalize_dictionary_list(dictionary_list):
 #   "receipt": (img),
 #   "tip": (float),
 #   "num-people": (int),
-#   "people": [{"name": "", "items": ""}, ...]
+#   "people": [{"name": "", "items": ""}, ...],
+#   "owner": (str, optional - web-app session the receipt belongs to),
+#   "group": (str, optional - ledger group id the web-app handed out,
+#             defaults to the owner),
+#   "payer": (str, optional - who paid the bill, defaults to the first person)
+#   "engine": (str, optional - OCR engine, defaults to OCR_ENGINE)
+#   "idempotency_key": (str, optional - identifies repeats of one upload)
+#   "original_size": ((width, height), optional - size of the photo before
+#                     the browser downscaled it)
+#   "priority": (str, "interactive" (default) or "bulk" - OCR scheduling class)
+#   "deadline": (float, optional - seconds the receipt should be done in)
 # }
+def original_size(form):
+    """(width, height) the receipt photo was taken at, if the form says"""
+    try:
+        size = (int(form["original-width"]), int(form["original-height"]))
+    except (KeyError, ValueError):
+        return None
+    return size if min(size) > 0 else None
+
+
+def deadline_seconds(form):
+    """Seconds the sender wants the receipt done in, if the form says"""
+    try:
+        deadline = float(form["deadline"])
+    except (KeyError, ValueError):
+        return None
+    return deadline if deadline > 0 else None
+
+
+def user_input_from_form(form):
+    """Build the user_input described above from the fields the web-app posts"""
+    user_input = {
+        "receipt": "",
+        "tip": form["tip"],
+        "num-people": form["num-people"],
+        "people": [],
+        "owner": form.get("owner-id"),
+        "group": form.get("group"),
+        "payer": form.get("payer"),
+        "engine": form.get("ocr-engine"),
+        "idempotency_key": form.get("idempotency-key"),
+        "original_size": original_size(form),
+        "priority": form.get("priority") or "interactive",
+        "deadline": deadline_seconds(form),
+    }
+    for i in range(0, int(user_input["num-people"])):
+        user_input["people"].append(
+            {
+                "name": form["person-" + str(i + 1) + "-name"],
+                "items": form["person-" + str(i + 1) + "-items"],
+            }
+        )
+    return user_input
+
+
 def calculate_charge_per_person(
-    user_input, dish_entries, charge_entries
+    user_input, dish_entries, charge_entries, known_dishes=None
 ):  # pylint: disable=too-many-locals
-    """Calculate the total amount per person according to the provided bill"""
+    """
+    Calculate the total amount per person according to the provided bill;
+    known_dishes are canonical dish names of the merchant tried first
+    """
     # Convert charge_entries and dish_prices list of dictionaries into a single dictionary
 
     charges_dict = normalize_dictionary_list(charge_entries)
@@ -153,8 +584,14 @@ def calculate_charge_per_person(
     person_totals = {person["name"]: 0.0 for person in people}
 
     # For each dish that people ordered, add its cost share to each person who had the dish
+    known_dishes = [normalize_text(known) for known in known_dishes or []]
     for dish, consumers in dish_consumers.items():
-        matches = difflib.get_close_matches(dish, dish_prices.keys(), n=1, cutoff=0.6)
+        # Snap the user's spelling to the merchant's canonical one when possible
+        matches = difflib.get_close_matches(dish, known_dishes, n=1, cutoff=0.6)
+        if not matches or matches[0] not in dish_prices:
+            matches = difflib.get_close_matches(
+                dish, dish_prices.keys(), n=1, cutoff=0.6
+            )
         if matches:
             matched_key = matches[0]
             price = dish_prices[matched_key]
@@ -179,20 +616,46 @@ def calculate_charge_per_person(
     return person_totals
 
 
-def process_data(user_input, receipt_file):
-    """Reads the image sent by user, processes information, and stores data in DB"""
-    file_bytes = numpy.asarray(bytearray(receipt_file.read()), dtype=numpy.uint8)
-    img = cv2.imdecode(file_bytes, cv2.IMREAD_COLOR)
-
-    processed_text = pytesseract.image_to_string(process_image(img))
+def process_data(user_input, receipt_file, receipt_id=None, on_partial=None):
+    """
+    Reads the image sent by user, processes information, and stores data in DB.
+    Returns the receipt id, the charge per person and the dishes read. When on_partial is
+    given, the receipt is read in bands and on_partial receives the list of
+    dishes found so far whenever a band adds to it
+    """
+    gray_img = process_image(decode_image(receipt_file.read()))
+    with ocr_engines.selected(user_input.get("engine")):
+        lines, merchant, template = read_receipt_lines(
+            gray_img, report_dishes(on_partial) if on_partial else None
+        )
+    processed_text = "\n".join(line["text"] for line in lines)
     processed_lines = parse_processed_lines(processed_text.splitlines())
 
     filtered_dishes, other_charges = filter_dishes(processed_lines)
+    filtered_dishes = merchants.canonicalize_dishes(filtered_dishes, template)
 
     charge_per_person = calculate_charge_per_person(
-        user_input, filtered_dishes, other_charges
+        user_input,
+        filtered_dishes,
+        other_charges,
+        template["dishes"] if template else None,
     )
 
-    charge_id = store_receipt_info(processed_text, charge_per_person)
+    item_lines = [line for line in lines if PRICE_PATTERN.search(line["text"])]
+    merchants.learn_template(merchant, item_lines, filtered_dishes, gray_img.shape[0])
+
+    charge_id = store_receipt_info(
+        processed_text,
+        charge_per_person,
+        receipt_id,
+        user_input.get("owner"),
+        user_input.get("idempotency_key"),
+        user_input.get("original_size"),
+    )
+    ledger.record_user_receipt(user_input, charge_id, charge_per_person)
 
-    return charge_id
+    return {
+        "result_id": charge_id,
+        "charge_info": charge_per_person,
+        "dishes": filtered_dishes,
+    }
@@ -1,8 +1,147 @@
 """Flask application for Machine Learning Client API"""
 
-from flask import Flask, request, jsonify  # , url_for, redirect, session
+import io
+import os
+import queue
+import struct
+import threading
+import msgspec
+from flask import Flask, Response, request, jsonify, send_from_directory, abort
+from werkzeug.serving import make_server
 
-from analyzer import process_data
+from analyzer import process_data, user_input_from_form
+from ledger import group_summary
+import request_profiler
+import ocr_engines
+import dedup
+import warmup
+from scheduler import PRIORITIES, scheduler
+
+# Clients accepting one of the stream types get the dishes found so far
+# while OCR runs; MessagePack is the compact choice for the web-app
+STREAM_MIMETYPE = "application/x-ndjson"
+MSGPACK_STREAM_MIMETYPE = "application/x-msgpack-stream"
+MSGPACK_MIMETYPE = "application/x-msgpack"
+
+json_encoder = msgspec.json.Encoder()
+msgpack_encoder = msgspec.msgpack.Encoder()
+
+
+def frame_json(message):
+    """One line of newline-delimited JSON"""
+    return json_encoder.encode(message) + b"\n"
+
+
+def frame_msgpack(message):
+    """A MessagePack message prefixed with its length (4 bytes, big endian)"""
+    body = msgpack_encoder.encode(message)
+    return struct.pack(">I", len(body)) + body
+
+
+STREAM_FRAMES = {STREAM_MIMETYPE: frame_json, MSGPACK_STREAM_MIMETYPE: frame_msgpack}
+
+
+def success_payload(result):
+    """Response body of a processed receipt"""
+    return {
+        "status": "success",
+        "message": "Receipt received, processed, and stored in DB",
+        "result_id": str(result["result_id"]),
+        "charge_info": result["charge_info"],
+        "dishes": result.get("dishes", []),
+    }
+
+
+# A web-app on the same host can skip TCP and the multipart upload: the ML
+# client also listens on this Unix socket, and /submit-local reads the image
+# from the uploads volume the two services share
+LOCAL_SOCKET = os.getenv("ML_SOCKET")
+SHARED_UPLOAD_DIR = os.getenv("SHARED_UPLOAD_DIR", "uploads")
+# set on requests that came in over the Unix socket; /submit-local is not
+# served on the published TCP port
+LOCAL_ENVIRON_KEY = "dutchpay.local_socket"
+
+
+def shared_upload_path(name):
+    """Path of an image on the shared uploads volume, None if it is not there"""
+    root = os.path.realpath(SHARED_UPLOAD_DIR)
+    path = os.path.realpath(os.path.join(root, name))
+    if os.path.commonpath([root, path]) != root or not os.path.isfile(path):
+        return None
+    return path
+
+
+def serve_unix_socket(app, path):
+    """Serve the app on a Unix domain socket from a daemon thread"""
+
+    def local_app(environ, start_response):
+        environ[LOCAL_ENVIRON_KEY] = True
+        return app(environ, start_response)
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    server = make_server("unix://" + path, 0, local_app, threaded=True)
+    os.chmod(path, 0o660)
+    threading.Thread(
+        target=server.serve_forever, name="unix-socket", daemon=True
+    ).start()
+    print("ML Client listening on", path)
+    return server
+
+
+def read_receipt(data, receipt_file, receipt_id, on_partial=None):
+    """Process the receipt once the scheduler gives it an OCR slot"""
+    with scheduler.slot(data["priority"], data["owner"], data["deadline"]):
+        return process_data(data, receipt_file, receipt_id, on_partial=on_partial)
+
+
+def stream_results(
+    data, receipt_data, receipt_id, profile_token, mimetype=STREAM_MIMETYPE
+):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    Process the receipt in a worker thread and stream one message after
+    every OCR band that adds dishes ("partial", with the dishes found so
+    far), then the final result or an error. Messages are framed as
+    newline-delimited JSON or length-prefixed MessagePack
+    """
+    updates = queue.Queue()
+
+    def run():
+        try:
+            with request_profiler.maybe_profile(profile_token):
+                result = dedup.run_once(
+                    data["idempotency_key"],
+                    lambda: read_receipt(
+                        data,
+                        io.BytesIO(receipt_data),
+                        receipt_id,
+                        on_partial=lambda dishes: updates.put(
+                            {"status": "partial", "dishes": dishes}
+                        ),
+                    ),
+                )
+            print("ML Client processed data:", result["result_id"])
+            updates.put(success_payload(result))
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            print("Exception caught:", e)
+            updates.put(
+                {
+                    "status": "error",
+                    "message": f"Error processing the receipt in the ML client API: {e}",
+                }
+            )
+
+    threading.Thread(target=run, name="receipt-stream", daemon=True).start()
+
+    frame = STREAM_FRAMES[mimetype]
+
+    def generate():
+        while True:
+            update = updates.get()
+            yield frame(update)
+            if update["status"] != "partial":
+                return
+
+    return Response(generate(), mimetype=mimetype)
 
 
 def app_setup():
@@ -16,58 +155,152 @@ def app_setup():
         """
         return "running", 200
 
-    @app.route("/submit", methods=["POST"])
-    def submit():
+    @app.route("/ready", methods=["GET"])
+    def ready():
         """
-        Receive data from the web-app and run analysis
+        Readiness probe: 200 once the OCR engine has been warmed up
         """
-        print("reached /submit")
-        print("ML Client: request.form contents:", request.form)
-        print("ML Client: request.files contents:", request.files)
+        state = warmup.readiness()
+        return jsonify(state), 200 if state["status"] == "ready" else 503
 
-        data = {"receipt": "", "tip": 0, "num-people": 0, "people": []}
+    @app.route("/ledger/<group_id>", methods=["GET"])
+    def show_ledger(group_id):
+        """
+        Running balances of a group and the payments that settle them
+        """
+        return jsonify(group_summary(group_id)), 200
+
+    @app.route("/scheduler", methods=["GET"])
+    def show_scheduler():
+        """
+        Receipts being OCR'd and waiting, per priority class
+        """
+        return jsonify(scheduler.stats()), 200
 
-        # receive data from the POST request
+    def require_profile_token():
+        """Hide the profiling endpoints unless the admin token is presented"""
+        if not request_profiler.token_valid(request.headers.get("X-Profile-Token")):
+            abort(404)
 
-        # Convert data to organized form
-        # data["receipt"] = request.form["receipt"]
-        data["num-people"] = request.form["num-people"]
-        data["tip"] = request.form["tip"]
-        for i in range(0, int(data["num-people"])):
-            data["people"].append(
+    @app.route("/admin/profile", methods=["POST"])
+    def arm_profiling():
+        """
+        Profile the next `count` requests to /submit
+        """
+        require_profile_token()
+        count = request_profiler.arm(request.args.get("count", 1, type=int))
+        return jsonify({"armed": count}), 200
+
+    @app.route("/admin/profiles", methods=["GET"])
+    def list_profiles():
+        """
+        List stored profiles
+        """
+        require_profile_token()
+        return (
+            jsonify(
                 {
-                    "name": request.form["person-" + str(i + 1) + "-name"],
-                    "items": request.form["person-" + str(i + 1) + "-items"],
+                    "armed": request_profiler.armed_count(),
+                    "profiles": request_profiler.list_profiles(),
                 }
-            )
+            ),
+            200,
+        )
 
-        if "receipt" not in request.files:
-            return ("receipt not provided in files", 400)
-        receipt_file = request.files["receipt"]
-        print("ML Client: Received receipt file with filename:", receipt_file.filename)
+    @app.route("/admin/profiles/<path:filename>", methods=["GET"])
+    def download_profile(filename):
+        """
+        Download one file of a stored profile
+        """
+        require_profile_token()
+        return send_from_directory(
+            request_profiler.PROFILE_DIR, filename, as_attachment=True
+        )
 
-        try:
-            result_id = process_data(data, receipt_file)
-            print("ML Client processed data:", result_id)
-            return (
-                jsonify(
-                    {
-                        "status": "success",
-                        "message": "Receipt received, processed, and stored in DB",
-                        "result_id": str(result_id),
-                    }
-                ),
-                200,
+    def analyze(form, receipt_file):
+        """Run analysis on a receipt and the form fields sent with it"""
+        # convert the form fields to organized form
+        data = user_input_from_form(form)
+        if data["engine"] and data["engine"] not in ocr_engines.ENGINES:
+            return (f"Unknown OCR engine: {data['engine']}", 400)
+        if data["priority"] not in PRIORITIES:
+            return (f"Unknown priority: {data['priority']}", 400)
+
+        # the web-app pre-generates the id so it can report status right away
+        receipt_id = form.get("receipt-id")
+
+        mimetype = request.accept_mimetypes.best
+        if mimetype in STREAM_FRAMES:
+            return stream_results(
+                data,
+                receipt_file.read(),
+                receipt_id,
+                request.headers.get("X-Profile"),
+                mimetype,
             )
 
+        try:
+            with request_profiler.maybe_profile(request.headers.get("X-Profile")):
+                # double submits of one upload share a single OCR run
+                result = dedup.run_once(
+                    data["idempotency_key"],
+                    lambda: read_receipt(data, receipt_file, receipt_id),
+                )
+            print("ML Client processed data:", result["result_id"])
+            # the receipt is written to the DB in the background, so the
+            # charges are returned for the web-app to use right away
+            if mimetype == MSGPACK_MIMETYPE:
+                return Response(
+                    msgpack_encoder.encode(success_payload(result)),
+                    mimetype=MSGPACK_MIMETYPE,
+                )
+            return jsonify(success_payload(result)), 200
+
         except Exception as e:  # pylint: disable=broad-exception-caught
             print("Exception caught:", e)
             return (f"Error processing the receipt in the ML client API: {str(e)}", 500)
 
+    @app.route("/submit", methods=["POST"])
+    def submit():
+        """
+        Receive data from the web-app and run analysis
+        """
+        print("reached /submit")
+        print("ML Client: request.form contents:", request.form)
+        print("ML Client: request.files contents:", request.files)
+
+        if "receipt" not in request.files:
+            return ("receipt not provided in files", 400)
+        receipt_file = request.files["receipt"]
+        print("ML Client: Received receipt file with filename:", receipt_file.filename)
+        return analyze(request.form, receipt_file)
+
+    @app.route("/submit-local", methods=["POST"])
+    def submit_local():
+        """
+        Receive the form fields and the path of the receipt on the shared
+        uploads volume from a web-app on the same host, and run analysis
+        """
+        if not request.environ.get(LOCAL_ENVIRON_KEY):
+            # anyone reaching the TCP port could have any upload read
+            abort(404)
+        message = request.get_json(silent=True) or {}
+        path = shared_upload_path(str(message.get("image", "")))
+        if path is None:
+            return ("receipt not found on the shared uploads volume", 400)
+        print("ML Client: Reading shared receipt:", path)
+        with open(path, "rb") as fp:
+            receipt_file = io.BytesIO(fp.read())
+        return analyze(message.get("form") or {}, receipt_file)
+
     return app
 
 
 my_app = app_setup()
+if warmup.WARM_UP:
+    warmup.start()
+if LOCAL_SOCKET:
+    serve_unix_socket(my_app, LOCAL_SOCKET)
 
 # keep alive
 if __name__ == "__main__":
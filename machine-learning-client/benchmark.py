@@ -0,0 +1,412 @@
+"""
+Benchmark of the OCR engines on a corpus of receipts. The corpus is a
+directory of receipt images, each next to a .txt file of the same name
+holding its true text. For every engine the report gives the OCR latency,
+the character accuracy of the text and the share of true prices read
+
+    python benchmark.py path/to/corpus [--engines tesseract onnx] [--json out]
+
+With --receipts the truths are .json files instead, holding the dishes,
+subtotal and tax of the receipt (and optionally the people and tip to
+split it with):
+
+    {"dishes": [{"dish": "Pizza", "price": 12.5}], "subtotal": 12.5,
+     "tax": 1.1, "tip": 2, "people": [{"name": "jane", "items": "pizza"}]}
+
+Every pipeline configuration (engine, decode memory budget, band height,
+line re-reading, merchant templates) is then run end to end through
+read_receipt_lines and reported with its throughput, the precision and
+recall of the dishes parsed and filtered from the text, and the error of
+the resulting per-person totals. Each configuration starts with an empty
+template cache, so with templates on, repeat receipts of a merchant in the
+corpus are read from the region the earlier ones taught. Configurations
+no other one beats on both speed and totals error are marked as the
+frontier
+
+    python benchmark.py path/to/corpus --receipts --budgets 64 16 --band-rows 0 600
+"""
+
+import argparse
+import contextlib
+import difflib
+import io
+import itertools
+import json
+import math
+import os
+import time
+import analyzer
+from analyzer import (
+    OCR_MEMORY_BUDGET_MB,
+    PRICE_PATTERN,
+    calculate_charge_per_person,
+    decode_image,
+    filter_dishes,
+    normalize_dictionary_list,
+    normalize_text,
+    ocr_lines,
+    parse_processed_lines,
+    process_image,
+    read_receipt_lines,
+    refine_lines,
+)
+import merchants
+import ocr_engines
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"}
+DISH_MATCH_RATIO = 0.8  # name similarity at which a parsed dish counts as found
+CENT = 0.005
+
+
+def load_corpus(directory, truth_ext=".txt"):
+    """
+    (name, image bytes, truth) of every receipt in the corpus; .txt truths
+    are returned as text, .json truths parsed
+    """
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        stem, ext = os.path.splitext(name)
+        truth_path = os.path.join(directory, stem + truth_ext)
+        if ext.lower() not in IMAGE_EXTENSIONS or not os.path.exists(truth_path):
+            continue
+        with open(os.path.join(directory, name), "rb") as fp:
+            data = fp.read()
+        with open(truth_path, encoding="utf-8") as fp:
+            truth = json.load(fp) if truth_ext == ".json" else fp.read()
+        corpus.append((name, data, truth))
+    return corpus
+
+
+def text_accuracy(text, truth):
+    """Similarity of the OCR'd text to the true text, from 0 to 1"""
+    return difflib.SequenceMatcher(
+        None, normalize_text(text), normalize_text(truth)
+    ).ratio()
+
+
+def prices(text):
+    """Prices at the end of the lines of a text"""
+    found = []
+    for line in text.splitlines():
+        match = PRICE_PATTERN.search(line.strip())
+        if match:
+            found.append(match.group(1).replace(",", "."))
+    return found
+
+
+def price_recall(text, truth):
+    """Share of the true prices that were read (1 if there are none)"""
+    expected = prices(truth)
+    if not expected:
+        return 1.0
+    read = prices(text)
+    hits = 0
+    for price in expected:
+        if price in read:
+            read.remove(price)
+            hits += 1
+    return hits / len(expected)
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(fraction * len(ordered))) - 1]
+
+
+def benchmark_engine(name, corpus, refine=False):
+    """OCR every receipt with one engine and summarize the results"""
+    latencies, accuracies, recalls = [], [], []
+    with ocr_engines.selected(name):
+        images = [process_image(decode_image(data)) for _, data, _ in corpus]
+        ocr_lines(images[0])  # warm up models and caches outside the timing
+
+        for gray_img, (_, _, truth) in zip(images, corpus):
+            start = time.perf_counter()
+            lines = ocr_lines(gray_img)
+            if refine:
+                lines = refine_lines(gray_img, lines)
+            latencies.append(time.perf_counter() - start)
+
+            text = "\n".join(line["text"] for line in lines)
+            accuracies.append(text_accuracy(text, truth))
+            recalls.append(price_recall(text, truth))
+
+    return {
+        "engine": name,
+        "receipts": len(corpus),
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+        "p50_ms": 1000 * percentile(latencies, 0.5),
+        "p95_ms": 1000 * percentile(latencies, 0.95),
+        "text_accuracy": sum(accuracies) / len(accuracies),
+        "price_recall": sum(recalls) / len(recalls),
+    }
+
+
+@contextlib.contextmanager
+def pipeline_settings(config):
+    """Band height and line re-reading of a configuration, in the enclosed block"""
+    saved = analyzer.OCR_BAND_ROWS, analyzer.MAX_RETRY_LINES
+    if config["band_rows"]:
+        analyzer.OCR_BAND_ROWS = config["band_rows"]
+    if not config["refine"]:
+        analyzer.MAX_RETRY_LINES = 0
+    try:
+        yield
+    finally:
+        analyzer.OCR_BAND_ROWS, analyzer.MAX_RETRY_LINES = saved
+
+
+def read_receipt(data, config):
+    """
+    Decode and OCR a receipt the way process_data does with the settings
+    of the configuration, learning the merchant's template on the way.
+    Returns the text and the template it was read with
+    """
+    gray_img = process_image(decode_image(data, config["memory_budget_mb"]))
+    # bands are only read one by one when someone listens for them
+    on_band = (lambda band: None) if config["band_rows"] else None
+    with ocr_engines.selected(config["engine"]), pipeline_settings(config):
+        lines, merchant, template = read_receipt_lines(gray_img, on_band)
+
+    text = "\n".join(line["text"] for line in lines)
+    dishes, _ = filter_dishes(parse_processed_lines(text.splitlines()))
+    item_lines = [line for line in lines if PRICE_PATTERN.search(line["text"])]
+    merchants.learn_template(merchant, item_lines, dishes, gray_img.shape[0])
+    return text, template
+
+
+def matched_dishes(found, truth):
+    """Number of true dishes found with their price and a close enough name"""
+    unmatched = list(truth)
+    hits = 0
+    for dish in found:
+        for true_dish in unmatched:
+            similarity = difflib.SequenceMatcher(
+                None, normalize_text(dish["dish"]), normalize_text(true_dish["dish"])
+            ).ratio()
+            if (
+                abs(dish["price"] - true_dish["price"]) < CENT
+                and similarity >= DISH_MATCH_RATIO
+            ):
+                unmatched.remove(true_dish)
+                hits += 1
+                break
+    return hits
+
+
+def split_totals(truth, dishes, charges):
+    """
+    Per-person totals of the receipt computed from the given dishes and
+    charges. Without people in the truth, everyone orders one true dish
+    """
+    people = truth.get("people") or [
+        {"name": str(number), "items": dish["dish"]}
+        for number, dish in enumerate(truth["dishes"])
+    ]
+    user_input = {"tip": truth.get("tip", 0), "people": people}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return calculate_charge_per_person(user_input, dishes, charges)
+    except (TypeError, ValueError):  # e.g. a subtotal read without its tax
+        return {person["name"]: 0.0 for person in people}
+
+
+def true_charges(truth):
+    """Subtotal and tax of the truth as charge entries"""
+    return [
+        {"dish": name, "price": truth[name]}
+        for name in ("subtotal", "tax")
+        if truth.get(name) is not None
+    ]
+
+
+def score_receipt(text, truth, template=None):
+    """Compare the dishes, charges and totals read from a text with the truth"""
+    dishes, charges = filter_dishes(parse_processed_lines(text.splitlines()))
+    dishes = merchants.canonicalize_dishes(dishes, template)
+    read = normalize_dictionary_list(charges)
+    expected = split_totals(truth, truth["dishes"], true_charges(truth))
+    got = split_totals(truth, dishes, charges)
+    errors = [abs(got.get(name, 0.0) - total) for name, total in expected.items()]
+    return {
+        "found": len(dishes),
+        "true": len(truth["dishes"]),
+        "hits": matched_dishes(dishes, truth["dishes"]),
+        "subtotal": truth.get("subtotal") is not None
+        and abs((read.get("subtotal") or 0) - truth["subtotal"]) < CENT,
+        "tax": truth.get("tax") is not None
+        and abs((read.get("tax") or 0) - truth["tax"]) < CENT,
+        "total_error": sum(errors) / len(errors) if errors else 0.0,
+        "exact": all(error < 0.01 for error in errors),
+    }
+
+
+def configurations(
+    engines, budgets, band_rows, refine_options, template_options=(True,)
+):
+    """Every combination of the pipeline settings to compare"""
+    return [
+        {
+            "engine": engine,
+            "memory_budget_mb": budget,
+            "band_rows": rows,
+            "refine": refine,
+            "templates": templates,
+        }
+        for engine, budget, rows, refine, templates in itertools.product(
+            engines, budgets, band_rows, refine_options, template_options
+        )
+    ]
+
+
+def benchmark_configuration(config, corpus):
+    """
+    Run every receipt through one configuration and summarize the scores;
+    templates learned here do not reach the DB or other configurations
+    """
+    with merchants.local_templates(config["templates"]):
+        read_receipt(corpus[0][1], config)  # warm up outside the timing
+
+    latencies, scores = [], []
+    with merchants.local_templates(config["templates"]):
+        for _, data, truth in corpus:
+            start = time.perf_counter()
+            text, template = read_receipt(data, config)
+            latencies.append(time.perf_counter() - start)
+            scores.append(score_receipt(text, truth, template))
+
+    found = sum(score["found"] for score in scores)
+    true = sum(score["true"] for score in scores)
+    hits = sum(score["hits"] for score in scores)
+    return dict(
+        config,
+        receipts=len(corpus),
+        receipts_per_s=len(corpus) / sum(latencies),
+        mean_ms=1000 * sum(latencies) / len(latencies),
+        p95_ms=1000 * percentile(latencies, 0.95),
+        precision=hits / found if found else 1.0,
+        recall=hits / true if true else 1.0,
+        subtotal_accuracy=sum(score["subtotal"] for score in scores) / len(scores),
+        tax_accuracy=sum(score["tax"] for score in scores) / len(scores),
+        total_error=sum(score["total_error"] for score in scores) / len(scores),
+        exact_totals=sum(score["exact"] for score in scores) / len(scores),
+    )
+
+
+def mark_frontier(results):
+    """Flag the results no other result beats on both throughput and error"""
+    for row in results:
+        row["frontier"] = not any(
+            other["receipts_per_s"] >= row["receipts_per_s"]
+            and other["total_error"] <= row["total_error"]
+            and (
+                other["receipts_per_s"] > row["receipts_per_s"]
+                or other["total_error"] < row["total_error"]
+            )
+            for other in results
+        )
+    return results
+
+
+def print_engines(results):
+    """Table of the OCR engine benchmark"""
+    print(
+        f"{'engine':<12}{'receipts':>9}{'mean ms':>9}{'p50 ms':>9}"
+        f"{'p95 ms':>9}{'text acc':>10}{'prices':>8}"
+    )
+    for row in results:
+        print(
+            f"{row['engine']:<12}{row['receipts']:>9}{row['mean_ms']:>9.0f}"
+            f"{row['p50_ms']:>9.0f}{row['p95_ms']:>9.0f}"
+            f"{row['text_accuracy']:>10.3f}{row['price_recall']:>8.3f}"
+        )
+
+
+def print_configurations(results):
+    """Table of the receipt-level benchmark, frontier rows starred"""
+    print(
+        f"  {'engine':<12}{'budget':>7}{'bands':>7}{'refine':>7}{'tmpl':>6}"
+        f"{'rcpt/s':>8}"
+        f"{'p95 ms':>8}{'prec':>7}{'recall':>7}{'subtot':>7}{'tax':>6}"
+        f"{'err $':>7}{'exact':>7}"
+    )
+    for row in results:
+        print(
+            f"{'*' if row['frontier'] else ' '} {row['engine']:<12}"
+            f"{row['memory_budget_mb']:>7g}{row['band_rows']:>7}"
+            f"{'yes' if row['refine'] else 'no':>7}"
+            f"{'yes' if row['templates'] else 'no':>6}{row['receipts_per_s']:>8.2f}"
+            f"{row['p95_ms']:>8.0f}{row['precision']:>7.3f}{row['recall']:>7.3f}"
+            f"{row['subtotal_accuracy']:>7.2f}{row['tax_accuracy']:>6.2f}"
+            f"{row['total_error']:>7.2f}{row['exact_totals']:>7.2f}"
+        )
+
+
+def main():
+    """Run the benchmark from the command line"""
+    parser = argparse.ArgumentParser(description="Compare the OCR engines")
+    parser.add_argument("corpus", help="directory of receipt images and truths")
+    parser.add_argument(
+        "--engines", nargs="+", help="engines to compare (default: all available)"
+    )
+    parser.add_argument(
+        "--refine",
+        action="store_true",
+        help="re-read low-confidence lines too (with --receipts: compare both)",
+    )
+    parser.add_argument(
+        "--templates",
+        action="store_true",
+        help="with --receipts: compare reading with and without merchant templates",
+    )
+    parser.add_argument(
+        "--receipts",
+        action="store_true",
+        help="score parsed dishes and totals against .json truths",
+    )
+    parser.add_argument(
+        "--budgets",
+        nargs="+",
+        type=float,
+        default=[OCR_MEMORY_BUDGET_MB],
+        help="decode memory budgets in MB to compare (with --receipts)",
+    )
+    parser.add_argument(
+        "--band-rows",
+        nargs="+",
+        type=int,
+        default=[0],
+        help="OCR band heights to compare, 0 for whole receipts (with --receipts)",
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    truth_ext = ".json" if args.receipts else ".txt"
+    corpus = load_corpus(args.corpus, truth_ext)
+    if not corpus:
+        parser.error(f"no receipts with {truth_ext} truths found in {args.corpus}")
+    engines = args.engines or ocr_engines.available_engines()
+
+    if args.receipts:
+        configs = configurations(
+            engines,
+            args.budgets,
+            args.band_rows,
+            [False, True] if args.refine else [False],
+            [False, True] if args.templates else [True],
+        )
+        results = mark_frontier(
+            [benchmark_configuration(config, corpus) for config in configs]
+        )
+        print_configurations(results)
+    else:
+        results = [benchmark_engine(name, corpus, args.refine) for name in engines]
+        print_engines(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
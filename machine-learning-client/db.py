@@ -4,7 +4,16 @@ in the DB
 """
 
 import os
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from bson import json_util
+from bson.objectid import ObjectId
+import pymongo
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -12,19 +21,244 @@ uri = os.getenv("MONGO_URI")
 client = MongoClient(uri)
 db_name = os.getenv("MONGO_DBNAME")
 
+# Receipts are written behind the request by a background writer unless
+# RECEIPT_WRITE_BEHIND=0; inserts are batched and journaled to a local file
+# while the DB is unreachable
+WRITE_BEHIND = os.getenv("RECEIPT_WRITE_BEHIND", "1") == "1"
+BATCH_SIZE = int(os.getenv("RECEIPT_BATCH_SIZE", "50"))
+FLUSH_INTERVAL = float(os.getenv("RECEIPT_FLUSH_MS", "200")) / 1000
+JOURNAL_PATH = os.getenv(
+    "RECEIPT_JOURNAL",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "receipt-journal.jsonl"),
+)
+DUPLICATE_KEY = 11000
+LEDGER_APPLIED_WINDOW = 1000  # receipts remembered per group to skip replays
+# Lookups made before OCR starts give up after this long, including finding
+# a server, instead of pymongo's default 30 s; callers go on without them
+LOOKUP_TIMEOUT = float(os.getenv("DB_LOOKUP_TIMEOUT_MS", "500")) / 1000
+
 
 def get_db():
     """Get DB connection"""
     return client[db_name]
 
 
-def store_receipt_info(receipt_text, charge_per_person):
-    """Store raw receipt text and charge per person info in DB"""
-    db = get_db()
+def _insert_ignoring_duplicates(collection, documents):
+    """Insert documents, skipping ones that were already written"""
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != DUPLICATE_KEY for error in errors):
+            raise
+
+
+class ReceiptWriter:
+    """
+    Background writer that coalesces receipt inserts into insert_many
+    batches, flushing when a batch is full or flush_interval has passed
+    """
+
+    def __init__(self, batch_size, flush_interval, journal_path):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.journal_path = journal_path
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, document):
+        """Queue a document for insertion, starting the writer if needed"""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name="receipt-writer", daemon=True
+                )
+                self._thread.start()
+        self._queue.put(document)
+
+    def flush(self):
+        """Block until every queued document has been written or journaled"""
+        self._queue.join()
+
+    def _run(self):
+        """Writer loop: collect a batch, write it, repeat"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self.write_batch(batch)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                # keep the writer alive for the receipts still to come
+                print("Receipt writer failed, receipts lost:", e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def write_batch(self, batch):
+        """Insert a batch, falling back to the journal if the DB is unavailable"""
+        try:
+            receipts = get_db().receipts
+            self.replay_journal(receipts)
+            _insert_ignoring_duplicates(receipts, batch)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            print("Could not write receipts, journaling them:", e)
+            try:
+                with open(self.journal_path, "a", encoding="utf-8") as fp:
+                    for document in batch:
+                        fp.write(json_util.dumps(document) + "\n")
+            except OSError as journal_error:
+                print("Could not journal receipts, they are lost:", journal_error)
+
+    def replay_journal(self, receipts):
+        """Insert receipts journaled during an outage, then drop the journal"""
+        if not os.path.exists(self.journal_path):
+            return
+        documents = []
+        with open(self.journal_path, encoding="utf-8") as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                try:
+                    documents.append(json_util.loads(line))
+                except ValueError:
+                    # a line torn by a crash while it was being appended
+                    print("Skipping unreadable journal line:", line[:80])
+        if documents:
+            _insert_ignoring_duplicates(receipts, documents)
+        os.remove(self.journal_path)
+        print("Replayed", len(documents), "journaled receipts")
 
+
+receipt_writer = ReceiptWriter(BATCH_SIZE, FLUSH_INTERVAL, JOURNAL_PATH)
+atexit.register(receipt_writer.flush)
+
+
+def flush_receipts():
+    """Wait for receipts queued by store_receipt_info to reach the DB"""
+    receipt_writer.flush()
+
+
+def store_receipt_info(
+    receipt_text,
+    charge_per_person,
+    receipt_id=None,
+    owner_id=None,
+    key=None,
+    original_size=None,
+):  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    """
+    Store raw receipt text and charge per person info in DB, under the id
+    chosen by the caller when one is given. The id is returned right away;
+    with write-behind enabled the document is inserted in the background.
+    The owner, timestamp, people and total are stored for history queries,
+    the idempotency key of the request, if any, to recognize repeats, and
+    the size of the photo before the browser downscaled it, if known
+    """
     receipt_info = {
+        "_id": ObjectId(receipt_id) if receipt_id else ObjectId(),
         "receipt_text": receipt_text,
         "charge_info": charge_per_person,
+        "status": "done",
+        "timestamp": datetime.now(timezone.utc),
+        "owner_id": owner_id,
+        "people": [name.strip().lower() for name in charge_per_person],
+        "total": round(sum(charge_per_person.values()), 2),
+    }
+    if key:
+        receipt_info["idempotency_key"] = key
+    if original_size:
+        receipt_info["original_size"] = {
+            "width": original_size[0],
+            "height": original_size[1],
+        }
+
+    if WRITE_BEHIND:
+        receipt_writer.submit(receipt_info)
+    else:
+        get_db().receipts.insert_one(receipt_info)
+    return receipt_info["_id"]
+
+
+def find_receipt_by_key(key, since):
+    """The receipt stored since the given time for an idempotency key, if any"""
+    with pymongo.timeout(LOOKUP_TIMEOUT):
+        return get_db().receipts.find_one(
+            {"idempotency_key": key, "timestamp": {"$gte": since}},
+            {"charge_info": 1},
+        )
+
+
+def get_merchant_template(merchant):
+    """Get the stored receipt layout of a merchant, or None if unknown"""
+    db = get_db()
+    with pymongo.timeout(LOOKUP_TIMEOUT):
+        return db.merchants.find_one({"_id": merchant})
+
+
+def store_merchant_template(template):
+    """Insert or replace the receipt layout of a merchant"""
+    db = get_db()
+    db.merchants.replace_one({"_id": template["_id"]}, template, upsert=True)
+
+
+def _balance_field(name):
+    """Field path of a person's balance; escapes characters Mongo reserves"""
+    escaped = name.replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+    return "balances_cents." + escaped
+
+
+def _balance_name(field):
+    """Person name of an escaped balance field"""
+    return field.replace("%2E", ".").replace("%24", "$").replace("%25", "%")
+
+
+def apply_ledger_entries(group_id, receipt_id, balance_changes, transactions):
+    """
+    Add a receipt's balance changes (in cents, per person) to the group's
+    running balances in one atomic update, and record its transactions.
+    Replaying the same receipt leaves the balances untouched
+    """
+    db = get_db()
+    receipt_id = str(receipt_id)
+
+    try:
+        db.balances.update_one(
+            {"_id": group_id, "applied": {"$ne": receipt_id}},
+            {
+                "$inc": {
+                    _balance_field(name): cents
+                    for name, cents in balance_changes.items()
+                },
+                "$push": {
+                    "applied": {"$each": [receipt_id], "$slice": -LEDGER_APPLIED_WINDOW}
+                },
+            },
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # the group exists and already has this receipt applied
+        print("Ledger already has receipt", receipt_id)
+
+    if transactions:
+        _insert_ignoring_duplicates(db.transactions, transactions)
+
+
+def get_group_balances(group_id):
+    """Get the running balance of every person in a group, in cents"""
+    db = get_db()
+    document = db.balances.find_one({"_id": group_id}, {"balances_cents": 1})
+    if not document:
+        return {}
+    return {
+        _balance_name(name): cents
+        for name, cents in document.get("balances_cents", {}).items()
     }
-    result = db.receipts.insert_one(receipt_info)
-    return result.inserted_id
@@ -0,0 +1,94 @@
+"""
+This module makes receipt submissions idempotent. Requests carrying the
+same idempotency key share one computation: concurrent repeats wait for the
+one in flight, and later repeats within the window get its result back
+instead of running OCR again
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from pymongo.errors import PyMongoError
+from db import find_receipt_by_key
+
+IDEMPOTENCY_WINDOW = float(os.getenv("IDEMPOTENCY_WINDOW_SECONDS", "600"))
+MAX_REMEMBERED = 1000  # results kept in process for repeats
+
+_lock = threading.Lock()
+_in_flight = {}
+_results = OrderedDict()
+
+
+class _Flight:  # pylint: disable=too-few-public-methods
+    """One computation that repeats of the same request wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _remembered(key, now):
+    """Result of a recent request with this key (caller holds the lock)"""
+    while _results:
+        oldest_key, (finished, _) = next(iter(_results.items()))
+        if now - finished <= IDEMPOTENCY_WINDOW and len(_results) <= MAX_REMEMBERED:
+            break
+        del _results[oldest_key]
+    entry = _results.get(key)
+    return entry[1] if entry is not None else None
+
+
+def _stored(key):
+    """Result of a request with this key stored by any ML client process"""
+    since = datetime.now(timezone.utc) - timedelta(seconds=IDEMPOTENCY_WINDOW)
+    try:
+        receipt = find_receipt_by_key(key, since)
+    except PyMongoError as e:
+        print("Could not look up the idempotency key:", e)
+        return None
+    if receipt is None:
+        return None
+    return {"result_id": receipt["_id"], "charge_info": receipt["charge_info"]}
+
+
+def run_once(key, compute):
+    """
+    Return compute(), computed once per key within the window. Without a key
+    compute() always runs. Errors are passed to everyone waiting but are not
+    remembered, so a failed request can be retried
+    """
+    if not key:
+        return compute()
+
+    with _lock:
+        result = _remembered(key, time.monotonic())
+        if result is not None:
+            print("Repeated request, returning the earlier result")
+            return result
+        flight = _in_flight.get(key)
+        leader = flight is None
+        if leader:
+            flight = _in_flight[key] = _Flight()
+
+    if not leader:
+        print("Identical request in flight, waiting for it")
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    try:
+        flight.result = _stored(key) or compute()
+        with _lock:
+            _results[key] = (time.monotonic(), flight.result)
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _lock:
+            del _in_flight[key]
+        flight.done.set()
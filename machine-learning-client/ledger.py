@@ -0,0 +1,117 @@
+"""
+This module keeps a running balance per person for groups that split many
+receipts, and works out a short list of payments that settles everyone up
+"""
+
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import PyMongoError
+from db import apply_ledger_entries, get_group_balances
+
+# one worker keeps receipts of a group applied in order, off the request path
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ledger")
+
+
+def to_cents(amount):
+    """Convert a dollar amount to integer cents"""
+    return int(round(amount * 100))
+
+
+def receipt_entries(group_id, receipt_id, payer, charge_per_person):
+    """
+    Work out what a receipt changes in the ledger: everyone except the payer
+    owes the payer their share. Returns (balance changes in cents,
+    transaction documents)
+    """
+    balance_changes = {}
+    transactions = []
+    for name, amount in charge_per_person.items():
+        cents = to_cents(amount)
+        if name == payer or cents == 0:
+            continue
+        balance_changes[name] = balance_changes.get(name, 0) - cents
+        balance_changes[payer] = balance_changes.get(payer, 0) + cents
+        transactions.append(
+            {
+                "_id": f"{receipt_id}:{name}",
+                "receipt_id": str(receipt_id),
+                "group_id": group_id,
+                "debtor": name,
+                "creditor": payer,
+                "amount_cents": cents,
+            }
+        )
+    return balance_changes, transactions
+
+
+def record_receipt(group_id, receipt_id, payer, charge_per_person):
+    """Apply a receipt to the group's ledger"""
+    balance_changes, transactions = receipt_entries(
+        group_id, receipt_id, payer, charge_per_person
+    )
+    if not balance_changes:
+        return
+    try:
+        apply_ledger_entries(group_id, receipt_id, balance_changes, transactions)
+    except PyMongoError as e:
+        print("Could not record receipt in the ledger:", e)
+
+
+def record_receipt_async(group_id, receipt_id, payer, charge_per_person):
+    """Queue a receipt to be applied to the group's ledger in the background"""
+    return _executor.submit(
+        record_receipt, group_id, receipt_id, payer, charge_per_person
+    )
+
+
+def record_user_receipt(user_input, receipt_id, charge_per_person):
+    """
+    Queue a processed receipt for the ledger of its group: the group named
+    in the form, else the web-app session. The payer defaults to the first
+    person listed
+    """
+    group_id = user_input.get("group") or user_input.get("owner")
+    payer = user_input.get("payer") or next(iter(charge_per_person), None)
+    if not group_id or not payer:
+        return None
+    return record_receipt_async(group_id, receipt_id, payer, charge_per_person)
+
+
+def settle_up(balances):
+    """
+    Turn balances (cents, positive means owed money) into payments that
+    settle every debt. The largest debtor always pays the largest creditor,
+    which needs at most one payment fewer than the number of people
+    """
+    creditors = [(-cents, name) for name, cents in balances.items() if cents > 0]
+    debtors = [(cents, name) for name, cents in balances.items() if cents < 0]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    payments = []
+    while creditors and debtors:
+        credit, creditor = heapq.heappop(creditors)
+        debt, debtor = heapq.heappop(debtors)
+        amount = min(-credit, -debt)
+        payments.append({"from": debtor, "to": creditor, "amount_cents": amount})
+        if -credit > amount:
+            heapq.heappush(creditors, (credit + amount, creditor))
+        if -debt > amount:
+            heapq.heappush(debtors, (debt + amount, debtor))
+    return payments
+
+
+def group_summary(group_id):
+    """Balances (in dollars) of a group and the payments that settle them"""
+    balances = get_group_balances(group_id)
+    return {
+        "balances": {name: cents / 100 for name, cents in balances.items()},
+        "settle_up": [
+            {
+                "from": payment["from"],
+                "to": payment["to"],
+                "amount": payment["amount_cents"] / 100,
+            }
+            for payment in settle_up(balances)
+        ],
+    }
@@ -0,0 +1,190 @@
+"""
+This module remembers the layout of receipts from merchants we have already
+seen, so repeat receipts can be OCR'd from the item region only and their
+dishes matched against canonical spellings
+"""
+
+import re
+import difflib
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import PyMongoError
+from db import get_merchant_template, store_merchant_template
+
+HEADER_FRACTION = 0.2  # top part of the receipt searched for the merchant name
+HEADER_LINES = 3  # number of header lines considered as the merchant name
+REGION_MARGIN = 0.03  # extra room (fraction of height) kept around the items
+MAX_KNOWN_DISHES = 200
+DISH_CUTOFF = 0.8  # similarity needed to snap an OCR'd dish to a known one
+CACHE_SIZE = 128
+
+_cache = OrderedDict()
+# guards _cache and the templates in it, which concurrent receipts share
+_lock = threading.Lock()
+# templates can be switched off, or kept to this process (see local_templates)
+_settings = {"enabled": True, "persist": True}
+# templates are written behind the request, one at a time so the last
+# change of a merchant is the one stored
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="merchants")
+
+
+def merchant_key(text):
+    """Normalize a header line into a merchant key"""
+    text = re.sub(r"[^a-z0-9 ]", "", text.lower())
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def detect_merchant(header_lines):
+    """Pick the merchant name from the first lines of the receipt"""
+    candidates = [line for line in header_lines if line.strip()][:HEADER_LINES]
+    for line in candidates:
+        letters = sum(ch.isalpha() for ch in line)
+        digits = sum(ch.isdigit() for ch in line)
+        key = merchant_key(line)
+        if letters >= 3 and letters > digits and key:
+            return key
+    return None
+
+
+def _remember(merchant, template):
+    """
+    Put a template in the in-process cache, evicting the oldest one; the
+    caller holds _lock
+    """
+    _cache[merchant] = template
+    _cache.move_to_end(merchant)
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def get_template(merchant):
+    """Return the cached template of a merchant, or None if it is unknown"""
+    if merchant is None or not _settings["enabled"]:
+        return None
+    with _lock:
+        if merchant in _cache:
+            _cache.move_to_end(merchant)
+            return _cache[merchant]
+
+        # fuzzy lookup so small OCR misreads of the name still hit the cache
+        close = difflib.get_close_matches(merchant, list(_cache), n=1, cutoff=0.85)
+        if close:
+            return _cache[close[0]]
+    if not _settings["persist"]:
+        return None
+
+    try:
+        template = get_merchant_template(merchant)
+    except PyMongoError as e:
+        print("Could not load merchant template:", e)
+        return None
+    if template is not None:
+        with _lock:
+            _remember(merchant, template)
+    return template
+
+
+@contextmanager
+def local_templates(enabled=True):
+    """
+    Start the enclosed block with an empty template cache that is neither
+    loaded from nor written to the DB, e.g. to benchmark repeat receipts;
+    with enabled False no template is used. The cache is restored after
+    """
+    with _lock:
+        saved = OrderedDict(_cache), dict(_settings)
+        _cache.clear()
+        _settings.update(enabled=enabled, persist=False)
+    try:
+        yield
+    finally:
+        with _lock:
+            _cache.clear()
+            _cache.update(saved[0])
+            _settings.update(saved[1])
+
+
+def region_rows(template, height):
+    """Convert the template's item region into pixel rows of an image"""
+    top, bottom = template["region"]
+    return int(top * height), int(bottom * height)
+
+
+def store_template(template):
+    """Write a template to the DB"""
+    try:
+        store_merchant_template(template)
+    except PyMongoError as e:
+        print("Could not store merchant template:", e)
+
+
+def flush_templates():
+    """Wait for queued template writes to reach the DB"""
+    _executor.submit(lambda: None).result()
+
+
+def learn_template(merchant, item_lines, dishes, height):
+    """
+    Update the merchant's template with the rows holding priced lines and
+    the dish names found on this receipt. The template is written in the
+    background, and only when its region or dishes changed
+    """
+    if merchant is None or not item_lines or height <= 0:
+        return None
+    if not _settings["enabled"]:
+        return None
+
+    top = max(0.0, min(line["top"] for line in item_lines) / height - REGION_MARGIN)
+    bottom = min(
+        1.0, max(line["bottom"] for line in item_lines) / height + REGION_MARGIN
+    )
+
+    template = get_template(merchant)
+    with _lock:
+        # another receipt of the merchant may have cached it in the meantime
+        template = _cache.get(merchant) or template
+        changed = template is None
+        if template is None:
+            template = {
+                "_id": merchant,
+                "region": [top, bottom],
+                "dishes": [],
+                "seen": 0,
+            }
+        # only ever grow the region so a short receipt cannot hide items;
+        # new lists are swapped in so readers never see a half-made change
+        region = [min(template["region"][0], top), max(template["region"][1], bottom)]
+        known = list(template["dishes"])
+        for dish in dishes:
+            if dish["dish"] not in known:
+                known.append(dish["dish"])
+        known = known[-MAX_KNOWN_DISHES:]
+        changed = changed or region != template["region"] or known != template["dishes"]
+        template["region"] = region
+        template["dishes"] = known
+        template["seen"] += 1  # stored with the next change
+        _remember(template["_id"], template)
+        stored = dict(template)  # the cached template keeps changing
+
+    if changed and _settings["persist"]:
+        _executor.submit(store_template, stored)
+    return template
+
+
+def canonicalize_dishes(entries, template):
+    """Replace OCR'd dish names with the merchant's known spelling"""
+    if not template:
+        return entries
+
+    known = template["dishes"]
+    canonical = []
+    for entry in entries:
+        matches = difflib.get_close_matches(
+            entry["dish"], known, n=1, cutoff=DISH_CUTOFF
+        )
+        if matches:
+            entry = {**entry, "dish": matches[0]}
+        canonical.append(entry)
+    return canonical
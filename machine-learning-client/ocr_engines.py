@@ -0,0 +1,183 @@
+"""
+This module holds the OCR engines the analyzer can read receipts with.
+Every engine returns word boxes in the layout of pytesseract's
+image_to_data dictionaries, so the rest of the pipeline does not care which
+engine produced them. The engine is chosen per deployment with OCR_ENGINE
+and can be overridden per request
+"""
+
+# pylint: disable=no-member
+
+import os
+import contextvars
+from contextlib import contextmanager
+import cv2
+import pytesseract
+
+try:
+    from rapidocr_onnxruntime import RapidOCR
+except ImportError:  # the ONNX engine is optional
+    RapidOCR = None
+
+DEFAULT_ENGINE = os.getenv("OCR_ENGINE", "tesseract")
+TESSERACT_PATH = os.getenv("TESSERACT_PATH")
+# Threads OpenCV, Tesseract (through OpenMP) and ONNX Runtime may each use
+# for one receipt. Left at their defaults every library starts a thread per
+# core, and concurrent receipts oversubscribe the CPU; the scheduler
+# provides the parallelism instead
+OCR_THREADS = int(os.getenv("OCR_THREADS", "1"))
+ROW_OVERLAP = 0.5  # share of a box's height that must overlap its row
+DATA_KEYS = [
+    "text",
+    "conf",
+    "left",
+    "top",
+    "width",
+    "height",
+    "block_num",
+    "par_num",
+    "line_num",
+]
+
+
+def limit_threads(threads):
+    """Cap the threads each OCR library starts per receipt"""
+    cv2.setNumThreads(threads)
+    # read by every tesseract process pytesseract starts from now on
+    os.environ["OMP_THREAD_LIMIT"] = str(threads)
+
+
+limit_threads(OCR_THREADS)
+
+
+class TesseractEngine:  # pylint: disable=too-few-public-methods
+    """Tesseract through pytesseract"""
+
+    name = "tesseract"
+
+    def __init__(self):
+        if TESSERACT_PATH:
+            pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
+        # raises TesseractNotFoundError (an OSError) if it is not installed
+        self.version = pytesseract.get_tesseract_version()
+
+    def image_to_data(self, img, config=""):
+        """Word boxes of the image"""
+        return pytesseract.image_to_data(
+            img, config=config, output_type=pytesseract.Output.DICT
+        )
+
+
+def same_row(row, box):
+    """Whether a box overlaps a row vertically by half the lower of the two"""
+    overlap = min(row["bottom"], box["bottom"]) - max(row["top"], box["top"])
+    lower = min(row["bottom"] - row["top"], box["bottom"] - box["top"])
+    return overlap >= ROW_OVERLAP * max(lower, 1)
+
+
+def group_rows(boxes):
+    """
+    Group text boxes into rows of boxes that overlap vertically, top to
+    bottom, each row ordered left to right
+    """
+    rows = []
+    for box in sorted(boxes, key=lambda box: (box["top"] + box["bottom"]) / 2):
+        if rows and same_row(rows[-1], box):
+            row = rows[-1]
+            row["boxes"].append(box)
+            row["top"] = min(row["top"], box["top"])
+            row["bottom"] = max(row["bottom"], box["bottom"])
+        else:
+            rows.append({"top": box["top"], "bottom": box["bottom"], "boxes": [box]})
+    return [sorted(row["boxes"], key=lambda box: box["left"]) for row in rows]
+
+
+class OnnxEngine:  # pylint: disable=too-few-public-methods
+    """
+    PaddleOCR detection and recognition models run locally on ONNX Runtime
+    (through rapidocr_onnxruntime). It detects runs of text, so a dish and
+    its right-aligned price come as separate boxes; boxes on the same row
+    are reported as the words of one line
+    """
+
+    name = "onnx"
+
+    def __init__(self):
+        if RapidOCR is None:
+            raise RuntimeError("The onnx OCR engine needs rapidocr_onnxruntime")
+        self.reader = RapidOCR(intra_op_num_threads=OCR_THREADS, inter_op_num_threads=1)
+
+    def image_to_data(self, img, config=""):  # pylint: disable=unused-argument
+        """Word boxes of the image; Tesseract options in config are ignored"""
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        results, _ = self.reader(img)
+
+        boxes = []
+        for box, text, score in results or []:
+            xs = [point[0] for point in box]
+            ys = [point[1] for point in box]
+            boxes.append(
+                {
+                    "text": text,
+                    "conf": float(score) * 100,
+                    "left": int(min(xs)),
+                    "top": int(min(ys)),
+                    "bottom": int(max(ys)),
+                    "width": int(max(xs) - min(xs)),
+                }
+            )
+
+        data = {key: [] for key in DATA_KEYS}
+        for number, row in enumerate(group_rows(boxes), start=1):
+            for box in row:
+                for key in ("text", "conf", "left", "top", "width"):
+                    data[key].append(box[key])
+                data["height"].append(box["bottom"] - box["top"])
+                data["block_num"].append(number)
+                data["par_num"].append(1)
+                data["line_num"].append(1)
+        return data
+
+
+ENGINES = {engine.name: engine for engine in (TesseractEngine, OnnxEngine)}
+
+_instances = {}
+_selected = contextvars.ContextVar("ocr_engine", default=None)
+
+
+def get_engine(name=None):
+    """Return the engine with the given name (the default one if None)"""
+    name = name or DEFAULT_ENGINE
+    if name not in ENGINES:
+        raise ValueError(f"Unknown OCR engine: {name}")
+    if name not in _instances:
+        _instances[name] = ENGINES[name]()
+    return _instances[name]
+
+
+def available_engines():
+    """Names of the engines that can run here"""
+    names = []
+    for name in ENGINES:
+        try:
+            get_engine(name)
+        except (RuntimeError, OSError):
+            continue
+        names.append(name)
+    return names
+
+
+@contextmanager
+def selected(name):
+    """Use the named engine for OCR in the enclosed block"""
+    token = _selected.set(get_engine(name))
+    try:
+        yield _selected.get()
+    finally:
+        _selected.reset(token)
+
+
+def current():
+    """The engine OCR should use right now"""
+    return _selected.get() or get_engine()
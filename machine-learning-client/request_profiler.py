@@ -0,0 +1,186 @@
+"""
+This module captures opt-in CPU and memory profiles of /submit requests so a
+slow receipt can be traced to decoding, image processing, Tesseract or dish
+matching. Nothing runs unless profiling was armed through the admin endpoint
+or the request carries the profiling token, so it stays compiled in
+"""
+
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+
+PROFILE_DIR = os.getenv(
+    "PROFILE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "profiles"),
+)
+# Admin endpoints and the X-Profile header are disabled unless this is set
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_MS", "5")) / 1000
+MAX_PROFILES = int(os.getenv("PROFILE_KEEP", "50"))
+TRACEMALLOC_FRAMES = 10
+TOP_ENTRIES = 25
+
+_lock = threading.Lock()
+_busy = threading.Lock()  # tracemalloc is process wide: one profile at a time
+_state = {"armed": 0}  # number of upcoming requests to profile
+
+
+def token_valid(token):
+    """Check a token against PROFILE_TOKEN (always False when unset)"""
+    return bool(PROFILE_TOKEN) and token == PROFILE_TOKEN
+
+
+def arm(count):
+    """Profile the next count requests; returns how many are armed"""
+    with _lock:
+        _state["armed"] = max(0, count)
+        return _state["armed"]
+
+
+def armed_count():
+    """Number of upcoming requests that will be profiled"""
+    return _state["armed"]
+
+
+def _claim(request_token):
+    """Decide whether this request is profiled, consuming an armed slot"""
+    if token_valid(request_token):
+        return True
+    with _lock:
+        if _state["armed"] > 0:
+            _state["armed"] -= 1
+            return True
+    return False
+
+
+class StackSampler(threading.Thread):
+    """
+    Samples the stack of one thread at a fixed interval and counts the
+    collapsed stacks (the format flame graph tools read)
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(  # pylint: disable=protected-access
+                self.thread_id
+            )
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                    f":{frame.f_lineno})"
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        """Stop sampling and wait for the sampler to exit"""
+        self._stop_event.set()
+        self.join()
+
+
+def _prune(directory):
+    """Keep only the MAX_PROFILES most recent profiles"""
+    names = sorted({name.split(".")[0] for name in os.listdir(directory)})
+    for stale in names[:-MAX_PROFILES] if MAX_PROFILES > 0 else names:
+        for name in os.listdir(directory):
+            if name.split(".")[0] == stale:
+                os.remove(os.path.join(directory, name))
+
+
+def _write_profile(name, elapsed, sampler, snapshot, peak):
+    """Write the collapsed stacks, the tracemalloc snapshot and a summary"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, name)
+
+    with open(base + ".folded", "w", encoding="utf-8") as fp:
+        for stack, count in sampler.stacks.most_common():
+            fp.write(f"{stack} {count}\n")
+    snapshot.dump(base + ".tracemalloc")
+
+    total_samples = sum(sampler.stacks.values()) or 1
+    leaf_counts = Counter()
+    for stack, count in sampler.stacks.items():
+        leaf_counts[stack.rsplit(";", 1)[-1]] += count
+
+    with open(base + ".txt", "w", encoding="utf-8") as fp:
+        fp.write(f"wall time: {elapsed * 1000:.1f} ms\n")
+        fp.write(f"cpu samples: {sum(sampler.stacks.values())}\n")
+        fp.write(f"peak traced memory: {peak / 1024 / 1024:.1f} MB\n\n")
+        fp.write("top frames (self time):\n")
+        for frame, count in leaf_counts.most_common(TOP_ENTRIES):
+            fp.write(f"  {100 * count / total_samples:5.1f}%  {frame}\n")
+        fp.write("\ntop allocations:\n")
+        for stat in snapshot.statistics("lineno")[:TOP_ENTRIES]:
+            fp.write(f"  {stat}\n")
+
+    _prune(PROFILE_DIR)
+
+
+@contextmanager
+def maybe_profile(request_token=None):
+    """
+    Profile the enclosed block if this request is due for profiling; yields
+    the profile name, or None when the block runs unprofiled
+    """
+    if not _state["armed"] and request_token is None:
+        yield None
+        return
+    if not _busy.acquire(blocking=False):  # pylint: disable=consider-using-with
+        yield None
+        return
+    if not _claim(request_token):
+        _busy.release()
+        yield None
+        return
+
+    name = time.strftime("%Y%m%d-%H%M%S") + f"-{time.time_ns() % 10**9:09d}"
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    tracemalloc.reset_peak()
+    sampler = StackSampler(threading.get_ident(), SAMPLE_INTERVAL)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        yield name
+    finally:
+        elapsed = time.perf_counter() - start
+        sampler.stop()
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+        try:
+            _write_profile(name, elapsed, sampler, snapshot, peak)
+            print("Stored profile", name)
+        except OSError as e:
+            print("Could not store profile:", e)
+        finally:
+            _busy.release()
+
+
+def list_profiles():
+    """Stored profiles, newest first, with the files belonging to each"""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = {}
+    for name in os.listdir(PROFILE_DIR):
+        profiles.setdefault(name.split(".")[0], []).append(name)
+    return [
+        {"name": name, "files": sorted(profiles[name])}
+        for name in sorted(profiles, reverse=True)
+    ]
@@ -0,0 +1,234 @@
+"""
+This module decides which receipts get OCR'd when the ML client is busy.
+Only a limited number of receipts are read at once and the rest wait their
+turn: interactive uploads go before bulk work, then the tenant that has
+used the least OCR time lately, then the earliest deadline. Some slots are
+kept for interactive receipts only, so a large batch never fills the
+machine and someone waiting at the table is served as fast as on an idle
+client. The number of slots starts at OCR_SLOTS and is tuned from the
+measured latency and throughput while the client is busy
+"""
+
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+OCR_SLOTS = int(os.getenv("OCR_SLOTS", str(os.cpu_count() or 2)))
+OCR_MAX_SLOTS = int(os.getenv("OCR_MAX_SLOTS", str(2 * (os.cpu_count() or 2))))
+ADAPTIVE_SLOTS = os.getenv("OCR_ADAPTIVE_SLOTS", "1") == "1"
+INTERACTIVE_SLOTS = int(os.getenv("OCR_INTERACTIVE_SLOTS", "1"))
+PRIORITIES = {"interactive": 0, "bulk": 1}
+DEADLINES = {"interactive": 30, "bulk": 600}  # default seconds to finish in
+USAGE_HALF_LIFE = 60  # seconds after which half of a tenant's usage is forgotten
+
+# Slot tuning: after every TUNE_WINDOW receipts, one slot is added if some
+# receipts had to wait, and a quarter of them are taken away when the mean
+# latency exceeds LATENCY_TOLERANCE times the lowest seen or the last added
+# slot lowered throughput
+TUNE_WINDOW = 8
+LATENCY_TOLERANCE = float(os.getenv("OCR_LATENCY_TOLERANCE", "1.5"))
+THROUGHPUT_TOLERANCE = 0.95
+DECREASE_FACTOR = 0.75
+BASELINE_DRIFT = 1.05  # the lowest latency creeps up to follow larger images
+
+
+class _Ticket:  # pylint: disable=too-few-public-methods
+    """A receipt waiting for a slot"""
+
+    def __init__(self, priority, tenant, deadline, number):
+        self.priority = priority
+        self.tenant = tenant
+        self.deadline = deadline
+        self.number = number
+        self.granted = False
+
+
+class ConcurrencyTuner:  # pylint: disable=too-many-instance-attributes
+    """
+    Additive-increase, multiplicative-decrease control of the number of
+    receipts read at once, from the latency and throughput of windows of
+    finished receipts
+    """
+
+    def __init__(self, limit, max_limit, window=TUNE_WINDOW, now=None):
+        self.limit = max(limit, 1)
+        self.max_limit = max(max_limit, self.limit)
+        self.window = window
+        self.baseline = None  # lowest mean latency seen, in seconds
+        self.throughput = None  # receipts per second of the last busy window
+        self._latencies = []
+        self._busy = False
+        self._grew = False
+        self._started = time.monotonic() if now is None else now
+
+    def waited(self):
+        """Note that a receipt had to wait for a slot in this window"""
+        self._busy = True
+
+    def record(self, seconds, now=None):
+        """Account for one finished receipt; returns the limit to use"""
+        now = time.monotonic() if now is None else now
+        self._latencies.append(seconds)
+        if len(self._latencies) < self.window:
+            return self.limit
+
+        latency = sum(self._latencies) / len(self._latencies)
+        throughput = len(self._latencies) / max(now - self._started, 1e-6)
+        if self.baseline is None:
+            self.baseline = latency
+        else:
+            self.baseline = min(latency, self.baseline * BASELINE_DRIFT)
+
+        slower = latency > self.baseline * LATENCY_TOLERANCE
+        # idle windows say nothing about throughput
+        dropped = (
+            self._busy
+            and self._grew
+            and self.throughput is not None
+            and throughput < self.throughput * THROUGHPUT_TOLERANCE
+        )
+        self._grew = False
+        if slower or dropped:
+            self.limit = max(1, int(self.limit * DECREASE_FACTOR))
+        elif self._busy and self.limit < self.max_limit:
+            self.limit += 1
+            self._grew = True
+        if self._busy:
+            self.throughput = throughput
+
+        self._latencies = []
+        self._busy = False
+        self._started = now
+        return self.limit
+
+
+class Scheduler:  # pylint: disable=too-many-instance-attributes
+    """Hands out OCR slots by priority class, tenant usage and deadline"""
+
+    def __init__(
+        self,
+        slots=OCR_SLOTS,
+        interactive_slots=INTERACTIVE_SLOTS,
+        max_slots=None,
+        adaptive=False,
+    ):
+        self.slots = max(slots, 1)
+        self.interactive_slots = interactive_slots
+        self.tuner = None
+        if adaptive:
+            self.tuner = ConcurrencyTuner(self.slots, max_slots or self.slots)
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._running = {priority: 0 for priority in PRIORITIES}
+        self._tenant_running = {}
+        self._usage = {}
+        self._numbers = itertools.count()
+
+    def usage(self, tenant, now=None):
+        """OCR seconds the tenant used lately, decayed by USAGE_HALF_LIFE"""
+        seconds, since = self._usage.get(tenant, (0.0, 0.0))
+        now = time.monotonic() if now is None else now
+        return seconds * 0.5 ** ((now - since) / USAGE_HALF_LIFE)
+
+    def _order(self, ticket, now):
+        return (
+            PRIORITIES[ticket.priority],
+            self._tenant_running.get(ticket.tenant, 0),
+            self.usage(ticket.tenant, now),
+            ticket.deadline,
+            ticket.number,
+        )
+
+    def _can_start(self, ticket):
+        running = sum(self._running.values())
+        if ticket.priority == "bulk":
+            # with a single slot nothing can be held back for interactive work
+            reserved = min(self.interactive_slots, self.slots - 1)
+            return running < self.slots - reserved
+        return running < self.slots
+
+    def _dispatch(self):
+        """Grant free slots to the waiting tickets that go first"""
+        now = time.monotonic()
+        while self._waiting:
+            ticket = min(self._waiting, key=lambda waiting: self._order(waiting, now))
+            if not self._can_start(ticket):
+                if self.tuner is not None:
+                    self.tuner.waited()
+                break
+            self._waiting.remove(ticket)
+            ticket.granted = True
+            self._running[ticket.priority] += 1
+            self._tenant_running[ticket.tenant] = (
+                self._tenant_running.get(ticket.tenant, 0) + 1
+            )
+        self._condition.notify_all()
+
+    def _release(self, ticket, seconds):
+        now = time.monotonic()
+        self._running[ticket.priority] -= 1
+        self._tenant_running[ticket.tenant] -= 1
+        if not self._tenant_running[ticket.tenant]:
+            del self._tenant_running[ticket.tenant]
+        self._usage[ticket.tenant] = (self.usage(ticket.tenant, now) + seconds, now)
+        if self.tuner is not None:
+            self.slots = self.tuner.record(seconds, now)
+        self._dispatch()
+
+    @contextmanager
+    def slot(self, priority="interactive", tenant=None, deadline=None):
+        """
+        Wait for a slot and hold it in the enclosed block. deadline is how
+        many seconds from now the receipt should be done in; it defaults by
+        priority class
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}")
+        if deadline is None:
+            deadline = DEADLINES[priority]
+
+        with self._condition:
+            ticket = _Ticket(
+                priority, tenant, time.monotonic() + deadline, next(self._numbers)
+            )
+            self._waiting.append(ticket)
+            self._dispatch()
+            while not ticket.granted:
+                self._condition.wait()
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._release(ticket, time.monotonic() - start)
+
+    def stats(self):
+        """Current number of slots and the receipts running and waiting"""
+        with self._condition:
+            stats = {
+                priority: {
+                    "running": self._running[priority],
+                    "waiting": sum(
+                        ticket.priority == priority for ticket in self._waiting
+                    ),
+                }
+                for priority in PRIORITIES
+            }
+            stats["slots"] = self.slots
+            if self.tuner is not None:
+                stats["tuning"] = {
+                    "max_slots": self.tuner.max_limit,
+                    "baseline_ms": (
+                        None
+                        if self.tuner.baseline is None
+                        else round(1000 * self.tuner.baseline, 1)
+                    ),
+                    "throughput": self.tuner.throughput,
+                }
+            return stats
+
+
+scheduler = Scheduler(OCR_SLOTS, INTERACTIVE_SLOTS, OCR_MAX_SLOTS, ADAPTIVE_SLOTS)
@@ -0,0 +1,8 @@
+"""Settings shared by the ML client tests"""
+
+import os
+
+# set before app is imported: its warm-up thread would run real OCR next to
+# tests that patch the OCR functions, and its socket server is not needed
+os.environ["OCR_WARM_UP"] = "0"
+os.environ.pop("ML_SOCKET", None)
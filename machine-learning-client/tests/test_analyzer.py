@@ -1,5 +1,7 @@
 """ "This module tests the ML client analyzer algorithm"""
 
+import cv2
+import numpy
 import pytest
 from analyzer import sanitize_string
 from analyzer import parse_processed_lines
@@ -7,6 +9,15 @@ from analyzer import filter_dishes
 from analyzer import normalize_dictionary_list
 from analyzer import calculate_charge_per_person
 from analyzer import normalize_text
+from analyzer import read_receipt_lines
+from analyzer import ocr_lines
+from analyzer import decode_image
+from analyzer import image_dimensions
+from analyzer import band_bounds
+from analyzer import report_dishes
+from analyzer import refine_lines, retry_budget
+from analyzer import user_input_from_form
+import ocr_engines
 
 
 def test_sanitize_string_normal():
@@ -338,3 +349,360 @@ def test_normalize_extra_spaces():
 def test_normalize_empty_string():
     """Test that an empty string remains empty"""
     assert normalize_text("") == ""
+
+
+def test_calculate_charge_known_dishes():
+    """Test that the merchant's known dishes are tried before fuzzy matching"""
+    user_input = {
+        "tip": 0.0,
+        "people": [
+            {"name": "Alice", "items": "spicy tuna"},
+            {"name": "Bob", "items": "tuna"},
+        ],
+    }
+    dish_entries = [
+        {"dish": "Tuna Roll", "price": 8.0},
+        {"dish": "Spicy Tuna Roll", "price": 10.0},
+    ]
+    charge_entries = [{"dish": "Subtotal", "price": 18.0}, {"dish": "Tax", "price": 0}]
+
+    result = calculate_charge_per_person(
+        user_input, dish_entries, charge_entries, ["Spicy Tuna Roll", "Tuna Roll"]
+    )
+    assert result == {"Alice": 10.0, "Bob": 8.0}
+
+
+def fake_page(rows):
+    """OCR stub reading the lines of a page given as {top row: text}"""
+    calls = []
+
+    def fake_ocr_lines(img, offset=0):
+        calls.append((offset, offset + img.shape[0]))
+        return [
+            {"text": text, "top": top, "bottom": top + 20}
+            for top, text in sorted(rows.items())
+            if offset <= top < offset + img.shape[0]
+        ]
+
+    return fake_ocr_lines, calls
+
+
+def test_read_receipt_lines_uses_template(monkeypatch):
+    """Repeat merchants skip the rows between the header and the items"""
+    fake_ocr_lines, calls = fake_page(
+        {5: "Joe's Pizza", 300: "Table 4", 450: "Pizza 10.00", 550: "Total 10.00"}
+    )
+    monkeypatch.setattr("analyzer.ocr_lines", fake_ocr_lines)
+    monkeypatch.setattr(
+        "merchants.get_template",
+        lambda merchant: {"_id": merchant, "region": [0.4, 0.6], "dishes": []},
+    )
+
+    lines, merchant, template = read_receipt_lines(numpy.zeros((1000, 200)))
+    assert merchant == "joes pizza"
+    assert template is not None
+    assert calls == [(0, 200), (400, 600)]
+    assert [line["text"] for line in lines] == [
+        "Joe's Pizza",
+        "Pizza 10.00",
+        "Total 10.00",
+    ]
+
+
+def test_read_receipt_lines_longer_repeat_receipt(monkeypatch):
+    """Items and totals below the learned region are still read"""
+    rows = {5: "Joe's Pizza"}
+    rows.update({400 + 40 * n: f"Dish {n} {n}.00" for n in range(1, 10)})
+    rows.update({800: "Subtotal 45.00", 840: "Tax 4.00"})
+    fake_ocr_lines, calls = fake_page(rows)
+    monkeypatch.setattr("analyzer.ocr_lines", fake_ocr_lines)
+    monkeypatch.setattr(
+        "merchants.get_template",
+        lambda merchant: {"_id": merchant, "region": [0.4, 0.55], "dishes": []},
+    )
+
+    lines, _, _ = read_receipt_lines(numpy.zeros((1000, 200)))
+    dishes, charges = filter_dishes(parse_processed_lines([l["text"] for l in lines]))
+    assert len(dishes) == 9
+    assert [charge["dish"] for charge in charges] == ["Subtotal", "Tax"]
+    assert calls == [(0, 200), (400, 550), (550, 1000)]
+
+
+def test_read_receipt_lines_template_without_total(monkeypatch):
+    """Without a total the rows skipped above the region are read too"""
+    fake_ocr_lines, calls = fake_page(
+        {5: "Joe's Pizza", 300: "Pasta 9.00", 450: "Pizza 10.00"}
+    )
+    monkeypatch.setattr("analyzer.ocr_lines", fake_ocr_lines)
+    monkeypatch.setattr(
+        "merchants.get_template",
+        lambda merchant: {"_id": merchant, "region": [0.4, 0.6], "dishes": []},
+    )
+
+    lines, _, _ = read_receipt_lines(numpy.zeros((1000, 200)))
+    assert [line["text"] for line in lines] == [
+        "Joe's Pizza",
+        "Pasta 9.00",
+        "Pizza 10.00",
+    ]
+    assert calls[-1] == (200, 400)
+
+
+def test_band_bounds_cut_between_lines():
+    """Test that bands are cut on blank rows instead of through text"""
+    img = numpy.full((1000, 200), 255, dtype=numpy.uint8)
+    for top in range(0, 1000, 50):
+        img[top + 10 : top + 40] = 0  # a text line every 50 rows
+
+    bounds = band_bounds(img, 0, 1000, 300)
+    assert bounds[0][0] == 0 and bounds[-1][1] == 1000
+    for (_, bottom), (top, _) in zip(bounds, bounds[1:]):
+        assert bottom == top
+        assert img[bottom].min() == 255
+    assert all(bottom - top <= 375 for top, bottom in bounds)
+
+
+def test_read_receipt_lines_streams_bands(monkeypatch):
+    """Test that streaming reads the page band by band and reports every band"""
+    calls = []
+
+    def fake_ocr_lines(img, offset=0):
+        calls.append((img.shape[0], offset))
+        return [{"text": f"Dish {offset} 1.00", "top": offset, "bottom": offset + 9}]
+
+    monkeypatch.setattr("analyzer.ocr_lines", fake_ocr_lines)
+    monkeypatch.setattr("merchants.get_template", lambda merchant: None)
+    monkeypatch.setattr("analyzer.OCR_BAND_ROWS", 300)
+
+    bands = []
+    lines, _, _ = read_receipt_lines(numpy.full((900, 200), 255), bands.append)
+    # the header, then the rest of the page in bands, without the header again
+    assert calls[0] == (180, 0)
+    assert [offset for _, offset in calls[1:]] == [180, 480, 780]
+    assert len(bands) == 4
+    assert len(lines) == 4
+
+
+def test_report_dishes():
+    """Test that partial results accumulate dishes and skip charges"""
+    partials = []
+    on_band = report_dishes(partials.append)
+
+    on_band([{"text": "Pizza 10.00"}, {"text": "Tax 1.00"}])
+    on_band([{"text": "Thank you"}])
+    on_band([{"text": "Soda 2.50"}])
+    assert partials == [
+        [{"dish": "Pizza", "price": 10.0}],
+        [{"dish": "Pizza", "price": 10.0}, {"dish": "Soda", "price": 2.5}],
+    ]
+
+
+class FakeEngine:  # pylint: disable=too-few-public-methods
+    """OCR engine answering every image with the same words"""
+
+    def __init__(self, data, calls=None):
+        self.data = data
+        self.calls = calls if calls is not None else []
+
+    def image_to_data(self, img, config=""):
+        """Canned word boxes"""
+        self.calls.append((img.shape, config))
+        return self.data
+
+
+def make_line(text, conf, left=10, top=100):
+    """OCR line with a single word"""
+    word = {
+        "text": text,
+        "conf": conf,
+        "left": left,
+        "top": top,
+        "width": 80,
+        "height": 20,
+    }
+    return {"text": text, "top": top, "bottom": top + 20, "words": [word]}
+
+
+def test_refine_lines_rereads_low_confidence_prices(monkeypatch):
+    """Test that only doubtful lines with digits are read again"""
+    crops = []
+    engine = FakeEngine(
+        {
+            "text": ["12.50"],
+            "conf": [91.0],
+            "left": [8],
+            "top": [8],
+            "width": [160],
+            "height": [40],
+            "block_num": [1],
+            "par_num": [1],
+            "line_num": [1],
+        },
+        crops,
+    )
+    monkeypatch.setattr("ocr_engines.current", lambda: engine)
+    lines = [
+        make_line("Thank you", 20.0),
+        make_line("Pasta 12.5O", 40.0),
+        make_line("Soda 2.00", 95.0),
+    ]
+
+    refined = refine_lines(numpy.full((300, 200), 255, dtype=numpy.uint8), lines)
+    assert crops == [((56, 176), "--psm 6")]
+    assert refined[0] is lines[0]
+    assert refined[1]["text"] == "12.50"
+    assert refined[1]["words"][0]["left"] == 10
+    assert refined[1]["words"][0]["top"] == 100
+    assert refined[2] is lines[2]
+
+
+def test_refine_lines_keeps_more_confident_reading(monkeypatch):
+    """Test that a worse second reading is thrown away"""
+    engine = FakeEngine(
+        {
+            "text": ["1Z.5O"],
+            "conf": [10.0],
+            "left": [0],
+            "top": [0],
+            "width": [10],
+            "height": [10],
+            "block_num": [1],
+            "par_num": [1],
+            "line_num": [1],
+        }
+    )
+    monkeypatch.setattr("ocr_engines.current", lambda: engine)
+    lines = [make_line("Pasta 12.50", 40.0)]
+    assert refine_lines(numpy.full((300, 200), 255, dtype=numpy.uint8), lines) == lines
+
+
+def test_refine_lines_rereads_in_one_call(monkeypatch):
+    """Doubtful lines are stacked and read together, then mapped back"""
+    crops = []
+    # the second crop starts below the first (56 rows) and the gap (16)
+    engine = FakeEngine(
+        {
+            "text": ["12.50", "3.00"],
+            "conf": [91.0, 92.0],
+            "left": [8, 8],
+            "top": [8, 80],
+            "width": [160, 100],
+            "height": [40, 40],
+            "block_num": [1, 1],
+            "par_num": [1, 1],
+            "line_num": [1, 2],
+        },
+        crops,
+    )
+    monkeypatch.setattr("ocr_engines.current", lambda: engine)
+    lines = [make_line("Pasta 12.5O", 40.0), make_line("Tea 3.OO", 30.0, top=150)]
+
+    refined = refine_lines(numpy.full((300, 200), 255, dtype=numpy.uint8), lines)
+    assert crops == [((56 + 16 + 56, 176), "--psm 6")]
+    assert [line["text"] for line in refined] == ["12.50", "3.00"]
+    assert refined[1]["words"][0]["top"] == 150
+
+
+def test_refine_lines_budget_is_per_receipt(monkeypatch):
+    """Lines re-read for one part of a receipt count against the rest"""
+    crops = []
+    engine = FakeEngine({key: [] for key in ocr_engines.DATA_KEYS}, crops)
+    monkeypatch.setattr("ocr_engines.current", lambda: engine)
+    monkeypatch.setattr("analyzer.MAX_RETRY_LINES", 3)
+    img = numpy.full((300, 200), 255, dtype=numpy.uint8)
+    budget = retry_budget()
+
+    refine_lines(img, [make_line("Pasta 12.5O", 40.0)] * 2, budget)
+    refine_lines(img, [make_line("Tea 3.OO", 30.0)] * 2, budget)
+    refine_lines(img, [make_line("Soup 4.OO", 30.0)], budget)
+    assert budget["lines"] == 0
+    assert [shape[0] for shape, _ in crops] == [56 + 16 + 56, 56]
+
+
+def test_unknown_ocr_engine():
+    """Test that selecting an engine that does not exist fails clearly"""
+    with pytest.raises(ValueError):
+        with ocr_engines.selected("abacus"):
+            pass
+
+
+def test_onnx_engine_reads_text():
+    """Test that the ONNX engine returns Tesseract style word boxes"""
+    pytest.importorskip("rapidocr_onnxruntime")
+    img = numpy.full((200, 900), 255, dtype=numpy.uint8)
+    put_text = cv2.putText  # pylint: disable=no-member
+    font = cv2.FONT_HERSHEY_SIMPLEX  # pylint: disable=no-member
+    # dish names on the left, prices in a column on the right
+    put_text(img, "Pizza", (10, 70), font, 1.5, 0, 3)
+    put_text(img, "12.50", (720, 70), font, 1.5, 0, 3)
+    put_text(img, "Soda", (10, 150), font, 1.5, 0, 3)
+    put_text(img, "2.00", (740, 150), font, 1.5, 0, 3)
+
+    with ocr_engines.selected("onnx"):
+        lines = ocr_lines(img, offset=100)
+    assert [line["text"] for line in lines] == ["Pizza 12.50", "Soda 2.00"]
+    assert lines[0]["top"] >= 100
+    assert lines[0]["words"][0]["conf"] > 50
+    assert parse_processed_lines([line["text"] for line in lines]) == [
+        {"dish": "Pizza", "price": 12.5},
+        {"dish": "Soda", "price": 2.0},
+    ]
+
+
+def test_group_rows_merges_price_column():
+    """Boxes overlapping vertically become one row, ordered left to right"""
+    price = {"text": "12.50", "left": 700, "top": 12, "bottom": 42}
+    dish = {"text": "Pizza", "left": 10, "top": 10, "bottom": 40}
+    soda = {"text": "Soda", "left": 10, "top": 60, "bottom": 90}
+    assert ocr_engines.group_rows([price, soda, dish]) == [[dish, price], [soda]]
+
+
+def make_jpeg(width, height):
+    """Encode a color test image as JPEG"""
+    img = numpy.full((height, width, 3), 200, dtype=numpy.uint8)
+    return cv2.imencode(".jpg", img)[1].tobytes()  # pylint: disable=no-member
+
+
+def test_image_dimensions():
+    """Test that the size is read from the header and garbage gives None"""
+    assert image_dimensions(make_jpeg(400, 300)) == (400, 300)
+    assert image_dimensions(b"some initial text data") is None
+
+
+def test_decode_image_full_resolution():
+    """Test that images within budget are decoded in full, as grayscale"""
+    img = decode_image(make_jpeg(400, 300), memory_budget_mb=64)
+    assert img.shape == (300, 400)
+
+
+def test_decode_image_reduced_resolution():
+    """Test that images over budget are decoded at reduced resolution"""
+    # 120000 pixels with room for 40000: 1/2 resolution is enough
+    budget = 40000 * 4 / (1024 * 1024)
+    img = decode_image(make_jpeg(400, 300), memory_budget_mb=budget)
+    assert img.shape == (150, 200)
+
+
+def test_decode_image_beyond_smallest_reduction():
+    """Test that images still too big at 1/8 resolution are scaled to fit"""
+    budget = 100 * 4 / (1024 * 1024)
+    img = decode_image(make_jpeg(800, 800), memory_budget_mb=budget)
+    assert img.size <= 100
+
+
+def test_decode_image_invalid_data():
+    """Test that undecodable data raises a ValueError"""
+    with pytest.raises(ValueError):
+        decode_image(b"some initial text data")
+
+
+def test_user_input_original_size():
+    """The size the photo was taken at is kept only when it makes sense"""
+    form = {"tip": "0", "num-people": "0"}
+    assert user_input_from_form(form)["original_size"] is None
+
+    form.update({"original-width": "4032", "original-height": "3024"})
+    assert user_input_from_form(form)["original_size"] == (4032, 3024)
+
+    form["original-height"] = "tall"
+    assert user_input_from_form(form)["original_size"] is None
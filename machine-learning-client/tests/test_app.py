@@ -1,8 +1,18 @@
 """Module created to test the ML client Flask server API"""
 
 import io
+import json
+import os
+import socket
+import struct
+import msgspec
 import pytest
-from app import app_setup  # Flask instance of the API
+import warmup
+from app import (
+    LOCAL_ENVIRON_KEY,
+    app_setup,
+    serve_unix_socket,
+)  # Flask instance of the API
 
 
 @pytest.fixture(name="client")
@@ -74,3 +84,227 @@ def test_post_dummy_receipt(client):
     response = client.post("/submit", data=data)
     assert response.status_code == 500
     assert b"Error processing the receipt in the ML client API" in response.data
+
+
+def test_post_unknown_ocr_engine(client):
+    """Asking for an OCR engine that does not exist is a client error"""
+    data = {
+        "tip": "0",
+        "receipt": (io.BytesIO(b"image"), "filename.png"),
+        "num-people": 0,
+        "ocr-engine": "abacus",
+    }
+    response = client.post("/submit", data=data)
+    assert response.status_code == 400
+    assert b"Unknown OCR engine" in response.data
+
+
+def test_post_unknown_priority(client):
+    """Only interactive and bulk receipts are scheduled"""
+    data = {
+        "tip": "0",
+        "receipt": (io.BytesIO(b"image"), "filename.png"),
+        "num-people": 0,
+        "priority": "urgent",
+    }
+    response = client.post("/submit", data=data)
+    assert response.status_code == 400
+    assert b"Unknown priority" in response.data
+
+
+def test_scheduler_route(client):
+    """The scheduler reports its queues per priority class"""
+    response = client.get("/scheduler")
+    assert response.status_code == 200
+    assert response.get_json()["bulk"] == {"running": 0, "waiting": 0}
+
+
+def test_post_streams_partial_results(client, monkeypatch):
+    """Clients accepting NDJSON get the dishes found so far, then the result"""
+
+    def fake_process_data(data, receipt_file, receipt_id=None, on_partial=None):
+        assert receipt_file.read() == b"image"
+        on_partial([{"dish": "Pizza", "price": 10.0}])
+        return {"result_id": receipt_id, "charge_info": {data["people"][0]["name"]: 10}}
+
+    monkeypatch.setattr("app.process_data", fake_process_data)
+    data = {
+        "tip": "0",
+        "receipt": (io.BytesIO(b"image"), "filename.png"),
+        "num-people": 1,
+        "person-1-name": "jane",
+        "person-1-items": "pizza",
+        "receipt-id": "67fc3fd6d5619018c1bdf3a3",
+    }
+
+    response = client.post(
+        "/submit", data=data, headers={"Accept": "application/x-ndjson"}
+    )
+    assert response.mimetype == "application/x-ndjson"
+    updates = [json.loads(line) for line in response.data.splitlines()]
+    assert updates[0] == {
+        "status": "partial",
+        "dishes": [{"dish": "Pizza", "price": 10.0}],
+    }
+    assert updates[1]["status"] == "success"
+    assert updates[1]["charge_info"] == {"jane": 10}
+
+
+def test_post_returns_msgpack(client, monkeypatch):
+    """Clients accepting MessagePack get the charges and dishes in it"""
+    dishes = [{"dish": "Pizza", "price": 10.0}]
+
+    def fake_process_data(data, receipt_file, receipt_id=None, on_partial=None):
+        # pylint: disable=unused-argument
+        return {"result_id": receipt_id, "charge_info": {"jane": 10}, "dishes": dishes}
+
+    monkeypatch.setattr("app.process_data", fake_process_data)
+    data = {
+        "tip": "0",
+        "receipt": (io.BytesIO(b"image"), "filename.png"),
+        "num-people": 0,
+        "receipt-id": "67fc3fd6d5619018c1bdf3a3",
+    }
+    response = client.post(
+        "/submit", data=data, headers={"Accept": "application/x-msgpack"}
+    )
+    assert response.mimetype == "application/x-msgpack"
+    result = msgspec.msgpack.decode(response.data)
+    assert result["charge_info"] == {"jane": 10}
+    assert result["dishes"] == dishes
+
+
+def test_post_streams_msgpack_frames(client, monkeypatch):
+    """The MessagePack stream carries length-prefixed messages"""
+
+    def fake_process_data(data, receipt_file, receipt_id=None, on_partial=None):
+        # pylint: disable=unused-argument
+        on_partial([{"dish": "Pizza", "price": 10.0}])
+        return {"result_id": receipt_id, "charge_info": {"jane": 10}}
+
+    monkeypatch.setattr("app.process_data", fake_process_data)
+    data = {
+        "tip": "0",
+        "receipt": (io.BytesIO(b"image"), "filename.png"),
+        "num-people": 0,
+        "receipt-id": "67fc3fd6d5619018c1bdf3a3",
+    }
+    response = client.post(
+        "/submit", data=data, headers={"Accept": "application/x-msgpack-stream"}
+    )
+    assert response.mimetype == "application/x-msgpack-stream"
+    body, updates = response.data, []
+    while body:
+        (size,) = struct.unpack(">I", body[:4])
+        updates.append(msgspec.msgpack.decode(body[4 : 4 + size]))
+        body = body[4 + size :]
+    assert [update["status"] for update in updates] == ["partial", "success"]
+    assert updates[1]["dishes"] == []
+
+
+def test_ledger_route(client, monkeypatch):
+    """Ensure the ledger endpoint returns balances and settle-up payments"""
+    monkeypatch.setattr(
+        "ledger.get_group_balances", lambda group_id: {"Alice": 500, "Bob": -500}
+    )
+    response = client.get("/ledger/friday-lunch")
+
+    assert response.status_code == 200
+    assert response.get_json()["settle_up"] == [
+        {"from": "Bob", "to": "Alice", "amount": 5.0}
+    ]
+
+
+def test_profiling_endpoints_hidden_without_token(client):
+    """Ensure the profiling endpoints are not reachable without the token"""
+    assert client.post("/admin/profile?count=2").status_code == 404
+    assert client.get("/admin/profiles").status_code == 404
+
+
+def test_profiling_endpoints(client, monkeypatch, tmp_path):
+    """Ensure profiling can be armed and profiles listed with the token"""
+    monkeypatch.setattr("request_profiler.PROFILE_TOKEN", "secret")
+    monkeypatch.setattr("request_profiler.PROFILE_DIR", str(tmp_path))
+    headers = {"X-Profile-Token": "secret"}
+
+    response = client.post("/admin/profile?count=2", headers=headers)
+    assert response.get_json() == {"armed": 2}
+
+    (tmp_path / "20250101-000000-000000001.txt").write_text("wall time: 1 ms")
+    response = client.get("/admin/profiles", headers=headers)
+    assert response.get_json()["profiles"][0]["name"] == "20250101-000000-000000001"
+
+    response = client.get(
+        "/admin/profiles/20250101-000000-000000001.txt", headers=headers
+    )
+    assert response.data == b"wall time: 1 ms"
+    client.post("/admin/profile?count=0", headers=headers)
+
+
+def test_submit_local_reads_shared_volume(client, monkeypatch, tmp_path):
+    """A co-located web-app only sends the path of the receipt"""
+    (tmp_path / "refs").mkdir()
+    (tmp_path / "refs" / "receipt-1").write_bytes(b"image")
+    (tmp_path.parent / "outside").write_bytes(b"secret")
+    monkeypatch.setattr("app.SHARED_UPLOAD_DIR", str(tmp_path))
+
+    def fake_process_data(data, receipt_file, receipt_id=None, on_partial=None):
+        # pylint: disable=unused-argument
+        assert receipt_file.read() == b"image"
+        return {"result_id": receipt_id, "charge_info": {"jane": 10}}
+
+    monkeypatch.setattr("app.process_data", fake_process_data)
+    form = {"tip": "0", "num-people": "0", "receipt-id": "67fc3fd6d5619018c1bdf3a3"}
+    message = {"form": form, "image": "refs/receipt-1"}
+    # not served to requests over TCP
+    assert client.post("/submit-local", json=message).status_code == 404
+
+    local = {LOCAL_ENVIRON_KEY: True}
+    response = client.post("/submit-local", json=message, environ_base=local)
+    assert response.status_code == 200
+    assert response.get_json()["charge_info"] == {"jane": 10}
+
+    for image in ("refs/missing", "../outside", str(tmp_path.parent / "outside")):
+        response = client.post(
+            "/submit-local", json={"form": form, "image": image}, environ_base=local
+        )
+        assert response.status_code == 400
+
+
+def test_serve_unix_socket(tmp_path):
+    """The app answers on the Unix socket too"""
+    path = os.path.join(tmp_path, "run", "ml.sock")
+    server = serve_unix_socket(app_setup(), path)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            sock.sendall(b"GET / HTTP/1.0\r\nHost: ml-client\r\n\r\n")
+            reply = b""
+            while chunk := sock.recv(4096):
+                reply += chunk
+        assert reply.startswith(b"HTTP/1.1 200")
+        assert reply.endswith(b"running")
+
+        # /submit-local is served here: a bad image path is rejected, not hidden
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            sock.sendall(
+                b"POST /submit-local HTTP/1.0\r\nHost: ml-client\r\n"
+                b"Content-Type: application/json\r\nContent-Length: 2\r\n\r\n{}"
+            )
+            reply = b""
+            while chunk := sock.recv(4096):
+                reply += chunk
+        assert reply.startswith(b"HTTP/1.1 400")
+    finally:
+        server.shutdown()
+
+
+def test_ready_route(client, monkeypatch):
+    """The readiness probe fails until the warm-up is done"""
+    monkeypatch.setattr(warmup, "readiness", lambda: {"status": "warming up"})
+    assert client.get("/ready").status_code == 503
+    monkeypatch.setattr(warmup, "readiness", lambda: {"status": "ready"})
+    response = client.get("/ready")
+    assert response.status_code == 200
+    assert response.get_json() == {"status": "ready"}
@@ -0,0 +1,185 @@
+"""Module created to test the OCR engine benchmark"""
+
+import json
+import cv2
+import numpy
+import pytest
+import merchants
+from benchmark import (
+    benchmark_configuration,
+    benchmark_engine,
+    configurations,
+    load_corpus,
+    mark_frontier,
+    price_recall,
+    score_receipt,
+    text_accuracy,
+)
+
+RECEIPT_TRUTH = {
+    "dishes": [{"dish": "Pizza", "price": 12.5}, {"dish": "Soda", "price": 2.0}],
+    "subtotal": 14.5,
+    "tax": 1.45,
+}
+
+
+class FakeEngine:  # pylint: disable=too-few-public-methods
+    """OCR engine that always reads the same receipt"""
+
+    def image_to_data(self, img, config=""):  # pylint: disable=unused-argument
+        """Two lines of one word each"""
+        return {
+            "text": ["Pizza", "12.50", "Soda", "2.0O"],
+            "conf": [90.0, 90.0, 90.0, 90.0],
+            "left": [0, 60, 0, 60],
+            "top": [0, 0, 30, 30],
+            "width": [50, 50, 50, 50],
+            "height": [20, 20, 20, 20],
+            "block_num": [1, 1, 1, 1],
+            "par_num": [1, 1, 1, 1],
+            "line_num": [1, 1, 2, 2],
+        }
+
+
+def fake_page(rows):
+    """OCR stub reading the lines of a page given as {top row: text}"""
+    calls = []
+
+    def fake_ocr_lines(img, offset=0):
+        calls.append((offset, offset + img.shape[0]))
+        return [
+            {"text": text, "top": top, "bottom": top + 10}
+            for top, text in sorted(rows.items())
+            if offset <= top < offset + img.shape[0]
+        ]
+
+    return fake_ocr_lines, calls
+
+
+def write_receipt(path, height=200):
+    """Blank receipt image of the given height"""
+    img = numpy.full((height, 120), 255, dtype=numpy.uint8)
+    png = cv2.imencode(".png", img)[1]  # pylint: disable=no-member
+    path.write_bytes(png.tobytes())
+
+
+def test_text_accuracy():
+    """Identical texts score 1 regardless of case and spacing"""
+    assert text_accuracy("Pizza  12.50", "pizza 12.50") == 1.0
+    assert 0 < text_accuracy("Pizza 12.5O", "Pizza 12.50") < 1
+
+
+def test_price_recall():
+    """Each true price counts once"""
+    truth = "Pizza 12.50\nSoda 2.00\nSoda 2.00\nThanks"
+    assert price_recall("Pizza 12.50\nSoda 2.00", truth) == pytest.approx(2 / 3)
+    assert price_recall("anything", "no prices here") == 1.0
+
+
+def test_benchmark_engine(monkeypatch, tmp_path):
+    """Receipts with a .txt truth are OCR'd and scored per engine"""
+    img = numpy.full((60, 120), 255, dtype=numpy.uint8)
+    (tmp_path / "r1.png").write_bytes(
+        cv2.imencode(".png", img)[1].tobytes()  # pylint: disable=no-member
+    )
+    (tmp_path / "r1.txt").write_text("Pizza 12.50\nSoda 2.00\n")
+    (tmp_path / "notes.png").write_bytes(b"no truth, skipped")
+
+    corpus = load_corpus(tmp_path)
+    assert [name for name, _, _ in corpus] == ["r1.png"]
+
+    monkeypatch.setattr("ocr_engines.get_engine", lambda name=None: FakeEngine())
+    result = benchmark_engine("fake", corpus)
+    assert result["engine"] == "fake"
+    assert result["receipts"] == 1
+    assert result["price_recall"] == 0.5
+    assert result["mean_ms"] >= 0
+
+
+def test_score_receipt():
+    """Dishes are matched by price and name, totals compared per person"""
+    perfect = score_receipt(
+        "Pizza 12.50\nSoda 2.00\nSubtotal 14.50\nTax 1.45", RECEIPT_TRUTH
+    )
+    assert perfect["hits"] == perfect["found"] == perfect["true"] == 2
+    assert perfect["subtotal"] and perfect["tax"] and perfect["exact"]
+    assert perfect["total_error"] == 0
+
+    # a misread dish name still counts, a misread price does not
+    partial = score_receipt("Piza 12.50\nSoda 3.00\nSubtotal 14.50", RECEIPT_TRUTH)
+    assert partial["hits"] == 1
+    assert partial["subtotal"] and not partial["tax"]
+    assert not partial["exact"]
+
+
+def test_benchmark_configuration(monkeypatch, tmp_path):
+    """Receipts with a .json truth are run through a pipeline configuration"""
+    write_receipt(tmp_path / "r1.png")
+    (tmp_path / "r1.json").write_text(json.dumps(RECEIPT_TRUTH))
+    (tmp_path / "r2.png").write_bytes(b"only a .txt truth, skipped")
+    (tmp_path / "r2.txt").write_text("Pizza 12.50\n")
+
+    corpus = load_corpus(tmp_path, ".json")
+    assert [name for name, _, _ in corpus] == ["r1.png"]
+    assert corpus[0][2] == RECEIPT_TRUTH
+
+    fake_ocr_lines, _ = fake_page(
+        {5: "Pizza Place", 100: "Pizza 12.50", 130: "Soda 2.0O"}
+    )
+    monkeypatch.setattr("analyzer.ocr_lines", fake_ocr_lines)
+    monkeypatch.setattr("ocr_engines.get_engine", lambda name=None: FakeEngine())
+    [config] = configurations(["fake"], [64], [0], [False])
+    result = benchmark_configuration(config, corpus)
+    assert result["templates"]
+    assert result["precision"] == 1.0  # the misread soda is not parsed at all
+    assert result["recall"] == 0.5
+    # pizza (13.75 with tax) gets 12.50, soda (2.20) nothing
+    assert result["total_error"] == pytest.approx((1.25 + 2.2) / 2)
+    assert result["receipts_per_s"] > 0
+
+
+def test_benchmark_with_and_without_templates(monkeypatch, tmp_path):
+    """Repeat receipts skip rows only with templates, each run from scratch"""
+    for name in ("r1", "r2"):
+        write_receipt(tmp_path / f"{name}.png", 1000)
+        (tmp_path / f"{name}.json").write_text(json.dumps(RECEIPT_TRUTH))
+    corpus = load_corpus(tmp_path, ".json")
+    fake_ocr_lines, calls = fake_page(
+        {
+            5: "Pizza Place",
+            500: "Pizza 12.50",
+            530: "Soda 2.00",
+            560: "Subtotal 14.50",
+            590: "Tax 1.45",
+        }
+    )
+    monkeypatch.setattr("analyzer.ocr_lines", fake_ocr_lines)
+    monkeypatch.setattr("ocr_engines.get_engine", lambda name=None: FakeEngine())
+    stored = []
+    monkeypatch.setattr("merchants.store_merchant_template", stored.append)
+    monkeypatch.setattr("merchants.get_merchant_template", lambda merchant: None)
+
+    rows_read = {}
+    for config in configurations(["fake"], [64], [0], [False], [False, True]):
+        calls.clear()
+        result = benchmark_configuration(config, corpus)
+        assert result["exact_totals"] == 1.0
+        rows_read[config["templates"]] = sum(bottom - top for top, bottom in calls)
+
+    # the warm-up and the first timed receipt read whole pages either way
+    assert rows_read[True] < rows_read[False]
+    merchants.flush_templates()
+    assert not stored
+    assert merchants.get_template("pizza place") is None
+
+
+def test_mark_frontier():
+    """Only results beaten on both speed and error leave the frontier"""
+    results = mark_frontier(
+        [
+            {"receipts_per_s": 10, "total_error": 0.5},
+            {"receipts_per_s": 5, "total_error": 0.1},
+            {"receipts_per_s": 4, "total_error": 0.2},
+        ]
+    )
+    assert [row["frontier"] for row in results] == [True, True, False]
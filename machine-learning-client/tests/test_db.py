@@ -3,7 +3,9 @@
 import mongomock
 import pytest
 
-from db import store_receipt_info
+from pymongo.errors import PyMongoError
+
+from db import store_receipt_info, flush_receipts, ReceiptWriter
 
 shared_client = mongomock.MongoClient()
 shared_db = shared_client["test_dutch_pay"]
@@ -27,6 +29,7 @@ def test_store_receipt_info_success():
 
     inserted_id = store_receipt_info(sample_receipt_text, sample_charge_info)
     assert inserted_id is not None
+    flush_receipts()
 
     stored_doc = shared_db.receipts.find_one({"_id": inserted_id})
     assert stored_doc is not None
@@ -42,9 +45,141 @@ def test_store_receipt_data_empty_values():
 
     inserted_id = store_receipt_info(sample_receipt_text, sample_charge_info)
     assert inserted_id is not None
+    flush_receipts()
 
     stored_doc = shared_db.receipts.find_one({"_id": inserted_id})
     assert stored_doc is not None
 
     assert stored_doc.get("receipt_text") == sample_receipt_text
     assert stored_doc.get("charge_info") == sample_charge_info
+
+
+def test_store_receipt_info_with_given_id():
+    """Test that a caller-chosen receipt id is used as the document id"""
+    receipt_id = "67fc3fd6d5619018c1bdf3a5"
+
+    inserted_id = store_receipt_info("Pizza 10.00", {"Alice": 10.0}, receipt_id)
+    assert str(inserted_id) == receipt_id
+    flush_receipts()
+
+    stored_doc = shared_db.receipts.find_one({"_id": inserted_id})
+    assert stored_doc.get("status") == "done"
+
+
+def test_store_receipt_info_history_fields():
+    """Test that the fields used by history queries are stored"""
+    charge_info = {"Alice": 10.77, " Bob ": 11.44}
+
+    inserted_id = store_receipt_info("text", charge_info, owner_id="owner-1")
+    flush_receipts()
+
+    stored_doc = shared_db.receipts.find_one({"_id": inserted_id})
+    assert stored_doc["owner_id"] == "owner-1"
+    assert stored_doc["people"] == ["alice", "bob"]
+    assert stored_doc["total"] == 22.21
+    assert stored_doc["timestamp"] is not None
+    assert "original_size" not in stored_doc
+
+
+def test_store_receipt_info_original_size():
+    """Test that the size of the photo before downscaling is stored"""
+    inserted_id = store_receipt_info("text", {"Alice": 1.0}, original_size=(800, 600))
+    flush_receipts()
+
+    stored_doc = shared_db.receipts.find_one({"_id": inserted_id})
+    assert stored_doc["original_size"] == {"width": 800, "height": 600}
+
+
+class UnavailableCollection:  # pylint: disable=too-few-public-methods
+    """Collection stand-in for a DB that cannot be reached"""
+
+    def insert_many(self, documents, ordered=True):
+        """Fail like pymongo does when no server is available"""
+        raise PyMongoError(f"no server for {len(documents)} documents ({ordered})")
+
+
+class UnavailableDB:  # pylint: disable=too-few-public-methods
+    """DB stand-in for a DB that cannot be reached"""
+
+    receipts = UnavailableCollection()
+
+
+def test_store_receipt_info_write_behind(monkeypatch):
+    """Test that receipts handed to the writer reach the DB once flushed"""
+    writer = ReceiptWriter(batch_size=10, flush_interval=0.05, journal_path="")
+    monkeypatch.setattr("db.receipt_writer", writer)
+
+    inserted_id = store_receipt_info("Soup 4.00", {"Alice": 4.0})
+    writer.flush()
+    assert shared_db.receipts.find_one({"_id": inserted_id}) is not None
+
+
+def test_writer_batches_inserts(monkeypatch):
+    """Test that queued receipts are written with a single insert_many"""
+    batches = []
+    original = shared_db.receipts.insert_many
+
+    def counting_insert_many(documents, ordered=True):
+        batches.append(len(documents))
+        return original(documents, ordered=ordered)
+
+    monkeypatch.setattr(shared_db.receipts, "insert_many", counting_insert_many)
+    writer = ReceiptWriter(batch_size=3, flush_interval=1, journal_path="")
+    for i in range(3):
+        writer.submit({"receipt_text": f"batch {i}"})
+    writer.flush()
+
+    assert batches == [3]
+
+
+def test_writer_journals_and_replays(monkeypatch, tmp_path):
+    """Test that receipts survive a DB outage through the local journal"""
+    journal = tmp_path / "journal.jsonl"
+    writer = ReceiptWriter(batch_size=10, flush_interval=0.01, journal_path=journal)
+
+    monkeypatch.setattr("db.get_db", UnavailableDB)
+    writer.write_batch([{"receipt_text": "outage", "charge_info": {"Bob": 1.0}}])
+    assert journal.exists()
+
+    monkeypatch.setattr("db.get_db", get_test_db)
+    writer.write_batch([{"receipt_text": "after outage"}])
+    assert not journal.exists()
+    assert shared_db.receipts.find_one({"receipt_text": "outage"}) is not None
+    assert shared_db.receipts.find_one({"receipt_text": "after outage"}) is not None
+
+    # replaying the same receipts again does not fail on duplicate ids
+    stored = shared_db.receipts.find_one({"receipt_text": "outage"})
+    writer.write_batch([stored])
+
+
+def test_writer_skips_torn_journal_line(tmp_path):
+    """A line torn by a crash mid-append does not block later receipts"""
+    journal = tmp_path / "journal.jsonl"
+    journal.write_text('{"receipt_text": "journaled"}\n{"receipt_text": "tor')
+    writer = ReceiptWriter(batch_size=10, flush_interval=0.01, journal_path=journal)
+
+    writer.write_batch([{"receipt_text": "after torn line"}])
+    assert not journal.exists()
+    assert shared_db.receipts.find_one({"receipt_text": "journaled"}) is not None
+    assert shared_db.receipts.find_one({"receipt_text": "after torn line"})
+
+
+def test_writer_survives_failed_batch(monkeypatch, tmp_path):
+    """A batch failing unexpectedly is journaled and the writer keeps going"""
+    journal = tmp_path / "journal.jsonl"
+    writer = ReceiptWriter(batch_size=1, flush_interval=0.01, journal_path=journal)
+
+    def broken_db():
+        raise RuntimeError("unexpected")
+
+    monkeypatch.setattr("db.get_db", broken_db)
+    writer.submit({"receipt_text": "while broken"})
+    writer.flush()
+    assert journal.exists()
+
+    monkeypatch.setattr("db.get_db", get_test_db)
+    writer.submit({"receipt_text": "once fixed"})
+    writer.flush()
+    assert not journal.exists()
+    assert shared_db.receipts.find_one({"receipt_text": "while broken"}) is not None
+    assert shared_db.receipts.find_one({"receipt_text": "once fixed"}) is not None
@@ -0,0 +1,105 @@
+"""This module tests the de-duplication of repeated receipt submissions"""
+
+import threading
+import time
+import mongomock
+import pytest
+from pymongo import MongoClient
+import dedup
+from db import store_receipt_info
+
+shared_db = mongomock.MongoClient()["test_dutch_pay"]
+
+
+@pytest.fixture(autouse=True)
+def patch_get_db(monkeypatch):
+    """Use an in-memory DB for the stored result lookups"""
+    monkeypatch.setattr("db.get_db", lambda: shared_db)
+    monkeypatch.setattr("db.WRITE_BEHIND", False)
+
+
+class Counter:  # pylint: disable=too-few-public-methods
+    """Computation that counts how often it ran"""
+
+    def __init__(self, gate=None):
+        self.calls = 0
+        self.gate = gate
+
+    def __call__(self):
+        self.calls += 1
+        if self.gate is not None:
+            self.gate.wait(5)
+        return {"result_id": self.calls, "charge_info": {"jane": 10.0}}
+
+
+def test_without_key_always_computes():
+    """Test that requests without a key are never coalesced"""
+    compute = Counter()
+    dedup.run_once(None, compute)
+    dedup.run_once("", compute)
+    assert compute.calls == 2
+
+
+def test_concurrent_repeats_share_one_computation():
+    """Test that identical requests in flight wait for the first one"""
+    gate = threading.Event()
+    compute = Counter(gate)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(dedup.run_once("k1", compute)))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    gate.set()
+    for thread in threads:
+        thread.join()
+
+    assert compute.calls == 1
+    assert results == [results[0]] * 4
+
+
+def test_repeat_within_window_returns_result(monkeypatch):
+    """Test that a finished request is answered again until the window ends"""
+    compute = Counter()
+    first = dedup.run_once("k2", compute)
+    assert dedup.run_once("k2", compute) is first
+    assert compute.calls == 1
+
+    monkeypatch.setattr("dedup.IDEMPOTENCY_WINDOW", -1)
+    dedup.run_once("k2", compute)
+    assert compute.calls == 2
+
+
+def test_errors_are_not_remembered():
+    """Test that a failed request can be retried"""
+
+    def fail():
+        raise ValueError("Could not decode the receipt image")
+
+    with pytest.raises(ValueError):
+        dedup.run_once("k3", fail)
+    compute = Counter()
+    dedup.run_once("k3", compute)
+    assert compute.calls == 1
+
+
+def test_repeat_answered_from_stored_receipt():
+    """Test that repeats handled by another process are found in the DB"""
+    receipt_id = store_receipt_info("Pizza 10.00", {"jane": 10.0}, key="k4")
+    compute = Counter()
+    result = dedup.run_once("k4", compute)
+    assert compute.calls == 0
+    assert result == {"result_id": receipt_id, "charge_info": {"jane": 10.0}}
+
+
+def test_unreachable_db_does_not_hold_up_ocr(monkeypatch):
+    """Test that the lookup gives up quickly and the receipt is computed"""
+    unreachable = MongoClient("mongodb://127.0.0.1:1", connect=False)["test"]
+    monkeypatch.setattr("db.get_db", lambda: unreachable)
+    compute = Counter()
+
+    start = time.monotonic()
+    dedup.run_once("k5", compute)
+    assert compute.calls == 1
+    assert time.monotonic() - start < 5
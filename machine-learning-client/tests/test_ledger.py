@@ -0,0 +1,82 @@
+"""This module tests the per-group balance ledger of the ML client"""
+
+import mongomock
+import pytest
+
+import ledger
+
+shared_client = mongomock.MongoClient()
+shared_db = shared_client["test_dutch_pay"]
+
+
+@pytest.fixture(autouse=True)
+def patch_get_db(monkeypatch):
+    """Monkeypatch the mock DB in and start every test with an empty ledger"""
+    monkeypatch.setattr("db.get_db", lambda: shared_db)
+    shared_db.balances.delete_many({})
+    shared_db.transactions.delete_many({})
+
+
+def test_receipt_entries():
+    """Test that everyone but the payer owes the payer their share"""
+    changes, transactions = ledger.receipt_entries(
+        "group", "r1", "Alice", {"Alice": 10.0, "Bob": 12.5, "Carol": 7.25}
+    )
+    assert changes == {"Alice": 1975, "Bob": -1250, "Carol": -725}
+    assert [t["debtor"] for t in transactions] == ["Bob", "Carol"]
+    assert all(t["creditor"] == "Alice" for t in transactions)
+
+
+def test_balances_accumulate_across_receipts():
+    """Test that running balances are updated incrementally per receipt"""
+    ledger.record_receipt("group", "r1", "Alice", {"Alice": 10.0, "Bob": 20.0})
+    ledger.record_receipt("group", "r2", "Bob", {"Alice": 5.0, "Bob": 5.0})
+
+    summary = ledger.group_summary("group")
+    assert summary["balances"] == {"Alice": 15.0, "Bob": -15.0}
+    assert summary["settle_up"] == [{"from": "Bob", "to": "Alice", "amount": 15.0}]
+    assert shared_db.transactions.count_documents({"group_id": "group"}) == 2
+
+
+def test_replayed_receipt_is_applied_once():
+    """Test that recording the same receipt twice does not double count"""
+    ledger.record_receipt("group", "r1", "Alice", {"Alice": 10.0, "Bob": 20.0})
+    ledger.record_receipt("group", "r1", "Alice", {"Alice": 10.0, "Bob": 20.0})
+
+    assert ledger.group_summary("group")["balances"] == {"Alice": 20.0, "Bob": -20.0}
+    assert shared_db.transactions.count_documents({"receipt_id": "r1"}) == 1
+
+
+def test_names_with_reserved_characters():
+    """Test that names with dots and dollar signs round-trip"""
+    ledger.record_receipt("group", "r1", "J.R.", {"J.R.": 1.0, "$am": 2.0})
+    assert ledger.group_summary("group")["balances"] == {"J.R.": 2.0, "$am": -2.0}
+
+
+def test_record_user_receipt_defaults():
+    """Test that the group defaults to the owner and the payer to the first person"""
+    future = ledger.record_user_receipt(
+        {"owner": "session-1"}, "r1", {"Alice": 3.0, "Bob": 4.0}
+    )
+    future.result()
+    assert ledger.group_summary("session-1")["balances"] == {"Alice": 4.0, "Bob": -4.0}
+    assert ledger.record_user_receipt({}, "r2", {"Alice": 1.0}) is None
+
+
+def test_settle_up_minimal_payments():
+    """Test that settling up needs fewer payments than people"""
+    balances = {"A": 5000, "B": -2000, "C": -2000, "D": -1000, "E": 0}
+    payments = ledger.settle_up(balances)
+
+    assert len(payments) == 3
+    assert all(payment["to"] == "A" for payment in payments)
+    assert sum(payment["amount_cents"] for payment in payments) == 5000
+
+
+def test_settle_up_balances_out():
+    """Test that the payments zero every balance"""
+    balances = {"A": 3000, "B": 1500, "C": -2500, "D": -1200, "E": -800}
+    for payment in ledger.settle_up(balances):
+        balances[payment["from"]] += payment["amount_cents"]
+        balances[payment["to"]] -= payment["amount_cents"]
+    assert all(cents == 0 for cents in balances.values())
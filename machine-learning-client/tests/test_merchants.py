@@ -0,0 +1,123 @@
+"""This module tests the merchant template cache of the ML client"""
+
+import threading
+import mongomock
+import pytest
+
+import merchants
+
+shared_client = mongomock.MongoClient()
+shared_db = shared_client["test_dutch_pay"]
+
+
+@pytest.fixture(autouse=True)
+def patch_get_db(monkeypatch):
+    """Monkeypatch the mock DB in and start every test with an empty cache"""
+    monkeypatch.setattr("db.get_db", lambda: shared_db)
+    shared_db.merchants.delete_many({})
+    merchants._cache.clear()  # pylint: disable=protected-access
+    yield
+    merchants.flush_templates()  # before the mock DB is patched out
+
+
+def test_detect_merchant_skips_numeric_lines():
+    """Test that the first mostly-alphabetic header line is the merchant"""
+    lines = ["", "12/04/2025 18:32", "Joe's Pizza & Pasta", "123 Main St"]
+    assert merchants.detect_merchant(lines) == "joes pizza pasta"
+
+
+def test_detect_merchant_no_header():
+    """Test that receipts without a usable header have no merchant"""
+    assert merchants.detect_merchant(["", "0042", "$$"]) is None
+
+
+def test_learn_and_get_template():
+    """Test that learning a receipt stores the item region and dishes"""
+    item_lines = [
+        {"text": "Margherita 12.00", "top": 300, "bottom": 320},
+        {"text": "Tax 1.00", "top": 600, "bottom": 620},
+    ]
+    dishes = [{"dish": "Margherita", "price": 12.0}]
+
+    merchants.learn_template("joes pizza", item_lines, dishes, 1000)
+    merchants.flush_templates()
+
+    merchants._cache.clear()  # pylint: disable=protected-access
+    template = merchants.get_template("joes pizza")
+    assert template["dishes"] == ["Margherita"]
+    assert template["region"][0] == pytest.approx(0.27)
+    assert template["region"][1] == pytest.approx(0.65)
+    assert merchants.region_rows(template, 2000) == (540, 1300)
+
+
+def test_template_region_only_grows():
+    """Test that a shorter receipt does not shrink the learned region"""
+    long_lines = [
+        {"text": "a 1.00", "top": 200, "bottom": 220},
+        {"text": "b 2.00", "top": 800, "bottom": 820},
+    ]
+    short_lines = [{"text": "c 3.00", "top": 400, "bottom": 420}]
+
+    merchants.learn_template("diner", long_lines, [], 1000)
+    template = merchants.learn_template("diner", short_lines, [], 1000)
+    assert template["region"][0] == pytest.approx(0.17)
+    assert template["region"][1] == pytest.approx(0.85)
+    assert template["seen"] == 2
+
+
+def test_learn_template_writes_only_changes(monkeypatch):
+    """Test that a receipt adding nothing to the template is not written"""
+    writes = []
+    monkeypatch.setattr("merchants.store_merchant_template", writes.append)
+    lines = [{"text": "Taco 3.00", "top": 300, "bottom": 320}]
+    dishes = [{"dish": "Taco", "price": 3.0}]
+
+    merchants.learn_template("taqueria", lines, dishes, 1000)
+    merchants.learn_template("taqueria", lines, dishes, 1000)
+    merchants.learn_template("taqueria", lines, [{"dish": "Agua", "price": 2}], 1000)
+    merchants.flush_templates()
+    assert [write["dishes"] for write in writes] == [["Taco"], ["Taco", "Agua"]]
+    assert writes[-1]["seen"] == 3
+
+
+def test_concurrent_receipts_share_the_cache(monkeypatch):
+    """Receipts learning and looking up templates at once lose no update"""
+    monkeypatch.setattr("merchants.store_merchant_template", lambda template: None)
+    monkeypatch.setattr("merchants.get_merchant_template", lambda merchant: None)
+    lines = [{"text": "Bao 5.00", "top": 300, "bottom": 320}]
+    names = ["ramen house", "taco truck", "bagel shop", "curry corner"]
+
+    def learn(number):
+        for _ in range(50):
+            merchants.learn_template(names[number % 4], lines, [], 1000)
+            merchants.get_template(f"unknown {number}")
+
+    threads = [threading.Thread(target=learn, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(merchants.get_template(name)["seen"] for name in names) == 400
+
+
+def test_get_template_fuzzy_merchant_name():
+    """Test that a slightly misread merchant name still finds the template"""
+    lines = [{"text": "Ramen 14.00", "top": 100, "bottom": 120}]
+    merchants.learn_template("ichiran ramen", lines, [], 1000)
+
+    assert merchants.get_template("ichiran ramem") is not None
+    assert merchants.get_template("burger barn") is None
+
+
+def test_canonicalize_dishes():
+    """Test that OCR'd dish names are snapped to the known spelling"""
+    template = {"dishes": ["Pepperoni Pizza", "Garlic Knots"]}
+    entries = [
+        {"dish": "Pepperon1 Pizza", "price": 15.0},
+        {"dish": "Lemonade", "price": 3.0},
+    ]
+
+    result = merchants.canonicalize_dishes(entries, template)
+    assert result[0] == {"dish": "Pepperoni Pizza", "price": 15.0}
+    assert result[1] == {"dish": "Lemonade", "price": 3.0}
+    assert merchants.canonicalize_dishes(entries, None) is entries
@@ -0,0 +1,83 @@
+"""This module tests the opt-in request profiler of the ML client"""
+
+import os
+import time
+import pytest
+
+import request_profiler
+
+
+@pytest.fixture(name="profile_dir", autouse=True)
+def fixture_profile_dir(monkeypatch, tmp_path):
+    """Store profiles in a temporary directory with a known token"""
+    monkeypatch.setattr("request_profiler.PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr("request_profiler.PROFILE_TOKEN", "secret")
+    monkeypatch.setattr("request_profiler.SAMPLE_INTERVAL", 0.001)
+    request_profiler.arm(0)
+    return tmp_path
+
+
+def busy_work():
+    """Spend some CPU time and allocate some memory"""
+    end = time.perf_counter() + 0.05
+    data = []
+    while time.perf_counter() < end:
+        data.append(list(range(100)))
+    return data
+
+
+def test_not_profiled_by_default(profile_dir):
+    """Test that nothing is captured unless armed or asked for"""
+    with request_profiler.maybe_profile() as name:
+        busy_work()
+    assert name is None
+    assert not os.listdir(profile_dir)
+
+
+def test_invalid_token_is_ignored():
+    """Test that a wrong X-Profile token does not trigger profiling"""
+    with request_profiler.maybe_profile("wrong") as name:
+        busy_work()
+    assert name is None
+
+
+def test_armed_requests_are_profiled(profile_dir):
+    """Test that arming profiles exactly the next N requests"""
+    assert request_profiler.arm(1) == 1
+
+    with request_profiler.maybe_profile() as name:
+        busy_work()
+    with request_profiler.maybe_profile() as second:
+        busy_work()
+
+    assert name is not None and second is None
+    assert request_profiler.armed_count() == 0
+    assert sorted(os.listdir(profile_dir)) == [
+        name + ".folded",
+        name + ".tracemalloc",
+        name + ".txt",
+    ]
+    with open(profile_dir / (name + ".folded"), encoding="utf-8") as fp:
+        assert "busy_work" in fp.read()
+    with open(profile_dir / (name + ".txt"), encoding="utf-8") as fp:
+        assert "peak traced memory" in fp.read()
+
+
+def test_token_profiles_request_and_listing():
+    """Test that the token profiles a request and the profile is listed"""
+    with request_profiler.maybe_profile("secret") as name:
+        busy_work()
+
+    profiles = request_profiler.list_profiles()
+    assert profiles[0]["name"] == name
+    assert len(profiles[0]["files"]) == 3
+
+
+def test_old_profiles_are_pruned(monkeypatch, profile_dir):
+    """Test that only the most recent profiles are kept"""
+    monkeypatch.setattr("request_profiler.MAX_PROFILES", 2)
+    for _ in range(3):
+        with request_profiler.maybe_profile("secret"):
+            pass
+    assert len(request_profiler.list_profiles()) == 2
+    assert len(os.listdir(profile_dir)) == 6
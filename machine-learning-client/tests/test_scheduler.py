@@ -0,0 +1,143 @@
+"""Module created to test the OCR scheduler"""
+
+import threading
+import time
+import pytest
+from scheduler import PRIORITIES, ConcurrencyTuner, Scheduler
+
+
+def start_waiting(sched, order, name, **kwargs):
+    """Queue a receipt that records its name once it gets a slot"""
+
+    def run():
+        with sched.slot(**kwargs):
+            order.append(name)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def wait_until_waiting(sched, count):
+    """Block until count tickets are waiting for a slot"""
+    for _ in range(500):
+        stats = sched.stats()
+        if sum(stats[priority]["waiting"] for priority in PRIORITIES) == count:
+            return
+        time.sleep(0.01)
+    raise AssertionError("tickets did not queue up")
+
+
+def test_interactive_goes_before_bulk():
+    """Queued bulk work waits for interactive receipts that came later"""
+    sched = Scheduler(slots=1)
+    order = []
+    with sched.slot("bulk", "batch"):
+        threads = [start_waiting(sched, order, "bulk", priority="bulk")]
+        wait_until_waiting(sched, 1)
+        threads.append(
+            start_waiting(sched, order, "interactive", priority="interactive")
+        )
+        wait_until_waiting(sched, 2)
+    for thread in threads:
+        thread.join(5)
+    assert order == ["interactive", "bulk"]
+
+
+def test_slots_kept_for_interactive():
+    """Bulk work cannot take the slots held back for interactive receipts"""
+    sched = Scheduler(slots=2, interactive_slots=1)
+    order = []
+    with sched.slot("bulk"):
+        bulk = start_waiting(sched, order, "bulk", priority="bulk")
+        wait_until_waiting(sched, 1)
+        # the interactive receipt starts right away next to the running bulk one
+        with sched.slot("interactive"):
+            assert sched.stats()["interactive"]["running"] == 1
+            assert sched.stats()["bulk"] == {"running": 1, "waiting": 1}
+    bulk.join(5)
+    assert order == ["bulk"]
+
+
+def test_tenants_share_fairly_then_deadlines():
+    """The tenant with less recent OCR time goes first, then the earliest deadline"""
+    sched = Scheduler(slots=1)
+    with sched.slot(tenant="busy"):
+        time.sleep(0.05)
+    assert sched.usage("busy") > 0
+
+    order = []
+    with sched.slot(tenant="other"):
+        threads = [
+            start_waiting(sched, order, "busy", tenant="busy", deadline=1),
+            start_waiting(sched, order, "late", tenant="new", deadline=60),
+        ]
+        wait_until_waiting(sched, 2)
+        threads.append(start_waiting(sched, order, "soon", tenant="new", deadline=5))
+        wait_until_waiting(sched, 3)
+    for thread in threads:
+        thread.join(5)
+    # busy has the earliest deadline but used the slot for a while
+    assert order == ["soon", "late", "busy"]
+
+
+def test_unknown_priority():
+    """Only the known priority classes are accepted"""
+    with pytest.raises(ValueError):
+        with Scheduler().slot("urgent"):
+            pass
+
+
+def test_tuner_adds_slots_while_receipts_wait():
+    """Busy windows at steady latency add one slot at a time up to the maximum"""
+    tuner = ConcurrencyTuner(2, 4, window=2, now=0)
+    now = 0
+    for _ in range(4):
+        tuner.waited()
+        for _ in range(2):
+            now += 1
+            tuner.record(1.0, now)
+    assert tuner.limit == 4
+
+    # without waiting receipts the limit stays where it is
+    for _ in range(2):
+        now += 1
+        tuner.record(1.0, now)
+    assert tuner.limit == 4
+
+
+def test_tuner_backs_off_when_latency_climbs():
+    """Oversubscribed cores show up as latency and cut the limit by a quarter"""
+    tuner = ConcurrencyTuner(8, 16, window=2, now=0)
+    tuner.record(1.0, 1)
+    tuner.record(1.0, 2)
+    assert tuner.limit == 8
+    tuner.waited()
+    tuner.record(2.0, 3)
+    assert tuner.record(2.0, 4) == 6
+
+
+def test_tuner_backs_off_when_throughput_drops():
+    """A slot that lowers throughput is taken back"""
+    tuner = ConcurrencyTuner(4, 8, window=2, now=0)
+    tuner.waited()
+    tuner.record(1.0, 1)
+    tuner.record(1.0, 2)  # 1 receipt/s
+    assert tuner.limit == 5
+    tuner.waited()
+    tuner.record(1.0, 4)
+    tuner.record(1.0, 6)  # 0.5 receipt/s at the same latency
+    assert tuner.limit == 3
+
+
+def test_adaptive_scheduler_reports_its_slots():
+    """The tuned number of slots is applied and exposed"""
+    sched = Scheduler(slots=2, max_slots=3, adaptive=True)
+    sched.tuner.window = 1
+    sched.tuner.waited()
+    with sched.slot():
+        pass
+    stats = sched.stats()
+    assert stats["slots"] == 3
+    assert stats["tuning"]["max_slots"] == 3
+    assert stats["tuning"]["baseline_ms"] is not None
@@ -0,0 +1,87 @@
+"""Module created to test the warm-up at start"""
+
+import ocr_engines
+import warmup
+from analyzer import decode_image
+
+
+class FakeEngine:  # pylint: disable=too-few-public-methods
+    """OCR engine reading one line of the synthetic receipt"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def image_to_data(self, img, config=""):  # pylint: disable=unused-argument
+        """Canned word boxes"""
+        self.calls += 1
+        data = {key: [1] for key in ocr_engines.DATA_KEYS}
+        data.update(text=["PIZZA 12.50"], conf=[95.0], left=[20], top=[30], width=[200])
+        data["height"] = [30]
+        return data
+
+
+def test_synthetic_receipt_decodes():
+    """The synthetic receipt is an image the pipeline can read"""
+    img = decode_image(warmup.synthetic_receipt())
+    assert img.shape[0] > 0 and img.shape[1] == 480
+
+
+def test_preload_tessdata_copies_to_tmpfs(monkeypatch, tmp_path):
+    """Language data and configs are copied and Tesseract pointed at them"""
+    source = tmp_path / "tessdata"
+    (source / "configs").mkdir(parents=True)
+    (source / "eng.traineddata").write_bytes(b"model")
+    (source / "configs" / "tsv").write_text("tessedit_create_tsv 1")
+    tmpfs = tmp_path / "shm"
+    monkeypatch.setenv("TESSDATA_PREFIX", str(source))
+
+    loaded = warmup.preload_tessdata(["eng", "deu"], str(tmpfs))
+    assert loaded == ["eng.traineddata"]
+    assert (tmpfs / "eng.traineddata").read_bytes() == b"model"
+    assert (tmpfs / "configs" / "tsv").exists()
+    assert warmup.tessdata_dir() == str(tmpfs)
+
+
+def test_preload_tessdata_without_data(monkeypatch, tmp_path):
+    """Nothing is loaded when the language is not installed"""
+    monkeypatch.setenv("TESSDATA_PREFIX", str(tmp_path))
+    assert not warmup.preload_tessdata(["eng"], "")
+
+
+def test_warm_up_reads_synthetic_receipt(monkeypatch, tmp_path):
+    """Every engine given reads the synthetic receipt"""
+    engine = FakeEngine()
+    monkeypatch.setenv("TESSDATA_PREFIX", str(tmp_path))
+    monkeypatch.setattr(ocr_engines, "get_engine", lambda name=None: engine)
+    assert warmup.warm_up(["tesseract", "onnx"]) >= 0
+    assert engine.calls >= 2
+
+
+def test_run_records_readiness(monkeypatch):
+    """The readiness state follows the outcome of the warm-up"""
+    state = {"status": "starting", "error": None, "seconds": None, "thread": None}
+    monkeypatch.setattr(warmup, "_state", state)
+    monkeypatch.setattr(warmup, "warm_up", lambda: 1.234)
+    assert warmup.run()
+    assert warmup.readiness()["status"] == "ready"
+    assert warmup.readiness()["seconds"] == 1.23
+
+    def fail():
+        raise OSError("tesseract is not installed")
+
+    monkeypatch.setattr(warmup, "warm_up", fail)
+    assert not warmup.run()
+    assert warmup.readiness() == {
+        "status": "failed",
+        "error": "tesseract is not installed",
+        "seconds": 1.23,
+    }
+
+
+def test_no_warm_up_in_tests():
+    """Importing the app in tests starts no warm-up thread"""
+    import app  # pylint: disable=import-outside-toplevel,unused-import
+
+    assert not warmup.WARM_UP
+    assert warmup._state["thread"] is None  # pylint: disable=protected-access
+    assert warmup.readiness()["status"] == "ready"
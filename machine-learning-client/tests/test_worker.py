@@ -0,0 +1,125 @@
+"""This module tests the queue worker of the ML client"""
+
+from datetime import timedelta
+import mongomock
+import pytest
+import worker
+from worker import Worker
+
+FORM = {
+    "tip": "0",
+    "num-people": "1",
+    "person-1-name": "jane",
+    "person-1-items": "pizza",
+}
+
+
+@pytest.fixture(name="queue")
+def fixture_queue():
+    """Empty queue collection"""
+    return mongomock.MongoClient()["test_dutch_pay"]["ocr_jobs"]
+
+
+def enqueue(queue, job_id, enqueued_at=None, priority=0, deadline=30):
+    """Put a job in the queue the way the web-app does"""
+    enqueued_at = enqueued_at or worker.now()
+    queue.insert_one(
+        {
+            "_id": job_id,
+            "status": "queued",
+            "form": FORM,
+            "image": b"image",
+            "filename": "receipt.png",
+            "attempts": 0,
+            "priority": priority,
+            "deadline": enqueued_at + timedelta(seconds=deadline),
+            "enqueued_at": enqueued_at,
+        }
+    )
+
+
+def test_claim_oldest_job_once(queue):
+    """Test that jobs are leased oldest first and only to one worker"""
+    enqueue(queue, "new")
+    enqueue(queue, "old", worker.now() - timedelta(minutes=1))
+
+    first = Worker(queue, "a").claim()
+    assert first["_id"] == "old"
+    assert first["status"] == "running"
+    assert first["attempts"] == 1
+    assert Worker(queue, "b").claim()["_id"] == "new"
+    assert Worker(queue, "c").claim() is None
+
+
+def test_claim_by_priority_then_deadline(queue):
+    """Test that interactive jobs go first, then the earliest deadline"""
+    worker.ensure_indexes(queue)
+    enqueue(queue, "bulk", worker.now() - timedelta(minutes=5), 1, 600)
+    enqueue(queue, "relaxed", worker.now() - timedelta(minutes=1), 0, 300)
+    enqueue(queue, "urgent", deadline=5)
+
+    claimed = [Worker(queue, name).claim()["_id"] for name in "abc"]
+    assert claimed == ["urgent", "relaxed", "bulk"]
+
+
+def test_expired_lease_is_claimed_again(queue):
+    """Test that a job of a dead worker goes to the next one"""
+    enqueue(queue, "job")
+    slow = Worker(queue, "slow", lease_seconds=-1)
+    assert slow.claim()["_id"] == "job"
+
+    fast = Worker(queue, "fast")
+    job = fast.claim()
+    assert job["attempts"] == 2
+    assert job["worker"] == "fast"
+    # the first worker lost the lease and can no longer record an outcome
+    assert not slow.finish("job", "done", charge_info={})
+    assert fast.finish("job", "done", charge_info={"jane": 10})
+
+
+def test_process_records_result(queue, monkeypatch):
+    """Test that a processed job keeps its partial dishes and result"""
+
+    def fake_process_data(user_input, receipt_file, receipt_id, on_partial):
+        assert user_input["people"] == [{"name": "jane", "items": "pizza"}]
+        assert receipt_file.read() == b"image"
+        on_partial([{"dish": "Pizza", "price": 10.0}])
+        return {"result_id": receipt_id, "charge_info": {"jane": 10.0}}
+
+    monkeypatch.setattr("worker.process_data", fake_process_data)
+    enqueue(queue, "job")
+
+    assert Worker(queue, "a").run_once()
+    job = queue.find_one({"_id": "job"})
+    assert job["status"] == "done"
+    assert job["charge_info"] == {"jane": 10.0}
+    assert job["dishes"] == [{"dish": "Pizza", "price": 10.0}]
+    assert "image" not in job
+    assert not Worker(queue, "a").run_once()
+
+
+def test_process_records_error(queue, monkeypatch):
+    """Test that a receipt that cannot be read fails its job"""
+
+    def fake_process_data(*args, **kwargs):
+        raise ValueError("Could not decode the receipt image")
+
+    monkeypatch.setattr("worker.process_data", fake_process_data)
+    enqueue(queue, "job")
+
+    Worker(queue, "a").run_once()
+    job = queue.find_one({"_id": "job"})
+    assert job["status"] == "error"
+    assert "Could not decode" in job["error"]
+
+
+def test_gives_up_after_max_attempts(queue, monkeypatch):
+    """Test that a job that keeps killing workers is eventually failed"""
+    monkeypatch.setattr("worker.MAX_ATTEMPTS", 1)
+    enqueue(queue, "job")
+    queue.update_one({"_id": "job"}, {"$set": {"attempts": 1}})
+
+    Worker(queue, "a").run_once()
+    job = queue.find_one({"_id": "job"})
+    assert job["status"] == "error"
+    assert "Gave up" in job["error"]
@@ -0,0 +1,147 @@
+"""
+This module warms the ML client up before it takes traffic. Tesseract's
+language data is read into the page cache (or copied to a tmpfs), and a
+synthetic receipt goes through decoding, OCR, line re-reading and parsing
+so the OCR engine, its models and OpenCV are loaded before the first real
+receipt arrives. /ready reports ready only once this has finished
+"""
+
+# pylint: disable=no-member
+
+import glob
+import os
+import shutil
+import threading
+import time
+import cv2
+import numpy
+from analyzer import (
+    decode_image,
+    filter_dishes,
+    ocr_rows,
+    parse_processed_lines,
+    process_image,
+)
+import ocr_engines
+
+WARM_UP = os.getenv("OCR_WARM_UP", "1") == "1"
+TESSDATA_LANGUAGES = os.getenv("TESSDATA_LANGUAGES", "eng").split("+")
+# copy the language data here (e.g. /dev/shm/tessdata) instead of only
+# reading it into the page cache
+TESSDATA_TMPFS = os.getenv("TESSDATA_TMPFS")
+SYNTHETIC_LINES = ["PIZZA 12.50", "SODA 2.00", "SUBTOTAL 14.50", "TAX 1.45"]
+
+_state = {
+    "status": "starting" if WARM_UP else "ready",
+    "error": None,
+    "seconds": None,
+    "thread": None,
+}
+_lock = threading.Lock()
+
+
+def tessdata_dir():
+    """Directory Tesseract loads its language data from, if there is one"""
+    candidates = [os.getenv("TESSDATA_PREFIX")]
+    candidates += sorted(glob.glob("/usr/share/tesseract-ocr/*/tessdata"))
+    candidates += ["/usr/share/tessdata", "/usr/local/share/tessdata"]
+    for directory in candidates:
+        if directory and os.path.isdir(directory):
+            return directory
+    return None
+
+
+def preload_tessdata(languages=None, tmpfs=None):
+    """
+    Read the language data Tesseract loads on every call into memory. With
+    tmpfs, copy it there (with the configs OCR output needs) and point
+    Tesseract at the copy. Returns the names of the files loaded
+    """
+    languages = TESSDATA_LANGUAGES if languages is None else languages
+    tmpfs = TESSDATA_TMPFS if tmpfs is None else tmpfs
+    source = tessdata_dir()
+    if source is None:
+        return []
+
+    if tmpfs:
+        os.makedirs(tmpfs, exist_ok=True)
+    loaded = []
+    for language in languages:
+        name = f"{language}.traineddata"
+        path = os.path.join(source, name)
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as fp:
+            data = fp.read()
+        if tmpfs:
+            with open(os.path.join(tmpfs, name), "wb") as fp:
+                fp.write(data)
+        loaded.append(name)
+
+    if tmpfs and loaded:
+        configs = os.path.join(source, "configs")
+        if os.path.isdir(configs):
+            shutil.copytree(configs, os.path.join(tmpfs, "configs"), dirs_exist_ok=True)
+        # read by every tesseract process pytesseract starts from now on
+        os.environ["TESSDATA_PREFIX"] = tmpfs
+    return loaded
+
+
+def synthetic_receipt():
+    """PNG bytes of a small printed receipt"""
+    img = numpy.full((60 * len(SYNTHETIC_LINES) + 40, 480), 255, dtype=numpy.uint8)
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    for number, line in enumerate(SYNTHETIC_LINES):
+        cv2.putText(img, line, (20, 60 * (number + 1)), font, 1.2, 0, 2)
+    return cv2.imencode(".png", img)[1].tobytes()
+
+
+def warm_up(engines=None):
+    """
+    Preload the language data and read the synthetic receipt with every
+    engine given (the default one if None). Returns the seconds it took
+    """
+    began = time.perf_counter()
+    loaded = preload_tessdata()
+    if loaded:
+        print("Preloaded Tesseract data:", ", ".join(loaded))
+
+    gray_img = process_image(decode_image(synthetic_receipt()))
+    for name in engines or [ocr_engines.DEFAULT_ENGINE]:
+        with ocr_engines.selected(name):
+            lines = ocr_rows(gray_img, 0, gray_img.shape[0])
+        dishes, _ = filter_dishes(parse_processed_lines([l["text"] for l in lines]))
+        print(f"Warmed up the {name} OCR engine, dishes read:", len(dishes))
+    return time.perf_counter() - began
+
+
+def run():
+    """Warm up and record the outcome for the readiness probe"""
+    with _lock:
+        _state["status"] = "warming up"
+    try:
+        seconds = warm_up()
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        print("Warm-up failed:", e)
+        with _lock:
+            _state.update(status="failed", error=str(e))
+        return False
+    print(f"Warm-up done in {seconds:.1f}s")
+    with _lock:
+        _state.update(status="ready", error=None, seconds=round(seconds, 2))
+    return True
+
+
+def start():
+    """Warm up in a daemon thread, once per process"""
+    with _lock:
+        if _state["thread"] is not None:
+            return
+        _state["thread"] = threading.Thread(target=run, name="warm-up", daemon=True)
+        _state["thread"].start()
+
+
+def readiness():
+    """Warm-up status, error and duration"""
+    with _lock:
+        return {key: value for key, value in _state.items() if key != "thread"}
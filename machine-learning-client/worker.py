@@ -0,0 +1,192 @@
+"""
+Queue worker for the ML client. Instead of waiting for the web-app to post
+receipts, any number of these workers pull them from the shared ocr_jobs
+collection in MongoDB:
+
+    python worker.py
+
+A job is claimed atomically and leased to one worker, which keeps renewing
+the lease while it reads the receipt. If a worker dies, its lease runs out
+and another worker picks the job up again. Interactive receipts are claimed
+before bulk ones and, within a class, the one with the earliest deadline
+first. Tenant fairness is left to the scheduler of the HTTP server: a
+worker reads one receipt at a time and has no usage to weigh
+"""
+
+import io
+import os
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
+from analyzer import process_data, user_input_from_form
+from db import get_db
+import dedup
+import warmup
+
+QUEUE_COLLECTION = "ocr_jobs"
+LEASE_SECONDS = float(os.getenv("QUEUE_LEASE_SECONDS", "60"))
+POLL_INTERVAL = float(os.getenv("QUEUE_POLL_SECONDS", "0.5"))
+MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))
+FINISHED_TTL = 24 * 3600  # seconds finished jobs are kept in the queue
+
+QUEUE_INDEXES = [
+    (
+        [("status", 1), ("priority", 1), ("deadline", 1), ("enqueued_at", 1)],
+        {"name": "status_priority_deadline"},
+    ),
+    (
+        [("finished_at", 1)],
+        {"name": "finished_ttl", "expireAfterSeconds": FINISHED_TTL},
+    ),
+]
+
+
+def now():
+    """Current time in UTC"""
+    return datetime.now(timezone.utc)
+
+
+def ensure_indexes(collection):
+    """Indexes the claim query and the cleanup of finished jobs rely on"""
+    for keys, options in QUEUE_INDEXES:
+        collection.create_index(keys, **options)
+
+
+class Worker:
+    """Claims jobs from the queue collection and processes them one at a time"""
+
+    def __init__(self, collection, name=None, lease_seconds=LEASE_SECONDS):
+        self.collection = collection
+        self.name = name or f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+        self.lease = timedelta(seconds=lease_seconds)
+
+    def claim(self):
+        """
+        Lease the most urgent queued job, or a running one whose lease
+        expired: by priority class, then deadline, then age. Returns the
+        job, or None when the queue is empty
+        """
+        claimed_at = now()
+        return self.collection.find_one_and_update(
+            {
+                "$or": [
+                    {"status": "queued"},
+                    {"status": "running", "lease_until": {"$lt": claimed_at}},
+                ]
+            },
+            {
+                "$set": {
+                    "status": "running",
+                    "worker": self.name,
+                    "lease_until": claimed_at + self.lease,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("priority", 1), ("deadline", 1), ("enqueued_at", 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _update_own(self, job_id, update):
+        """Update a job only while this worker still holds its lease"""
+        result = self.collection.update_one(
+            {"_id": job_id, "worker": self.name, "status": "running"}, update
+        )
+        return result.modified_count == 1
+
+    def renew(self, job_id):
+        """Extend the lease of a job this worker is processing"""
+        return self._update_own(job_id, {"$set": {"lease_until": now() + self.lease}})
+
+    def finish(self, job_id, status, **fields):
+        """Record the outcome of a job and drop the receipt image"""
+        fields.update({"status": status, "finished_at": now(), "lease_until": None})
+        return self._update_own(job_id, {"$set": fields, "$unset": {"image": ""}})
+
+    def process(self, job):
+        """Read the receipt of a claimed job and record the outcome"""
+        if job.get("attempts", 1) > MAX_ATTEMPTS:
+            self.finish(
+                job["_id"],
+                "error",
+                error=f"Gave up on the receipt after {MAX_ATTEMPTS} attempts",
+            )
+            return
+
+        stop = threading.Event()
+
+        def keep_lease():
+            while not stop.wait(self.lease.total_seconds() / 3):
+                try:
+                    self.renew(job["_id"])
+                except PyMongoError as e:
+                    print("Could not renew lease:", e)
+
+        heartbeat = threading.Thread(target=keep_lease, daemon=True)
+        heartbeat.start()
+        try:
+            user_input = user_input_from_form(job["form"])
+            result = dedup.run_once(
+                user_input["idempotency_key"],
+                lambda: process_data(
+                    user_input,
+                    io.BytesIO(job["image"]),
+                    job["_id"],
+                    on_partial=lambda dishes: self._update_own(
+                        job["_id"], {"$set": {"dishes": dishes}}
+                    ),
+                ),
+            )
+            outcome = {"charge_info": result["charge_info"]}
+            if result.get("dishes") is not None:
+                outcome["dishes"] = result["dishes"]
+            self.finish(job["_id"], "done", **outcome)
+            print("Worker processed receipt:", job["_id"])
+        except PyMongoError:
+            # leave the job leased; another attempt starts when the lease ends
+            raise
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            print("Exception caught:", e)
+            self.finish(
+                job["_id"],
+                "error",
+                error=f"Error processing the receipt in the ML client: {e}",
+            )
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    def run_once(self):
+        """Process one job if there is one; returns whether a job was found"""
+        job = self.claim()
+        if job is None:
+            return False
+        self.process(job)
+        return True
+
+    def run(self):
+        """Process jobs until interrupted, polling while the queue is empty"""
+        print("Worker", self.name, "waiting for receipts")
+        while True:
+            try:
+                if self.run_once():
+                    continue
+            except PyMongoError as e:
+                print("Queue unavailable:", e)
+            time.sleep(POLL_INTERVAL)
+
+
+def main():
+    """Run a worker against the configured database"""
+    collection = get_db()[QUEUE_COLLECTION]
+    ensure_indexes(collection)
+    if warmup.WARM_UP:
+        warmup.run()  # before the first job is claimed
+    Worker(collection).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,31 @@
 db = db.getSiblingDB('dutch_pay');
 db.createCollection('receipts');
 db.createCollection('transactions');
+db.createCollection('merchants');
+db.createCollection('balances');
+db.createCollection('ocr_jobs');
 db.receipts.createIndex({ "timestamp": 1 });
 db.receipts.createIndex({ "status": 1 });
+// receipt history: equality on owner, sort on timestamp/_id, range on total
+db.receipts.createIndex(
+  { "owner_id": 1, "timestamp": -1, "_id": -1, "total": 1 },
+  { name: "owner_timestamp_total" }
+);
+db.receipts.createIndex(
+  { "owner_id": 1, "people": 1, "timestamp": -1, "_id": -1 },
+  { name: "owner_people_timestamp" }
+);
+// repeats of an upload are answered with the receipt stored for its key
+db.receipts.createIndex(
+  { "idempotency_key": 1, "timestamp": -1 },
+  { name: "idempotency_key", sparse: true }
+);
 db.transactions.createIndex({ "receipt_id": 1 });
+db.transactions.createIndex({ "group_id": 1, "debtor": 1 });
+// OCR queue: claim the oldest queued job, drop finished jobs after a day
+db.ocr_jobs.createIndex({ "status": 1, "enqueued_at": 1 }, { name: "status_enqueued" });
+db.ocr_jobs.createIndex(
+  { "finished_at": 1 },
+  { name: "finished_ttl", expireAfterSeconds: 86400 }
+);
 print("Database initialization completed!");
@@ -1,18 +1,123 @@
 """Flask application for GoDutch - Receipt Splitter"""
 
 import os
+import json
+import re
+import secrets
+import struct
+import time
+import uuid
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import certifi
-from flask import Flask, render_template, request, session, redirect, url_for
+import msgspec
+from flask import (
+    Flask,
+    Response,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    session,
+    url_for,
+)
+from pymongo.errors import PyMongoError
 from pymongo.mongo_client import MongoClient
 from pymongo.server_api import ServerApi
 from dotenv import load_dotenv
 import requests
+from bson.errors import InvalidDocument
 from bson.objectid import ObjectId
+import jobs
+import storage
+import history
+import ml_queue
+import local_transport
 
 load_dotenv()
 
+MAX_POLL_WAIT = 30  # seconds a /result/status long-poll may block
+RESULT_PAGE_MAX_AGE = 24 * 3600  # seconds browsers may cache a result page
+MAX_EVENT_STREAM = 120  # seconds before an event stream asks for a reconnect
+KEEPALIVE_INTERVAL = 15  # seconds between event stream keepalive comments
+ML_STREAM_MIMETYPE = "application/x-ndjson"
+ML_MSGPACK_STREAM_MIMETYPE = "application/x-msgpack-stream"
+ML_MSGPACK_MIMETYPE = "application/x-msgpack"
+# result pages are shared by a random token, never by the guessable receipt id
+SHARE_TOKEN_BYTES = 16
+SHARE_TOKEN_PATTERN = re.compile(r"[A-Za-z0-9_-]{16,64}")
+# running tabs are kept under random group ids handed out here; a session
+# may only add receipts to the groups it created or joined by their link
+GROUP_ID_BYTES = 16
+MAX_SESSION_GROUPS = 20
 
-def app_setup():  # pylint: disable=too-many-statements
+msgpack_decoder = msgspec.msgpack.Decoder()
+
+
+def iter_frames(chunks):
+    """
+    Split a byte stream into the MessagePack messages it carries, each
+    prefixed with its length (4 bytes, big endian)
+    """
+    buffer = b""
+    for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= 4:
+            (size,) = struct.unpack(">I", buffer[:4])
+            if len(buffer) < 4 + size:
+                break
+            yield msgpack_decoder.decode(buffer[4 : 4 + size])
+            buffer = buffer[4 + size :]
+    if buffer:
+        raise ValueError("Truncated message from the ML client")
+
+
+def iter_updates(res):
+    """Messages of a streamed ML client answer, whichever the encoding"""
+    mimetype = res.headers.get("Content-Type", "").split(";")[0].strip()
+    if mimetype == ML_MSGPACK_STREAM_MIMETYPE:
+        yield from iter_frames(res.iter_content(chunk_size=None))
+        return
+    for line in res.iter_lines():
+        if line:
+            yield json.loads(line)
+
+
+def read_ml_response(result_id, res):
+    """
+    Read the ML client's answer. Streamed answers carry partial dishes,
+    which are attached to the job, before the final result
+    """
+    mimetype = res.headers.get("Content-Type", "").split(";")[0].strip()
+    if mimetype == ML_MSGPACK_MIMETYPE:
+        return msgpack_decoder.decode(res.content)
+    if mimetype not in (ML_STREAM_MIMETYPE, ML_MSGPACK_STREAM_MIMETYPE):
+        return res.json()
+
+    outcome = {"status": "error", "message": "The ML client stopped responding"}
+    for update in iter_updates(res):
+        if update.get("status") == "partial":
+            jobs.update_job(result_id, dishes=update["dishes"])
+        else:
+            outcome = update
+    print("Response from ML client:", outcome.get("status"))
+    return outcome
+
+
+def client_image_size(form):
+    """
+    (width, height) of the photo before the browser downscaled it, or None
+    when the form does not carry a valid size
+    """
+    try:
+        size = (int(form["original-width"]), int(form["original-height"]))
+    except (KeyError, ValueError):
+        return None
+    return size if min(size) > 0 else None
+
+
+def app_setup():  # pylint: disable=too-many-statements,too-many-locals
     """setup the app"""
     uri = os.getenv("MONGO_URI")
     client = MongoClient(  # pylint: disable=unused-variable
@@ -23,11 +128,117 @@ def app_setup():  # pylint: disable=too-many-statements
     app.config["MAX_CONTENT_LENGTH"] = 16 * 1024 * 1024  # 16 MB
     app.secret_key = os.getenv("SECRET_KEY", "godutch-development-key")
 
-    os.makedirs(os.path.join(app.static_folder, "uploads"), exist_ok=True)
+    upload_dir = os.getenv("UPLOAD_DIR", os.path.join(app.static_folder, "uploads"))
+    os.makedirs(upload_dir, exist_ok=True)
+    app.config["UPLOAD_DIR"] = upload_dir
+
+    # Keep the uploads volume bounded by age and size
+    sweep_minutes = float(os.getenv("UPLOAD_SWEEP_MINUTES", "30"))
+    if sweep_minutes > 0:
+        storage.start_sweeper(
+            upload_dir,
+            sweep_minutes * 60,
+            float(os.getenv("UPLOAD_MAX_AGE_HOURS", "72")) * 3600,
+            float(os.getenv("UPLOAD_MAX_MB", "1024")) * 1024 * 1024,
+        )
+    recompress_uploads = os.getenv("UPLOAD_RECOMPRESS", "1") == "1"
+    # uploads are copied here as a replay corpus for the load-test harness
+    record_dir = os.getenv("UPLOAD_RECORD_DIR")
+    ml_port = os.getenv("ML_CLIENT_PORT", "4999")
+    # "http" posts each receipt to one ML client; "queue" leaves it in MongoDB
+    # for any number of ML client queue workers; "local" hands it to an ML
+    # client on this host through the ML_SOCKET Unix socket, and falls back
+    # to http while nothing listens there
+    ml_transport = os.getenv("ML_TRANSPORT", "http")
+    ml_socket = os.getenv("ML_SOCKET")
+    local_session = None
+    if ml_transport == "local" and ml_socket:
+        local_session = local_transport.unix_session(ml_socket)
 
     # Get DB connection
     db = client[dbname]
 
+    def recompress_upload(result_id, digest):
+        """Shrink the stored original once OCR is done with it"""
+        if recompress_uploads:
+            storage.recompress(upload_dir, digest, result_id)
+
+    def render_result(result_id, share_token=None):
+        """The result page of a receipt as HTML, or None if it has no result"""
+        # the ML client hands back the charges of receipts processed here;
+        # anything else comes from the database
+        job = jobs.get_job(result_id)
+        if job is not None and job.get("charge_info") is not None:
+            result_data = {
+                "charge_info": job["charge_info"],
+                "dishes": job.get("dishes") or [],
+            }
+        else:
+            result_data = db.receipts.find_one(
+                {"_id": ObjectId(result_id), "charge_info": {"$exists": True}}
+            )
+        if not result_data:
+            return None
+
+        # reformat the data
+        new_charge_info = []
+        for person in result_data["charge_info"]:
+            a = {"name": person, "total": result_data["charge_info"][person]}
+            new_charge_info.append(a)
+
+        result_data["charge_info"] = new_charge_info
+        result_data["share_token"] = share_token
+        return render_template("result.html", data=result_data)
+
+    def result_page(result_id, share_token):
+        """
+        Path of the rendered result page of a receipt, stored under its
+        share token and rendered first if needed; None if it has no result
+        """
+        path = storage.page_path(upload_dir, share_token)
+        if os.path.exists(path):
+            return path
+        html = render_result(result_id, share_token)
+        if html is None:
+            return None
+        return storage.store_page(upload_dir, share_token, html.encode("utf-8"))
+
+    def receipt_done(result_id, digest):
+        """
+        Render the result page as soon as a receipt is done, so every view
+        is a static file, then shrink the stored original
+        """
+        job = jobs.get_job(result_id)
+        try:
+            if job is not None and job.get("share_token"):
+                with app.test_request_context(f"/r/{job['share_token']}"):
+                    result_page(result_id, job["share_token"])
+        except (OSError, PyMongoError) as e:
+            print("Could not render the result page:", e)
+        recompress_upload(result_id, digest)
+
+    def send_result_page(path, shared=True):
+        """
+        A stored result page, revalidated by ETag. Pages under their own
+        /r/<id> URL may be cached by anyone; a page served for the session
+        (/result) is kept out of shared caches
+        """
+        if shared:
+            return send_file(
+                path, mimetype="text/html", max_age=RESULT_PAGE_MAX_AGE, etag=True
+            )
+        response = send_file(path, mimetype="text/html", etag=True)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    follower = ml_queue.QueueFollower(db.ocr_jobs, on_done=receipt_done)
+    if ml_transport == "queue":
+        follower.start()
+
+    # Receipts are sent to the ML client from here so uploads return at once
+    executor = ThreadPoolExecutor(max_workers=int(os.getenv("UPLOAD_WORKERS", "4")))
+
     @app.route("/", methods=("GET", "POST"))
     def show_dashboard():
         """
@@ -38,13 +249,50 @@ def app_setup():  # pylint: disable=too-many-statements
         if request.method == "GET":
             data = {"filler": "filler"}
 
-        return render_template("index.html", data=data)
+        groups = [
+            (group_id, url_for("join_group", group_id=group_id, _external=True))
+            for group_id in session.get("groups", [])
+        ]
+        return render_template("index.html", data=data, groups=groups)
+
+    def add_session_group(group_id):
+        """Let this session add receipts to the group's running tab"""
+        groups = [known for known in session.get("groups", []) if known != group_id]
+        session["groups"] = (groups + [group_id])[-MAX_SESSION_GROUPS:]
+
+    def session_group(requested):
+        """
+        The group an upload asks for: None for no group, a new random id
+        for "new", else one this session created or joined. Raises
+        ValueError for any other group
+        """
+        if not requested:
+            return None
+        if requested == "new":
+            group_id = secrets.token_urlsafe(GROUP_ID_BYTES)
+            add_session_group(group_id)
+            return group_id
+        if requested not in session.get("groups", []):
+            raise ValueError("Unknown group, open its link to join it first")
+        return requested
+
+    @app.route("/groups/<group_id>", methods=["GET"])
+    def join_group(group_id):
+        """
+        Link to a group's running tab, shared by whoever started it; opening
+        it lets this session add receipts to the tab
+        """
+        if not SHARE_TOKEN_PATTERN.fullmatch(group_id):
+            return ("No such group", 404)
+        add_session_group(group_id)
+        return redirect(url_for("show_dashboard"))
 
     @app.route("/upload", methods=("GET", "POST"))
-    def upload():  # pylint: disable=too-many-return-statements
+    def upload():  # pylint: disable=too-many-return-statements,too-many-branches
         """
         Handle form submission when receipt is uploaded
         """
+        # pylint: disable=too-many-statements
 
         data = []
         # Debugging
@@ -104,49 +352,233 @@ def app_setup():  # pylint: disable=too-many-statements
                 )
             )
 
+        # optional running tab: who paid, and which group to keep the tab for;
+        # ocr-engine picks the ML client's OCR engine for this receipt
+        for field in ("payer", "ocr-engine"):
+            if request.form.get(field, "").strip():
+                data.append((field, request.form[field].strip()))
+        try:
+            group_id = session_group(request.form.get("group", "").strip())
+        except ValueError as e:
+            return (str(e), 400)
+        if group_id:
+            data.append(("group", group_id))
+
+        # the upload page sends a downscaled grayscale copy of the photo;
+        # the size it was taken at is recorded with the receipt
+        original_size = client_image_size(request.form)
+        if original_size is not None:
+            data.append(("original-width", original_size[0]))
+            data.append(("original-height", original_size[1]))
+
         # Debugging
         print("Payload data being sent to ML client:", data)
         print("Receipt file name:", receipt_file.filename)
 
-        files = {
-            "receipt": (
-                receipt_file.filename,
-                receipt_file.stream,
-                receipt_file.mimetype,
+        # Hand the receipt to a background worker and answer right away; the
+        # pending page follows the job through /result/events or /result/status
+        result_id = str(ObjectId())
+        # receipts are grouped by session for the history view
+        if "owner_id" not in session:
+            session["owner_id"] = uuid.uuid4().hex
+        receipt = (receipt_file.filename, receipt_file.read(), receipt_file.mimetype)
+        if ml_transport == "queue" and len(receipt[1]) > ml_queue.MAX_IMAGE_BYTES:
+            limit = ml_queue.MAX_IMAGE_BYTES / (1024 * 1024)
+            return (f"Receipt image too large, the limit is {limit:g} MB", 413)
+
+        # a double-click or browser retry follows the upload already sent
+        key = jobs.request_key(session["owner_id"], receipt[1], data)
+        job_id = jobs.create_job_once(
+            key, result_id, secrets.token_urlsafe(SHARE_TOKEN_BYTES)
+        )
+        session["result_id"] = job_id
+        session["share_token"] = jobs.get_job(job_id)["share_token"]
+        if job_id != result_id:
+            print("Repeated upload, following receipt", job_id)
+            return render_template("pending.html"), 202
+
+        data.append(("receipt-id", result_id))
+        data.append(("owner-id", session["owner_id"]))
+        data.append(("idempotency-key", key))
+        try:
+            start_receipt(result_id, data, receipt)
+        except Exception as e:
+            # a retry of the same upload must not follow a job nobody works on
+            jobs.finish_job(result_id, "error", error=f"Could not store receipt: {e}")
+            raise
+        return render_template("pending.html"), 202
+
+    def start_receipt(result_id, data, receipt):
+        """Store the upload and hand the receipt to the ML client"""
+        digest = storage.store_upload(upload_dir, receipt[1], result_id, receipt[0])
+        if record_dir:
+            storage.record_upload(
+                record_dir, result_id, request.form, receipt[0], receipt[1]
             )
-        }
+        if ml_transport == "queue":
+            queue_receipt(result_id, data, receipt, digest)
+        else:
+            executor.submit(send_to_ml_client, result_id, data, receipt, digest)
 
+    def queue_receipt(result_id, data, receipt, digest):
+        """Leave the receipt in the queue for the ML client workers"""
+        # a document over MongoDB's size limit raises DocumentTooLarge, an
+        # InvalidDocument rather than a PyMongoError
         try:
-            host = os.getenv("ML_CLIENT")
-            if host is None:
-                host = "127.0.0.1"
-            res = requests.post(
-                "http://" + host + ":4999/submit", data=data, files=files, timeout=60
+            ml_queue.enqueue(db.ocr_jobs, result_id, data, receipt)
+            follower.follow(result_id, digest)
+        except (PyMongoError, InvalidDocument) as e:
+            jobs.finish_job(
+                result_id, "error", error=f"Could not queue the receipt: {e}"
             )
-            if res.status_code == 200:
-                # print("received successful response from ML client")
-                print("Response status code from ML client:", res.status_code)
-                print("Response text from ML client:", res.text)
-                # Store the result ID in session
-                result_data = res.json()
-                session["result_id"] = result_data.get("result_id")
-                # Redirect to results page
-                return redirect(url_for("result"))
 
-            return (
-                f"Error processing receipt: {res.text}",
-                400,
+    def send_to_ml_client(result_id, data, receipt, digest):
+        """
+        Post the receipt to the ML client and record the outcome of the job;
+        the stored original is recompressed once OCR is done with it
+        """
+        files = {"receipt": receipt}
+        # ask for a stream so the dishes found so far reach the browser
+        headers = {"Accept": ML_MSGPACK_STREAM_MIMETYPE}
+
+        try:
+            res = None
+            if local_session is not None and local_transport.available(ml_socket):
+                # the ML client reads the image from the shared uploads volume
+                image = storage.ref_path(upload_dir, result_id)
+                try:
+                    res = local_session.post(
+                        local_transport.LOCAL_URL + "/submit-local",
+                        json={
+                            "form": {key: str(value) for key, value in data},
+                            "image": os.path.relpath(image, upload_dir),
+                        },
+                        headers=headers,
+                        stream=True,
+                        timeout=60,
+                    )
+                except requests.ConnectionError as e:
+                    # a socket file left behind by an ML client that stopped
+                    print("Nothing listens on the ML socket, posting over HTTP:", e)
+            if res is None:
+                host = os.getenv("ML_CLIENT")
+                if host is None:
+                    host = "127.0.0.1"
+                res = requests.post(
+                    "http://" + host + ":" + ml_port + "/submit",
+                    data=data,
+                    files=files,
+                    headers=headers,
+                    stream=True,
+                    timeout=60,
+                )
+            print("Response status code from ML client:", res.status_code)
+            if res.status_code != 200:
+                print("Response text from ML client:", res.text)
+                jobs.finish_job(
+                    result_id, "error", error=f"Error processing receipt: {res.text}"
+                )
+                return
+            outcome = read_ml_response(result_id, res)
+            if outcome.get("status") != "success":
+                jobs.finish_job(
+                    result_id,
+                    "error",
+                    error=f"Error processing receipt: {outcome.get('message')}",
+                )
+                return
+            jobs.finish_job(
+                result_id,
+                "done",
+                charge_info=outcome.get("charge_info"),
+                dishes=outcome.get("dishes"),
             )
+            receipt_done(result_id, digest)
         except requests.RequestException as req_error:
             error_msg = "Error connecting to ML client - ensure ML client is running "
-            error_msg += f"properly on port 4999: {str(req_error)}"
-            return (
-                error_msg,
-                400,
+            error_msg += f"properly on port {ml_port}: {str(req_error)}"
+            jobs.finish_job(result_id, "error", error=error_msg)
+        except ValueError as parse_error:
+            jobs.finish_job(
+                result_id,
+                "error",
+                error=f"Invalid response from ML client: {parse_error}",
             )
 
+    def receipt_status(result_id):
+        """
+        Current status of a receipt; falls back to the DB for receipts this
+        process does not know about (e.g. submitted through another worker)
+        """
+        job = jobs.get_job(result_id)
+        if job is not None:
+            status = {"status": job["status"], "error": job.get("error")}
+            if job["status"] == "pending" and job.get("dishes"):
+                status["dishes"] = job["dishes"]
+            return status
+
+        result_data = db.receipts.find_one(
+            {"_id": ObjectId(result_id)}, {"status": 1, "charge_info": 1}
+        )
+        if not result_data:
+            return {"status": "unknown", "error": None}
+        if "charge_info" in result_data:
+            return {"status": "done", "error": None}
+        return {"status": result_data.get("status", "pending"), "error": None}
+
+    @app.route("/result/status", methods=["GET"])
+    def result_status():
+        """
+        Long-poll for the status of the receipt in the session; waits up to
+        `wait` seconds for a pending receipt to finish, or to report more
+        than `seen` dishes
+        """
+        result_id = session.get("result_id")
+        if not result_id:
+            return ("No result_id found in session", 400)
+
+        wait = min(request.args.get("wait", 0, type=float), MAX_POLL_WAIT)
+        if wait > 0:
+            jobs.wait_for_job(result_id, wait, request.args.get("seen", type=int))
+        return jsonify(receipt_status(result_id))
+
+    @app.route("/result/events", methods=["GET"])
+    def result_events():
+        """
+        Server-sent events stream that emits the dishes found so far while
+        the receipt is read, then its status once it leaves the pending state
+        """
+        result_id = session.get("result_id")
+        if not result_id:
+            return ("No result_id found in session", 400)
+
+        def stream():
+            deadline = time.monotonic() + MAX_EVENT_STREAM
+            seen = 0
+            while True:
+                status = receipt_status(result_id)
+                if status["status"] != "pending":
+                    yield f"event: status\ndata: {json.dumps(status)}\n\n"
+                    return
+                dishes = status.get("dishes", [])
+                if len(dishes) > seen:
+                    seen = len(dishes)
+                    yield f"event: partial\ndata: {json.dumps(dishes)}\n\n"
+                elif time.monotonic() > deadline:
+                    # let the browser reconnect instead of holding the worker
+                    return
+                else:
+                    yield ": keepalive\n\n"
+                jobs.wait_for_job(result_id, KEEPALIVE_INTERVAL, seen)
+
+        return Response(
+            stream(),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
     @app.route("/result", methods=["GET"])
-    def result():
+    def result():  # pylint: disable=too-many-return-statements
         """
         Display results of data analysis
         """
@@ -156,28 +588,104 @@ def app_setup():  # pylint: disable=too-many-statements
         if not result_id:
             return ("No result_id found in session", 400)
 
-        # get the results data from the database
-        result_data = db.receipts.find_one(
-            {"_id": ObjectId(result_id), "charge_info": {"$exists": True}}
-        )
-        print(result_data)
-        if not result_data:
+        job = jobs.get_job(result_id)
+        if job is not None and job["status"] == "pending":
+            return render_template("pending.html")
+        if job is not None and job["status"] == "error":
+            return (job["error"], 400)
+
+        share_token = session.get("share_token")
+        if share_token:
+            path = result_page(result_id, share_token)
+            if path is None:
+                return ("No results found", 404)
+            return send_result_page(path, shared=False)
+
+        # receipts uploaded before share tokens existed are not stored
+        html = render_result(result_id)
+        if html is None:
             return ("No results found", 404)
+        return html, 200, {"Cache-Control": "no-cache, private"}
 
-        # reformat the data
-        new_charge_info = []
-        for person in result_data["charge_info"]:
-            a = {"name": person, "total": result_data["charge_info"][person]}
-            new_charge_info.append(a)
+    @app.route("/r/<share_token>", methods=["GET"])
+    def shared_result(share_token):
+        """
+        Result page of a receipt by its share token, for sharing with
+        everyone at the table
+        """
+        if not SHARE_TOKEN_PATTERN.fullmatch(share_token):
+            return ("No results found", 404)
+        path = storage.page_path(upload_dir, share_token)
+        if os.path.exists(path):
+            return send_result_page(path)
 
-        result_data["charge_info"] = new_charge_info
+        # only receipts this process is still tracking can be rendered now
+        shared = jobs.find_shared_job(share_token)
+        if shared is None:
+            return ("No results found", 404)
+        result_id, job = shared
+        if job["status"] == "pending":
+            return ("The receipt is still being read", 202, {"Retry-After": "2"})
+        path = result_page(result_id, share_token)
+        if path is None:
+            return ("No results found", 404)
+        return send_result_page(path)
 
-        # return the results HTML page
-        return render_template("result.html", data=result_data)
+    @app.route("/history", methods=["GET"])
+    def receipt_history():
+        """
+        Receipts of this session, newest first. Optional filters: start and
+        end (ISO dates), person, min_total, max_total; pages are chained with
+        the returned cursor
+        """
+        owner_id = session.get("owner_id")
+        if not owner_id:
+            return ("No receipts found in session", 400)
+
+        try:
+            filters = {
+                "start": parse_date(request.args.get("start")),
+                "end": parse_date(request.args.get("end")),
+                "person": request.args.get("person"),
+                "min_total": request.args.get("min_total", type=float),
+                "max_total": request.args.get("max_total", type=float),
+            }
+            history.ensure_indexes(db.receipts)
+            receipts, next_cursor = history.find_receipts(
+                db.receipts,
+                owner_id,
+                filters,
+                request.args.get("cursor"),
+                request.args.get("limit", history.PAGE_SIZE, type=int),
+            )
+        except ValueError as e:
+            return (f"Invalid history query: {str(e)}", 400)
+
+        return jsonify(
+            {
+                "receipts": [
+                    {
+                        "result_id": str(receipt["_id"]),
+                        "timestamp": receipt["timestamp"].isoformat(),
+                        "total": receipt.get("total"),
+                        "charge_info": receipt.get("charge_info"),
+                    }
+                    for receipt in receipts
+                ],
+                "next": next_cursor,
+            }
+        )
 
     return app
 
 
+def parse_date(value):
+    """Parse an optional ISO date or datetime query argument"""
+    if not value:
+        return None
+    return datetime.fromisoformat(value)
+
+
 my_app = app_setup()
 
 if __name__ == "__main__":
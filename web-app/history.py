@@ -0,0 +1,120 @@
+"""
+This module answers receipt history queries for a web-app session. Every
+query is shaped to match one of the compound indexes below, and pages are
+chained with an opaque cursor instead of skip/limit
+"""
+
+import base64
+from datetime import datetime
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Equality (owner), then sort (timestamp, _id), then range (total)
+HISTORY_INDEXES = [
+    (
+        [("owner_id", 1), ("timestamp", -1), ("_id", -1), ("total", 1)],
+        "owner_timestamp_total",
+    ),
+    (
+        [("owner_id", 1), ("people", 1), ("timestamp", -1), ("_id", -1)],
+        "owner_people_timestamp",
+    ),
+]
+HISTORY_PROJECTION = {
+    "timestamp": 1,
+    "people": 1,
+    "total": 1,
+    "charge_info": 1,
+}
+HISTORY_SORT = [("timestamp", -1), ("_id", -1)]
+
+_indexed = set()
+
+
+def ensure_indexes(collection):
+    """Create the history indexes once per collection and process"""
+    if collection.full_name in _indexed:
+        return
+    for keys, name in HISTORY_INDEXES:
+        collection.create_index(keys, name=name)
+    _indexed.add(collection.full_name)
+
+
+def encode_cursor(document):
+    """Opaque cursor pointing just after the given document"""
+    raw = f"{document['timestamp'].isoformat()}|{document['_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (timestamp, _id); raises ValueError if invalid"""
+    try:
+        timestamp, object_id = base64.urlsafe_b64decode(cursor).decode().split("|")
+        return datetime.fromisoformat(timestamp), ObjectId(object_id)
+    except (ValueError, InvalidId) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def build_query(owner_id, filters=None, cursor=None):
+    """
+    Build the history query for an owner. filters may hold start, end
+    (datetimes), person (name), min_total and max_total
+    """
+    filters = filters or {}
+    query = {"owner_id": owner_id}
+
+    if filters.get("person"):
+        query["people"] = filters["person"].strip().lower()
+
+    timestamp = {}
+    if filters.get("start") is not None:
+        timestamp["$gte"] = filters["start"]
+    if filters.get("end") is not None:
+        timestamp["$lt"] = filters["end"]
+    if timestamp:
+        query["timestamp"] = timestamp
+
+    total = {}
+    if filters.get("min_total") is not None:
+        total["$gte"] = filters["min_total"]
+    if filters.get("max_total") is not None:
+        total["$lte"] = filters["max_total"]
+    if total:
+        query["total"] = total
+
+    if cursor:
+        after_timestamp, after_id = decode_cursor(cursor)
+        query = {
+            "$and": [
+                query,
+                {
+                    "$or": [
+                        {"timestamp": {"$lt": after_timestamp}},
+                        {"timestamp": after_timestamp, "_id": {"$lt": after_id}},
+                    ]
+                },
+            ]
+        }
+    return query
+
+
+def find_receipts(collection, owner_id, filters=None, cursor=None, limit=PAGE_SIZE):
+    """
+    Return one page of an owner's receipts, newest first, and the cursor of
+    the next page (None on the last page)
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    documents = list(
+        collection.find(build_query(owner_id, filters, cursor), HISTORY_PROJECTION)
+        .sort(HISTORY_SORT)
+        .limit(limit + 1)
+    )
+
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor(documents[-1])
+    return documents, next_cursor
@@ -0,0 +1,128 @@
+"""
+This module keeps track of receipts that are being processed by the ML client
+so the web-app can answer status requests without blocking on the upload
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+JOB_TTL = 600  # seconds a finished job is kept around for status lookups
+DEDUP_WINDOW = 600  # seconds a repeated upload is answered with the first job
+
+_jobs = {}
+_keys = {}
+_condition = threading.Condition()
+
+
+def _prune_finished(now):
+    """Forget finished jobs older than JOB_TTL (caller holds the lock)"""
+    expired = [
+        job_id
+        for job_id, job in _jobs.items()
+        if job["status"] != "pending" and now - job["finished_at"] > JOB_TTL
+    ]
+    for job_id in expired:
+        del _jobs[job_id]
+    for key in [
+        key for key, (_, created) in _keys.items() if now - created > DEDUP_WINDOW
+    ]:
+        del _keys[key]
+
+
+def create_job(job_id, share_token=None):
+    """Register a new pending job, with the token its result is shared by"""
+    with _condition:
+        _prune_finished(time.time())
+        _jobs[job_id] = {
+            "status": "pending",
+            "finished_at": None,
+            "share_token": share_token,
+        }
+
+
+def request_key(owner_id, image, fields):
+    """Idempotency key of an upload: who sent it, the image and the form"""
+    digest = hashlib.sha256()
+    digest.update(owner_id.encode())
+    digest.update(hashlib.sha256(image).digest())
+    digest.update(json.dumps(sorted(fields), default=str).encode())
+    return digest.hexdigest()
+
+
+def create_job_once(key, job_id, share_token=None):
+    """
+    Register a new pending job for an idempotency key and return its id,
+    unless a recent job with the same key is pending or done: then that
+    job's id is returned and no job is created
+    """
+    with _condition:
+        now = time.time()
+        _prune_finished(now)
+        if key in _keys:
+            existing = _jobs.get(_keys[key][0])
+            if existing is not None and existing["status"] != "error":
+                return _keys[key][0]
+        _keys[key] = (job_id, now)
+        _jobs[job_id] = {
+            "status": "pending",
+            "finished_at": None,
+            "share_token": share_token,
+        }
+        return job_id
+
+
+def update_job(job_id, **fields):
+    """Attach partial results to a pending job and wake up its watchers"""
+    with _condition:
+        job = _jobs.get(job_id)
+        if job is None or job["status"] != "pending":
+            return
+        job.update(fields)
+        _condition.notify_all()
+
+
+def finish_job(job_id, status, **fields):
+    """Mark a job as done or failed and wake up everyone waiting on it"""
+    with _condition:
+        job = _jobs.setdefault(job_id, {})
+        job.update(fields)
+        job["status"] = status
+        job["finished_at"] = time.time()
+        _condition.notify_all()
+
+
+def get_job(job_id):
+    """Return a copy of the job state, or None if the job is unknown"""
+    with _condition:
+        job = _jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+
+def find_shared_job(share_token):
+    """Return the id and a copy of the job shared by a token, or None"""
+    with _condition:
+        for job_id, job in _jobs.items():
+            if share_token and job.get("share_token") == share_token:
+                return job_id, dict(job)
+        return None
+
+
+def wait_for_job(job_id, timeout, seen_dishes=None):
+    """
+    Block until the job leaves the pending state or the timeout expires,
+    then return its current state (None if the job is unknown). With
+    seen_dishes, also return as soon as the job has more partial dishes
+    """
+
+    def changed():
+        job = _jobs.get(job_id)
+        if job is None or job["status"] != "pending":
+            return True
+        return seen_dishes is not None and len(job.get("dishes", [])) > seen_dishes
+
+    with _condition:
+        _condition.wait_for(changed, timeout=timeout)
+        job = _jobs.get(job_id)
+        return dict(job) if job is not None else None
@@ -0,0 +1,76 @@
+"""
+This module lets the web-app talk to an ML client on the same host over a
+Unix domain socket instead of the network. The receipt image is already on
+the uploads volume both services mount, so only its path and the form
+fields are sent, not a multipart copy of the image
+"""
+
+import os
+import socket
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+# the host part of URLs sent over the socket; only the path matters
+LOCAL_URL = "http://ml-client"
+
+
+class UnixConnection(HTTPConnection):
+    """HTTP connection over a Unix domain socket"""
+
+    def __init__(self, *args, socket_path=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError as e:
+            sock.close()
+            raise NewConnectionError(
+                self, f"Failed to connect to {self.socket_path}: {e}"
+            ) from e
+        return sock
+
+
+class UnixConnectionPool(HTTPConnectionPool):
+    """Connection pool whose connections all go to one Unix socket"""
+
+    ConnectionCls = UnixConnection
+
+
+class UnixSocketAdapter(HTTPAdapter):
+    """Transport adapter sending every request of a session to a Unix socket"""
+
+    def __init__(self, socket_path, **kwargs):
+        super().__init__(**kwargs)
+        self.socket_path = socket_path
+        self._pool = UnixConnectionPool(
+            "localhost", maxsize=self._pool_maxsize, socket_path=socket_path
+        )
+
+    def get_connection_with_tls_context(
+        self, request, verify, proxies=None, cert=None
+    ):  # pylint: disable=unused-argument
+        return self._pool
+
+    def close(self):
+        self._pool.close()
+        super().close()
+
+
+def unix_session(socket_path):
+    """A requests session that talks to the server on the given socket"""
+    session = requests.Session()
+    session.mount("http://", UnixSocketAdapter(socket_path))
+    return session
+
+
+def available(socket_path):
+    """Whether a co-located ML client is listening on the socket"""
+    return bool(socket_path) and os.path.exists(socket_path)
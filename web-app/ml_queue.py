@@ -0,0 +1,138 @@
+"""
+This module hands receipts to the ML client through the shared ocr_jobs
+collection instead of posting them to a single ML client host, so OCR can
+be scaled out by running more queue workers. A follower thread mirrors the
+progress of queued receipts into the in-process job registry. Workers
+claim interactive receipts before bulk ones and, within a class, the
+earliest deadline first; the per-tenant fairness of the ML client's
+scheduler does not apply to queued receipts
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from bson.binary import Binary
+from pymongo.errors import PyMongoError
+import jobs
+
+QUEUE_TIMEOUT = 300  # seconds before a queued receipt is reported as failed
+# images are stored in the queue document, which MongoDB caps at 16 MB
+# together with the form fields
+MAX_IMAGE_BYTES = int(float(os.getenv("QUEUE_MAX_IMAGE_MB", "12")) * 1024 * 1024)
+# same classes and default deadlines as the ML client's scheduler
+PRIORITIES = {"interactive": 0, "bulk": 1}
+DEADLINES = {"interactive": 30, "bulk": 600}
+
+
+def queue_order(form, enqueued_at):
+    """Priority rank and deadline the workers claim a receipt in"""
+    priority = form.get("priority")
+    if priority not in PRIORITIES:
+        priority = "interactive"
+    try:
+        seconds = float(form["deadline"])
+    except (KeyError, ValueError):
+        seconds = 0
+    if seconds <= 0:
+        seconds = DEADLINES[priority]
+    return PRIORITIES[priority], enqueued_at + timedelta(seconds=seconds)
+
+
+def enqueue(collection, result_id, data, receipt):
+    """Queue a receipt; data holds the form fields, receipt the file tuple"""
+    filename, image = receipt[0], receipt[1]
+    form = {key: str(value) for key, value in data}
+    enqueued_at = datetime.now(timezone.utc)
+    priority, deadline = queue_order(form, enqueued_at)
+    collection.insert_one(
+        {
+            "_id": result_id,
+            "status": "queued",
+            "form": form,
+            "image": Binary(image),
+            "filename": filename,
+            "attempts": 0,
+            "priority": priority,
+            "deadline": deadline,
+            "enqueued_at": enqueued_at,
+        }
+    )
+
+
+class QueueFollower:
+    """
+    Polls the queue for the receipts this process enqueued and reports their
+    partial dishes and outcome to the job registry
+    """
+
+    def __init__(self, collection, interval=0.5, on_done=None):
+        self.collection = collection
+        self.interval = interval
+        self.on_done = on_done
+        self._followed = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def follow(self, result_id, digest=None):
+        """Start reporting the progress of a queued receipt"""
+        with self._lock:
+            self._followed[result_id] = (time.monotonic(), digest)
+
+    def start(self):
+        """Poll the queue in a daemon thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="queue-follower", daemon=True
+            )
+            self._thread.start()
+
+    def poll(self):
+        """Check every followed receipt once"""
+        with self._lock:
+            followed = dict(self._followed)
+        if not followed:
+            return
+
+        projection = {"status": 1, "dishes": 1, "charge_info": 1, "error": 1}
+        found = {
+            doc["_id"]: doc
+            for doc in self.collection.find(
+                {"_id": {"$in": list(followed)}}, projection
+            )
+        }
+        for result_id, (since, digest) in followed.items():
+            doc = found.get(result_id)
+            if doc is not None and doc["status"] == "done":
+                jobs.finish_job(
+                    result_id,
+                    "done",
+                    charge_info=doc.get("charge_info"),
+                    dishes=doc.get("dishes"),
+                )
+                if self.on_done is not None:
+                    self.on_done(result_id, digest)
+            elif doc is not None and doc["status"] == "error":
+                jobs.finish_job(
+                    result_id,
+                    "error",
+                    error=f"Error processing receipt: {doc['error']}",
+                )
+            elif time.monotonic() - since > QUEUE_TIMEOUT:
+                jobs.finish_job(
+                    result_id, "error", error="Timed out waiting for an OCR worker"
+                )
+            else:
+                if doc is not None and doc.get("dishes"):
+                    jobs.update_job(result_id, dishes=doc["dishes"])
+                continue
+            with self._lock:
+                self._followed.pop(result_id, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.poll()
+            except PyMongoError as e:
+                print("Could not check the OCR queue:", e)
@@ -0,0 +1,242 @@
+"""
+This module keeps uploaded receipt images in a content-addressed store on the
+uploads volume: identical images are stored once and shared through hard
+links, originals can be recompressed after OCR, and a background sweeper
+keeps the volume within an age and size budget
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+try:
+    from PIL import Image
+except ImportError:  # recompression is skipped when Pillow is not installed
+    Image = None
+
+OBJECTS_DIR = "objects"  # one file per distinct image, named by its sha256
+REFS_DIR = "refs"  # one hard link per upload, named by the receipt id
+PAGES_DIR = "pages"  # rendered result page of each receipt, by share token
+STALE_TMP_AGE = 300  # seconds before unfinished or unlinked files are removed
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".gif", ".bmp", ".tif", ".tiff"}
+
+_lock = threading.Lock()
+
+
+def _object_dir(root, digest):
+    """Directory holding the object with the given digest"""
+    return os.path.join(root, OBJECTS_DIR, digest[:2])
+
+
+def find_object(root, digest):
+    """Return the path of the stored object with the given digest, if any"""
+    directory = _object_dir(root, digest)
+    if not os.path.isdir(directory):
+        return None
+    for name in os.listdir(directory):
+        if os.path.splitext(name)[0] == digest:
+            return os.path.join(directory, name)
+    return None
+
+
+def ref_path(root, ref):
+    """Path of the hard link kept for an upload"""
+    return os.path.join(root, REFS_DIR, ref)
+
+
+def page_path(root, share_token):
+    """Path of the rendered result page of a receipt"""
+    return os.path.join(root, PAGES_DIR, share_token + ".html")
+
+
+def store_page(root, share_token, html):
+    """Save the rendered result page of a receipt and return its path"""
+    path = page_path(root, share_token)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _write_atomically(path, html)
+    return path
+
+
+def ref_count(path):
+    """Number of uploads sharing the object at path"""
+    return os.stat(path).st_nlink - 1
+
+
+def _write_atomically(path, data):
+    """Write data to path without ever exposing a partial file"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as fp:
+        fp.write(data)
+    os.replace(tmp_path, path)
+
+
+def _link(source, target):
+    """Point target at the same file as source, replacing what was there"""
+    tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+    os.link(source, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def store_upload(root, data, ref, filename=""):
+    """
+    Store an uploaded image under the given reference and return its digest;
+    an image that is already stored is only linked, not written again
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in IMAGE_EXTENSIONS:
+        ext = ""
+
+    with _lock:
+        os.makedirs(_object_dir(root, digest), exist_ok=True)
+        os.makedirs(os.path.join(root, REFS_DIR), exist_ok=True)
+
+        path = find_object(root, digest)
+        if path is None:
+            path = os.path.join(_object_dir(root, digest), digest + ext)
+            _write_atomically(path, data)
+        else:
+            # refresh the age of reused content so the sweeper keeps it
+            os.utime(path)
+        _link(path, ref_path(root, ref))
+
+    return digest
+
+
+def recompress(root, digest, ref, quality=80):
+    """
+    Re-encode a stored original as grayscale WebP once OCR is done with it.
+    Only objects used by this single upload are rewritten, and only when the
+    result is smaller. Returns True if the object was replaced
+    """
+    if Image is None:
+        return False
+
+    with _lock:
+        path = find_object(root, digest)
+        if path is None or path.endswith(".webp") or ref_count(path) != 1:
+            return False
+
+        new_path = os.path.join(_object_dir(root, digest), digest + ".webp")
+        tmp_path = new_path + ".tmp"
+        try:
+            with Image.open(path) as img:
+                img.convert("L").save(tmp_path, "WEBP", quality=quality)
+        except (OSError, ValueError) as e:
+            print("Could not recompress upload:", e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+
+        if os.path.getsize(tmp_path) >= os.path.getsize(path):
+            os.remove(tmp_path)
+            return False
+
+        os.replace(tmp_path, new_path)
+        _link(new_path, ref_path(root, ref))
+        os.remove(path)
+        return True
+
+
+def _sweep_pages(pages_dir, max_age, now):
+    """Remove result pages (and unfinished writes of them) past their age"""
+    if not os.path.isdir(pages_dir):
+        return
+    for name in os.listdir(pages_dir):
+        path = os.path.join(pages_dir, name)
+        try:
+            age = now - os.stat(path).st_mtime
+        except FileNotFoundError:  # renamed into place meanwhile
+            continue
+        if age > max_age or (name.endswith(".tmp") and age > STALE_TMP_AGE):
+            os.remove(path)
+
+
+def sweep(root, max_age, max_bytes, now=None):  # pylint: disable=too-many-locals
+    """
+    Evict uploads and result pages older than max_age seconds, then the
+    oldest remaining images until the store fits in max_bytes. Returns the
+    number of objects removed
+    """
+    now = time.time() if now is None else now
+    refs_dir = os.path.join(root, REFS_DIR)
+    objects_dir = os.path.join(root, OBJECTS_DIR)
+    _sweep_pages(os.path.join(root, PAGES_DIR), max_age, now)
+    if not os.path.isdir(objects_dir):
+        return 0
+
+    with _lock:
+        # map each object (by inode) to the uploads referencing it
+        refs = {}
+        if os.path.isdir(refs_dir):
+            for name in os.listdir(refs_dir):
+                path = os.path.join(refs_dir, name)
+                if name.endswith(".tmp"):
+                    if now - os.stat(path).st_mtime > STALE_TMP_AGE:
+                        os.remove(path)
+                    continue
+                refs.setdefault(os.stat(path).st_ino, []).append(path)
+
+        objects = []
+        for directory, _, names in os.walk(objects_dir):
+            for name in names:
+                path = os.path.join(directory, name)
+                stat = os.stat(path)
+                objects.append((stat.st_mtime, stat.st_size, stat.st_ino, path))
+        objects.sort()
+
+        total = sum(size for _, size, _, _ in objects)
+        removed = 0
+        for mtime, size, inode, path in objects:
+            age = now - mtime
+            if path.endswith(".tmp"):
+                # leftovers of writes that never finished
+                if age > STALE_TMP_AGE:
+                    os.remove(path)
+                    total -= size
+                continue
+            # give freshly written objects time to get their first link
+            unreferenced = inode not in refs and age > STALE_TMP_AGE
+            if not (age > max_age or unreferenced or total > max_bytes):
+                continue
+            for ref in refs.pop(inode, []):
+                os.remove(ref)
+            os.remove(path)
+            total -= size
+            removed += 1
+
+    return removed
+
+
+def record_upload(directory, name, form, filename, data):
+    """
+    Save an upload as a replay corpus entry: the image next to a JSON
+    manifest holding the submitted form fields
+    """
+    os.makedirs(directory, exist_ok=True)
+    ext = os.path.splitext(filename)[1].lower()
+    image_name = name + (ext if ext in IMAGE_EXTENSIONS else "")
+    _write_atomically(os.path.join(directory, image_name), data)
+    manifest = {"image": image_name, "filename": filename, "form": dict(form)}
+    with open(os.path.join(directory, name + ".json"), "w", encoding="utf-8") as fp:
+        json.dump(manifest, fp, indent=2)
+
+
+def start_sweeper(root, interval, max_age, max_bytes):
+    """Run sweep() every interval seconds in a daemon thread"""
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                removed = sweep(root, max_age, max_bytes)
+                if removed:
+                    print("Upload sweeper removed", removed, "images")
+            except OSError as e:
+                print("Upload sweeper failed:", e)
+
+    thread = threading.Thread(target=run, name="upload-sweeper", daemon=True)
+    thread.start()
+    return thread
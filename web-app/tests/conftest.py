@@ -0,0 +1,11 @@
+"""Settings shared by the web-app tests"""
+
+import pytest
+
+
+@pytest.fixture(name="upload_dir", autouse=True)
+def fixture_upload_dir(monkeypatch, tmp_path):
+    """Keep the uploads and result pages of every test out of the repo"""
+    path = tmp_path / "uploads"
+    monkeypatch.setenv("UPLOAD_DIR", str(path))
+    return path
@@ -1,10 +1,22 @@
 """Module created to test the GoDutch Flask application"""
 
 import io
+import os
+import struct
+import threading
+import time
+from datetime import datetime
+import msgspec
 import pytest
-from requests.exceptions import ConnectionError as conn_err
+import requests
 from werkzeug.datastructures import FileStorage
-from app import app_setup  # Flask instance of the API
+from app import (
+    app_setup,
+    client_image_size,
+    iter_frames,
+    read_ml_response,
+)  # Flask instance of the API
+import jobs
 
 
 @pytest.fixture(name="client")
@@ -187,13 +199,293 @@ def test_correct_post(client):
         }
     )
 
-    try:
-        # trying to POST to a running ML client; gets a connectivity error
-        response = client.post("/upload", data=data)
-    except conn_err:
-        assert True
-    else:
-        assert response.status_code == 400
+    # the upload returns a pending page straight away; the ML client is
+    # contacted in the background
+    response = client.post("/upload", data=data)
+    assert response.status_code == 202
+    assert b"Reading your receipt" in response.data
+
+    # no ML client is running, so the job ends up failing
+    response = client.get("/result/status?wait=30")
+    assert response.status_code == 200
+    assert response.get_json()["status"] == "error"
+    assert "Error connecting to ML client" in response.get_json()["error"]
+
+
+def test_repeated_upload_is_sent_once(client, monkeypatch):
+    """A double-click follows the receipt already sent to the ML client"""
+
+    calls = []
+    release = threading.Event()
+
+    def fake_post(_url, **kwargs):
+        calls.append(kwargs["data"])
+        release.wait(5)
+        raise requests.ConnectionError("ML client not running")
+
+    monkeypatch.setattr("requests.post", fake_post)
+
+    def upload():
+        client.post(
+            "/upload",
+            data={
+                "upload-receipt": (io.BytesIO(b"same receipt"), "filename.png"),
+                "tip": "5",
+                "num-people": 1,
+                "person-1-name": "jane",
+                "person-1-desc": "chicken",
+            },
+        )
+        with client.session_transaction() as session:
+            return session["result_id"]
+
+    first = upload()
+    assert upload() == first
+    release.set()
+    assert client.get("/result/status?wait=5").get_json()["status"] == "error"
+    assert len(calls) == 1
+    assert any(field == "idempotency-key" for field, _ in calls[0])
+
+    # a failed upload may be retried
+    assert upload() != first
+
+
+def test_failed_store_does_not_block_retries(client, monkeypatch):
+    """An upload that could not be stored ends its job, so a retry starts over"""
+
+    def full_volume(*_args):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr("storage.store_upload", full_volume)
+    monkeypatch.setitem(client.application.config, "PROPAGATE_EXCEPTIONS", False)
+
+    def upload():
+        response = client.post(
+            "/upload",
+            data={
+                "upload-receipt": (io.BytesIO(b"full disk"), "filename.png"),
+                "tip": "0",
+                "num-people": 1,
+                "person-1-name": "jane",
+                "person-1-desc": "soup",
+            },
+        )
+        assert response.status_code == 500
+        with client.session_transaction() as session:
+            return session["result_id"]
+
+    first = upload()
+    assert jobs.get_job(first)["status"] == "error"
+    assert upload() != first
+
+
+def test_compressed_upload_records_original_size(client, monkeypatch):
+    """The size of the photo before the browser shrank it is passed along"""
+
+    sent = []
+
+    def fake_post(_url, **kwargs):
+        sent.append((kwargs["data"], kwargs["files"]["receipt"]))
+        raise requests.ConnectionError("ML client not running")
+
+    monkeypatch.setattr("requests.post", fake_post)
+    client.post(
+        "/upload",
+        data={
+            "upload-receipt": (io.BytesIO(b"small webp"), "receipt.webp"),
+            "original-width": "4032",
+            "original-height": "3024",
+            "tip": "0",
+            "num-people": 1,
+            "person-1-name": "jane",
+            "person-1-desc": "chicken",
+        },
+    )
+    assert client.get("/result/status?wait=5").get_json()["status"] == "error"
+    data, receipt = sent[0]
+    assert ("original-width", 4032) in data
+    assert ("original-height", 3024) in data
+    assert receipt[:2] == ("receipt.webp", b"small webp")
+
+
+def test_running_tab_groups_are_handed_out(client, monkeypatch):
+    """Groups are random ids a session creates or joins by their link"""
+
+    sent = []
+
+    def fake_post(_url, **kwargs):
+        sent.append(dict(kwargs["data"]))
+        raise requests.ConnectionError("ML client not running")
+
+    monkeypatch.setattr("requests.post", fake_post)
+
+    def upload(test_client, group):
+        return test_client.post(
+            "/upload",
+            data={
+                "upload-receipt": (io.BytesIO(group.encode()), "filename.png"),
+                "tip": "0",
+                "num-people": 1,
+                "person-1-name": "jane",
+                "person-1-desc": "tacos",
+                "group": group,
+            },
+        )
+
+    # a group name typed by hand is not someone else's tab
+    assert upload(client, "friday-lunch").status_code == 400
+
+    assert upload(client, "new").status_code == 202
+    assert client.get("/result/status?wait=5").get_json()["status"] == "error"
+    group_id = sent[0]["group"]
+    with client.session_transaction() as session:
+        assert session["groups"] == [group_id]
+    assert f"/groups/{group_id}".encode() in client.get("/").data
+
+    with client.application.test_client() as friend:
+        assert upload(friend, group_id).status_code == 400
+        assert friend.get(f"/groups/{group_id}").status_code == 302
+        assert upload(friend, group_id).status_code == 202
+        assert friend.get("/result/status?wait=5").get_json()["status"] == "error"
+    assert sent[1]["group"] == group_id
+    assert client.get("/groups/not-a-group").status_code == 404
+
+
+def test_client_image_size():
+    """Only a complete, positive size is recorded"""
+    assert client_image_size({"original-width": "800", "original-height": "600"}) == (
+        800,
+        600,
+    )
+    assert client_image_size({"original-width": "800"}) is None
+    assert client_image_size({"original-width": "", "original-height": ""}) is None
+    assert client_image_size({"original-width": "0", "original-height": "600"}) is None
+
+
+def test_status_no_session(client):
+    """Try polling /result/status and /result/events with no session variables"""
+
+    response = client.get("/result/status")
+    assert response.status_code == 400
+    assert response.data == b"No result_id found in session"
+
+    response = client.get("/result/events")
+    assert response.status_code == 400
+
+
+def test_status_pending_job(client):
+    """A pending job is reported as pending and /result shows the pending page"""
+
+    jobs.create_job("67fc3fd6d5619018c1bdf3a3")
+    with client.session_transaction() as session:
+        session["result_id"] = "67fc3fd6d5619018c1bdf3a3"
+
+    response = client.get("/result/status")
+    assert response.get_json() == {"status": "pending", "error": None}
+
+    response = client.get("/result")
+    assert response.status_code == 200
+    assert b"Reading your receipt" in response.data
+
+
+def test_status_partial_dishes(client):
+    """Dishes found so far are reported while the receipt is pending"""
+
+    jobs.create_job("67fc3fd6d5619018c1bdf3a5")
+    jobs.update_job("67fc3fd6d5619018c1bdf3a5", dishes=[{"dish": "Pizza"}])
+    with client.session_transaction() as session:
+        session["result_id"] = "67fc3fd6d5619018c1bdf3a5"
+
+    response = client.get("/result/status?wait=1&seen=0")
+    assert response.get_json()["dishes"] == [{"dish": "Pizza"}]
+
+    jobs.finish_job("67fc3fd6d5619018c1bdf3a5", "error", error="bad receipt")
+    response = client.get("/result/events")
+    assert b"event: status" in response.data
+    assert b"event: partial" not in response.data
+
+
+def test_read_streamed_ml_response():
+    """Partial lines of a streamed answer update the job before the result"""
+
+    class FakeResponse:  # pylint: disable=too-few-public-methods
+        """Just enough of a requests response"""
+
+        headers = {"Content-Type": "application/x-ndjson"}
+
+        def iter_lines(self):
+            """Streamed body"""
+            return [
+                b'{"status": "partial", "dishes": [{"dish": "Pizza"}]}',
+                b"",
+                b'{"status": "success", "charge_info": {"jane": 10}}',
+            ]
+
+    jobs.create_job("67fc3fd6d5619018c1bdf3a6")
+    outcome = read_ml_response("67fc3fd6d5619018c1bdf3a6", FakeResponse())
+    assert outcome["charge_info"] == {"jane": 10}
+    assert jobs.get_job("67fc3fd6d5619018c1bdf3a6")["dishes"] == [{"dish": "Pizza"}]
+
+
+def msgpack_frame(message):
+    """A length-prefixed MessagePack message, as the ML client streams them"""
+    body = msgspec.msgpack.encode(message)
+    return struct.pack(">I", len(body)) + body
+
+
+def test_iter_frames_across_chunks():
+    """Messages split over chunks are reassembled; truncated ones are an error"""
+    stream = msgpack_frame({"status": "partial"}) + msgpack_frame({"n": 1})
+    chunks = [stream[:3], stream[3:10], stream[10:]]
+    assert list(iter_frames(chunks)) == [{"status": "partial"}, {"n": 1}]
+    with pytest.raises(ValueError):
+        list(iter_frames([stream[:-1]]))
+
+
+def test_read_msgpack_ml_response():
+    """Streamed MessagePack answers are read like the NDJSON ones"""
+
+    class FakeResponse:  # pylint: disable=too-few-public-methods
+        """Just enough of a requests response"""
+
+        headers = {"Content-Type": "application/x-msgpack-stream"}
+
+        def iter_content(self, chunk_size=None):  # pylint: disable=unused-argument
+            """Streamed body"""
+            return [
+                msgpack_frame({"status": "partial", "dishes": [{"dish": "Pizza"}]}),
+                msgpack_frame(
+                    {
+                        "status": "success",
+                        "charge_info": {"jane": 10},
+                        "dishes": [{"dish": "Pizza", "price": 10.0}],
+                    }
+                ),
+            ]
+
+    jobs.create_job("67fc3fd6d5619018c1bdf3a7")
+    outcome = read_ml_response("67fc3fd6d5619018c1bdf3a7", FakeResponse())
+    assert outcome["charge_info"] == {"jane": 10}
+    assert outcome["dishes"] == [{"dish": "Pizza", "price": 10.0}]
+    assert jobs.get_job("67fc3fd6d5619018c1bdf3a7")["dishes"] == [{"dish": "Pizza"}]
+
+
+def test_events_finished_job(client):
+    """The event stream emits the final status of a finished job"""
+
+    jobs.create_job("67fc3fd6d5619018c1bdf3a4")
+    jobs.finish_job("67fc3fd6d5619018c1bdf3a4", "error", error="bad receipt")
+    with client.session_transaction() as session:
+        session["result_id"] = "67fc3fd6d5619018c1bdf3a4"
+
+    response = client.get("/result/events")
+    assert response.mimetype == "text/event-stream"
+    assert b"event: status" in response.data
+    assert b"bad receipt" in response.data
+
+    response = client.get("/result")
+    assert response.status_code == 400
+    assert response.data == b"bad receipt"
 
 
 def test_get_no_session(client):
@@ -234,3 +526,137 @@ def test_get_with_valid_session(client):
     assert b"Individual Breakdown" in response.data
     # template contains data from this db query
     assert b"Charlie" in response.data
+
+
+def test_result_from_finished_job(client):
+    """The charges handed back by the ML client are shown without a DB read"""
+
+    jobs.create_job("67fc3fd6d5619018c1bdf3a6")
+    jobs.finish_job(
+        "67fc3fd6d5619018c1bdf3a6",
+        "done",
+        charge_info={"Alice": 12.5, "Bob": 7.25},
+        dishes=[{"dish": "Calamari", "price": 9.5}],
+    )
+    with client.session_transaction() as session:
+        session["result_id"] = "67fc3fd6d5619018c1bdf3a6"
+
+    response = client.get("/result")
+    assert response.status_code == 200
+    # the page of the session's receipt must not land in a shared cache
+    assert response.headers["Cache-Control"] == "no-cache, private"
+    assert b"Individual Breakdown" in response.data
+    assert b"Alice" in response.data
+    assert b"7.25" in response.data
+    assert b"Calamari" in response.data
+    assert b"$9.50" in response.data
+
+
+def test_shared_result_page(client):
+    """Result pages are served by share token, cacheable and revalidated by ETag"""
+    result_id = "67fc3fd6d5619018c1bdf3a8"
+    token = "s3cr3t-Share_Token-1234"
+    assert client.get("/r/not a token").status_code == 404
+    # the receipt id itself does not lead to the page
+    assert client.get("/r/" + result_id).status_code == 404
+
+    jobs.create_job(result_id, share_token=token)
+    response = client.get("/r/" + token)
+    assert response.status_code == 202
+    assert response.headers["Retry-After"] == "2"
+
+    jobs.finish_job(result_id, "done", charge_info={"Alice": 3.5})
+    response = client.get("/r/" + token)
+    assert response.status_code == 200
+    assert b"Alice" in response.data
+    assert b"/r/" + token.encode() in response.data
+    assert response.headers["Cache-Control"] == "public, max-age=86400"
+    etag = response.headers["ETag"]
+    assert client.get("/r/" + result_id).status_code == 404
+
+    # the stored page is served again without rendering
+    jobs.finish_job(result_id, "done", charge_info={"Bob": 1.0})
+    response = client.get("/r/" + token, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert b"Alice" in client.get("/r/" + token).data
+
+
+def test_result_page_rendered_when_done(client, monkeypatch):
+    """The result page is stored as soon as the ML client answers"""
+
+    class FakeResponse:  # pylint: disable=too-few-public-methods
+        """Just enough of a requests response"""
+
+        status_code = 200
+        headers = {"Content-Type": "application/json"}
+
+        def json(self):
+            """Final result"""
+            return {"status": "success", "charge_info": {"jane": 6.25}}
+
+    monkeypatch.setattr("requests.post", lambda _url, **kwargs: FakeResponse())
+    client.post(
+        "/upload",
+        data={
+            "upload-receipt": (io.BytesIO(b"rendered receipt"), "filename.png"),
+            "tip": "0",
+            "num-people": 1,
+            "person-1-name": "jane",
+            "person-1-desc": "soup",
+        },
+    )
+    assert client.get("/result/status?wait=5").get_json()["status"] == "done"
+    with client.session_transaction() as session:
+        share_token = session["share_token"]
+    page = os.path.join(
+        client.application.config["UPLOAD_DIR"], "pages", share_token + ".html"
+    )
+    for _ in range(100):  # the page is written right after the job finishes
+        if os.path.exists(page):
+            break
+        time.sleep(0.01)
+    with open(page, "rb") as fp:
+        assert b"6.25" in fp.read()
+    assert b"6.25" in client.get("/result").data
+    assert b"6.25" in client.get("/r/" + share_token).data
+
+
+def test_history_no_session(client):
+    """Try requesting the receipt history with no configured session variables"""
+
+    response = client.get("/history")
+    assert response.status_code == 400
+    assert response.data == b"No receipts found in session"
+
+
+def test_history_page(client, monkeypatch):
+    """The history endpoint returns one page of receipts and the next cursor"""
+
+    def fake_find_receipts(_collection, owner_id, filters, cursor, limit):
+        assert owner_id == "owner-1"
+        assert filters["person"] == "alice"
+        assert cursor is None and limit == 5
+        return (
+            [
+                {
+                    "_id": "67fc3fd6d5619018c1bdf3a7",
+                    "timestamp": datetime(2025, 4, 1, 12, 0),
+                    "total": 21.5,
+                    "charge_info": {"Alice": 21.5},
+                }
+            ],
+            "next-page",
+        )
+
+    monkeypatch.setattr("history.ensure_indexes", lambda collection: None)
+    monkeypatch.setattr("history.find_receipts", fake_find_receipts)
+    with client.session_transaction() as session:
+        session["owner_id"] = "owner-1"
+
+    response = client.get("/history?person=alice&limit=5")
+    assert response.status_code == 200
+    assert response.get_json()["next"] == "next-page"
+    assert response.get_json()["receipts"][0]["total"] == 21.5
+
+    response = client.get("/history?start=yesterday")
+    assert response.status_code == 400
@@ -0,0 +1,112 @@
+"""Module created to test receipt history queries"""
+
+import os
+from datetime import datetime, timedelta
+import mongomock
+import pytest
+from bson.objectid import ObjectId
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+import history
+
+BASE_TIME = datetime(2025, 4, 1, 12, 0, 0)
+
+
+def make_receipts(collection, owner_id, count):
+    """Insert count receipts one hour apart, the newest last"""
+    for i in range(count):
+        collection.insert_one(
+            {
+                "_id": ObjectId(),
+                "owner_id": owner_id,
+                "timestamp": BASE_TIME + timedelta(hours=i),
+                "people": ["alice", "bob"] if i % 2 == 0 else ["carol"],
+                "total": 10.0 * (i + 1),
+                "charge_info": {"Alice": 5.0 * (i + 1)},
+            }
+        )
+
+
+@pytest.fixture(name="receipts")
+def fixture_receipts():
+    """A mock receipts collection with receipts from two sessions"""
+    collection = mongomock.MongoClient()["test_dutch_pay"]["receipts"]
+    history.ensure_indexes(collection)
+    make_receipts(collection, "owner-1", 7)
+    make_receipts(collection, "owner-2", 3)
+    return collection
+
+
+def test_pages_follow_cursor(receipts):
+    """Pages come newest first and the cursor continues where they stopped"""
+    page, cursor = history.find_receipts(receipts, "owner-1", limit=3)
+    assert [doc["total"] for doc in page] == [70.0, 60.0, 50.0]
+
+    page, cursor = history.find_receipts(receipts, "owner-1", cursor=cursor, limit=3)
+    assert [doc["total"] for doc in page] == [40.0, 30.0, 20.0]
+
+    page, cursor = history.find_receipts(receipts, "owner-1", cursor=cursor, limit=3)
+    assert [doc["total"] for doc in page] == [10.0]
+    assert cursor is None
+
+
+def test_filters(receipts):
+    """Date range, person and total range filters narrow the history"""
+    filters = {
+        "start": BASE_TIME + timedelta(hours=1),
+        "end": BASE_TIME + timedelta(hours=6),
+        "person": " Alice ",
+        "min_total": 25.0,
+    }
+    page, cursor = history.find_receipts(receipts, "owner-1", filters)
+    assert [doc["total"] for doc in page] == [50.0, 30.0]
+    assert cursor is None
+
+
+def test_other_owner_is_not_visible(receipts):
+    """Receipts of other sessions never show up"""
+    page, _ = history.find_receipts(receipts, "owner-2", limit=50)
+    assert len(page) == 3
+
+
+def test_invalid_cursor():
+    """Malformed cursors are rejected with a ValueError"""
+    with pytest.raises(ValueError):
+        history.decode_cursor("not-a-cursor")
+
+
+def test_history_queries_use_indexes():
+    """Every history query shape is answered by an index scan with no sort"""
+    client = MongoClient(os.getenv("MONGO_URI"), serverSelectionTimeoutMS=2000)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        pytest.skip("MongoDB is not reachable")
+
+    collection = client[os.getenv("MONGO_DBNAME", "dutch_pay")]["history_explain_test"]
+    try:
+        history.ensure_indexes(collection)
+        make_receipts(collection, "owner-1", 20)
+        cursor = history.encode_cursor(
+            {"timestamp": BASE_TIME + timedelta(hours=10), "_id": ObjectId()}
+        )
+        query_shapes = [
+            {},
+            {"start": BASE_TIME, "end": BASE_TIME + timedelta(hours=5)},
+            {"person": "alice"},
+            {"min_total": 20.0, "max_total": 80.0},
+        ]
+        for filters in query_shapes:
+            for page_cursor in (None, cursor):
+                plan = str(
+                    collection.find(
+                        history.build_query("owner-1", filters, page_cursor)
+                    )
+                    .sort(history.HISTORY_SORT)
+                    .explain()["queryPlanner"]["winningPlan"]
+                )
+                assert "COLLSCAN" not in plan
+                assert "'stage': 'SORT'" not in plan
+    finally:
+        collection.drop()
+        client.close()
@@ -0,0 +1,82 @@
+"""Module created to test the in-process receipt job tracking"""
+
+import threading
+import jobs
+
+
+def test_unknown_job():
+    """Unknown jobs are reported as None"""
+    assert jobs.get_job("does-not-exist") is None
+    assert jobs.wait_for_job("does-not-exist", 0.01) is None
+
+
+def test_create_and_finish_job():
+    """A job starts pending and keeps the fields it was finished with"""
+    jobs.create_job("job-1")
+    assert jobs.get_job("job-1")["status"] == "pending"
+
+    jobs.finish_job("job-1", "done", result="ok")
+    job = jobs.get_job("job-1")
+    assert job["status"] == "done"
+    assert job["result"] == "ok"
+
+
+def test_wait_times_out_on_pending_job():
+    """Waiting on a job that never finishes returns it still pending"""
+    jobs.create_job("job-2")
+    assert jobs.wait_for_job("job-2", 0.05)["status"] == "pending"
+
+
+def test_wait_wakes_up_when_job_finishes():
+    """Waiters are notified as soon as the job finishes"""
+    jobs.create_job("job-3")
+    timer = threading.Timer(0.05, jobs.finish_job, args=("job-3", "error"))
+    timer.start()
+
+    job = jobs.wait_for_job("job-3", 5)
+    timer.join()
+    assert job["status"] == "error"
+
+
+def test_finished_jobs_are_pruned(monkeypatch):
+    """Finished jobs older than the TTL are forgotten when new jobs arrive"""
+    jobs.create_job("job-4")
+    jobs.finish_job("job-4", "done")
+    monkeypatch.setattr(jobs, "JOB_TTL", -1)
+
+    jobs.create_job("job-5")
+    assert jobs.get_job("job-4") is None
+    assert jobs.get_job("job-5") is not None
+
+
+def test_wait_wakes_up_on_partial_dishes():
+    """Waiting with seen_dishes returns once more dishes are attached"""
+    jobs.create_job("job-6")
+    timer = threading.Timer(
+        0.05, jobs.update_job, args=("job-6",), kwargs={"dishes": [{"dish": "Pizza"}]}
+    )
+    timer.start()
+    job = jobs.wait_for_job("job-6", 5, seen_dishes=0)
+    timer.join()
+    assert job["status"] == "pending"
+    assert job["dishes"] == [{"dish": "Pizza"}]
+
+    # updates after the job finished are ignored
+    jobs.finish_job("job-6", "done")
+    jobs.update_job("job-6", dishes=[])
+    assert jobs.get_job("job-6")["dishes"] == [{"dish": "Pizza"}]
+
+
+def test_create_job_once():
+    """Repeats of an upload follow the first job until it fails"""
+    key = jobs.request_key("owner", b"image", [("tip", 5.0)])
+    assert key != jobs.request_key("owner", b"image", [("tip", 6.0)])
+    assert key != jobs.request_key("other", b"image", [("tip", 5.0)])
+
+    assert jobs.create_job_once(key, "job-7") == "job-7"
+    assert jobs.get_job("job-7")["status"] == "pending"
+    assert jobs.create_job_once(key, "job-8") == "job-7"
+    assert jobs.get_job("job-8") is None
+
+    jobs.finish_job("job-7", "error", error="bad receipt")
+    assert jobs.create_job_once(key, "job-8") == "job-8"
@@ -0,0 +1,157 @@
+"""Module created to test the Unix socket transport to the ML client"""
+
+import io
+import os
+import socket
+import threading
+from flask import Flask, Response, jsonify, request
+import pytest
+import requests
+from werkzeug.serving import make_server
+from app import app_setup
+import local_transport
+import jobs
+
+
+@pytest.fixture(name="socket_path")
+def fixture_socket_path(tmp_path):
+    """Path of a Unix socket in a short-lived directory"""
+    return os.path.join(tmp_path, "ml.sock")
+
+
+def serve(app, socket_path):
+    """Serve a Flask app on the socket until the test is over"""
+    server = make_server("unix://" + socket_path, 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def upload(client, image):
+    """Upload a receipt for one person"""
+    client.post(
+        "/upload",
+        data={
+            "upload-receipt": (io.BytesIO(image), "receipt.png"),
+            "tip": "0",
+            "num-people": 1,
+            "person-1-name": "jane",
+            "person-1-desc": "soup",
+        },
+    )
+
+
+def test_unix_session_streams(socket_path):
+    """Requests and streamed responses go through the socket"""
+    app = Flask(__name__)
+
+    @app.route("/lines", methods=["POST"])
+    def lines():
+        count = request.get_json()["count"]
+        return Response((f"line {i}\n" for i in range(count)), mimetype="text/plain")
+
+    server = serve(app, socket_path)
+    try:
+        assert local_transport.available(socket_path)
+        session = local_transport.unix_session(socket_path)
+        res = session.post(
+            local_transport.LOCAL_URL + "/lines", json={"count": 3}, stream=True
+        )
+        assert list(res.iter_lines()) == [b"line 0", b"line 1", b"line 2"]
+        session.close()
+    finally:
+        server.shutdown()
+    assert not local_transport.available(None)
+
+
+def test_upload_over_local_transport(monkeypatch, socket_path):
+    """A co-located ML client gets the path of the image, not the image"""
+    received = []
+    ml_app = Flask(__name__)
+
+    @ml_app.route("/submit-local", methods=["POST"])
+    def submit_local():
+        received.append(request.get_json())
+        return jsonify({"status": "success", "charge_info": {"jane": 4.5}})
+
+    monkeypatch.setenv("ML_TRANSPORT", "local")
+    monkeypatch.setenv("ML_SOCKET", socket_path)
+    web_app = app_setup()
+    web_app.testing = True
+    upload_dir = web_app.config["UPLOAD_DIR"]
+
+    server = serve(ml_app, socket_path)
+    try:
+        with web_app.test_client() as client:
+            client.post(
+                "/upload",
+                data={
+                    "upload-receipt": (io.BytesIO(b"local receipt"), "receipt.png"),
+                    "tip": "0",
+                    "num-people": 1,
+                    "person-1-name": "jane",
+                    "person-1-desc": "soup",
+                },
+            )
+            status = client.get("/result/status?wait=5").get_json()
+            assert status["status"] == "done"
+            with client.session_transaction() as session:
+                result_id = session["result_id"]
+    finally:
+        server.shutdown()
+
+    message = received[0]
+    assert message["form"]["person-1-name"] == "jane"
+    with open(os.path.join(upload_dir, message["image"]), "rb") as fp:
+        assert fp.read() == b"local receipt"
+    assert jobs.get_job(result_id)["charge_info"] == {"jane": 4.5}
+
+
+def test_local_transport_falls_back_to_http(monkeypatch, socket_path):
+    """Without an ML client on the socket, receipts are posted over HTTP"""
+    posted = []
+
+    def fake_post(url, **kwargs):
+        posted.append((url, kwargs["files"]["receipt"][1]))
+        raise requests.ConnectionError("ML client not running")
+
+    monkeypatch.setattr("requests.post", fake_post)
+    monkeypatch.setenv("ML_TRANSPORT", "local")
+    monkeypatch.setenv("ML_SOCKET", socket_path)
+    web_app = app_setup()
+    web_app.testing = True
+    with web_app.test_client() as client:
+        upload(client, b"remote receipt")
+        assert client.get("/result/status?wait=5").get_json()["status"] == "error"
+    assert posted[0][0].endswith("/submit")
+    assert posted[0][1] == b"remote receipt"
+
+
+def test_stale_socket_falls_back_to_http(monkeypatch, socket_path):
+    """A socket file nobody listens on any more does not fail the receipt"""
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()  # the file stays behind, as after the ML client stops
+    assert local_transport.available(socket_path)
+
+    class FakeResponse:  # pylint: disable=too-few-public-methods
+        """Answer of the ML client over HTTP"""
+
+        status_code = 200
+        headers = {"Content-Type": "application/json"}
+
+        def json(self):
+            """Final result"""
+            return {"status": "success", "charge_info": {"jane": 2.0}}
+
+    posted = []
+    monkeypatch.setattr(
+        "requests.post", lambda url, **kwargs: posted.append(url) or FakeResponse()
+    )
+    monkeypatch.setenv("ML_TRANSPORT", "local")
+    monkeypatch.setenv("ML_SOCKET", socket_path)
+    web_app = app_setup()
+    web_app.testing = True
+    with web_app.test_client() as client:
+        upload(client, b"stale socket")
+        assert client.get("/result/status?wait=5").get_json()["status"] == "done"
+    assert posted[0].endswith("/submit")
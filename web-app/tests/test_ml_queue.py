@@ -0,0 +1,124 @@
+"""Module created to test handing receipts to the ML client through the queue"""
+
+import io
+import mongomock
+import pytest
+from pymongo.errors import DocumentTooLarge
+from app import app_setup
+import jobs
+import ml_queue
+
+
+@pytest.fixture(name="queue")
+def fixture_queue():
+    """Empty queue collection"""
+    return mongomock.MongoClient()["test_dutch_pay"]["ocr_jobs"]
+
+
+def test_enqueue(queue):
+    """Receipts are queued with their form fields and image"""
+    ml_queue.enqueue(
+        queue,
+        "queued-1",
+        [("num-people", "1"), ("tip", 10.0)],
+        ("receipt.png", b"image", "image/png"),
+    )
+    job = queue.find_one({"_id": "queued-1"})
+    assert job["status"] == "queued"
+    assert job["form"] == {"num-people": "1", "tip": "10.0"}
+    assert bytes(job["image"]) == b"image"
+    assert job["attempts"] == 0
+    assert job["priority"] == 0
+    assert (job["deadline"] - job["enqueued_at"]).total_seconds() == 30
+
+
+def test_enqueue_bulk_with_deadline(queue):
+    """Bulk receipts rank after interactive ones and keep their deadline"""
+    ml_queue.enqueue(
+        queue,
+        "queued-bulk",
+        [("num-people", "0"), ("priority", "bulk"), ("deadline", "120")],
+        ("receipt.png", b"image", "image/png"),
+    )
+    job = queue.find_one({"_id": "queued-bulk"})
+    assert job["priority"] == 1
+    assert (job["deadline"] - job["enqueued_at"]).total_seconds() == 120
+
+
+def test_follower_reports_progress(queue):
+    """Partial dishes, results and errors reach the job registry"""
+    done = []
+    follower = ml_queue.QueueFollower(
+        queue, on_done=lambda result_id, digest: done.append((result_id, digest))
+    )
+    for result_id in ("queued-2", "queued-3"):
+        jobs.create_job(result_id)
+        queue.insert_one({"_id": result_id, "status": "running"})
+        follower.follow(result_id, "digest-" + result_id)
+
+    queue.update_one({"_id": "queued-2"}, {"$set": {"dishes": [{"dish": "Pizza"}]}})
+    follower.poll()
+    assert jobs.get_job("queued-2")["dishes"] == [{"dish": "Pizza"}]
+    assert jobs.get_job("queued-2")["status"] == "pending"
+
+    queue.update_one(
+        {"_id": "queued-2"}, {"$set": {"status": "done", "charge_info": {"jane": 1}}}
+    )
+    queue.update_one({"_id": "queued-3"}, {"$set": {"status": "error", "error": "bad"}})
+    follower.poll()
+    assert jobs.get_job("queued-2")["charge_info"] == {"jane": 1}
+    assert jobs.get_job("queued-3")["error"] == "Error processing receipt: bad"
+    assert done == [("queued-2", "digest-queued-2")]
+
+    # finished receipts are no longer followed
+    follower.poll()
+    assert done == [("queued-2", "digest-queued-2")]
+
+
+def test_follower_times_out(queue, monkeypatch):
+    """Receipts no worker picks up are eventually failed"""
+    monkeypatch.setattr("ml_queue.QUEUE_TIMEOUT", -1)
+    follower = ml_queue.QueueFollower(queue)
+    jobs.create_job("queued-4")
+    follower.follow("queued-4")
+    follower.poll()
+    assert jobs.get_job("queued-4")["status"] == "error"
+
+
+@pytest.fixture(name="queue_client")
+def fixture_queue_client(monkeypatch):
+    """Web-app that leaves receipts in the queue"""
+    monkeypatch.setenv("ML_TRANSPORT", "queue")
+    app = app_setup()
+    app.testing = True
+    with app.test_client() as testing_client:
+        yield testing_client
+
+
+def queue_upload(client, image):
+    """Upload a receipt for one person"""
+    form = {"tip": "0", "num-people": 1, "person-1-name": "jane"}
+    form["person-1-desc"] = "noodles"
+    form["upload-receipt"] = (io.BytesIO(image), "receipt.png")
+    return client.post("/upload", data=form)
+
+
+def test_oversized_image_rejected_up_front(queue_client, monkeypatch):
+    """Images the queue document cannot hold get a 413, not a 500"""
+    monkeypatch.setattr("ml_queue.MAX_IMAGE_BYTES", 4)
+    response = queue_upload(queue_client, b"too large")
+    assert response.status_code == 413
+    assert b"too large" in response.data
+
+
+def test_document_too_large_fails_the_job(queue_client, monkeypatch):
+    """A queue document MongoDB refuses ends the job with an error"""
+
+    def refuse(*_args):
+        raise DocumentTooLarge("BSON document too large")
+
+    monkeypatch.setattr("ml_queue.enqueue", refuse)
+    assert queue_upload(queue_client, b"image").status_code == 202
+    status = queue_client.get("/result/status").get_json()
+    assert status["status"] == "error"
+    assert "Could not queue the receipt" in status["error"]
@@ -0,0 +1,109 @@
+"""Module created to test the content-addressed upload store"""
+
+import io
+import json
+import os
+import time
+import pytest
+import storage
+
+
+def make_png():
+    """Build a small, highly compressible PNG image"""
+    image = pytest.importorskip("PIL.Image")
+    buffer = io.BytesIO()
+    image.new("RGB", (200, 200), (250, 250, 250)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def test_identical_uploads_are_stored_once(tmp_path):
+    """Two uploads of the same image share one object"""
+    first = storage.store_upload(str(tmp_path), b"same image", "receipt-1", "a.png")
+    second = storage.store_upload(str(tmp_path), b"same image", "receipt-2", "b.png")
+    assert first == second
+
+    path = storage.find_object(str(tmp_path), first)
+    assert path.endswith(first + ".png")
+    assert storage.ref_count(path) == 2
+    with open(storage.ref_path(str(tmp_path), "receipt-2"), "rb") as fp:
+        assert fp.read() == b"same image"
+
+
+def test_unknown_extension_is_dropped(tmp_path):
+    """Only image extensions are kept on stored objects"""
+    digest = storage.store_upload(str(tmp_path), b"data", "receipt-1", "evil.html")
+    assert storage.find_object(str(tmp_path), digest).endswith(digest)
+
+
+def test_recompress_single_reference(tmp_path):
+    """An object used by one upload is replaced by a smaller grayscale WebP"""
+    digest = storage.store_upload(str(tmp_path), make_png(), "receipt-1", "r.png")
+
+    assert storage.recompress(str(tmp_path), digest, "receipt-1")
+    path = storage.find_object(str(tmp_path), digest)
+    assert path.endswith(".webp")
+    assert storage.ref_count(path) == 1
+    assert os.path.samefile(path, storage.ref_path(str(tmp_path), "receipt-1"))
+
+
+def test_recompress_skips_shared_objects(tmp_path):
+    """Objects shared by several uploads are left alone"""
+    data = make_png()
+    digest = storage.store_upload(str(tmp_path), data, "receipt-1", "r.png")
+    storage.store_upload(str(tmp_path), data, "receipt-2", "r.png")
+
+    assert not storage.recompress(str(tmp_path), digest, "receipt-1")
+
+
+def test_sweep_by_age(tmp_path):
+    """Uploads older than the age limit are evicted with their references"""
+    old = storage.store_upload(str(tmp_path), b"old", "receipt-1")
+    new = storage.store_upload(str(tmp_path), b"new", "receipt-2")
+    old_path = storage.find_object(str(tmp_path), old)
+    os.utime(old_path, (time.time() - 7200, time.time() - 7200))
+
+    assert storage.sweep(str(tmp_path), max_age=3600, max_bytes=10**9) == 1
+    assert storage.find_object(str(tmp_path), old) is None
+    assert not os.path.exists(storage.ref_path(str(tmp_path), "receipt-1"))
+    assert storage.find_object(str(tmp_path), new) is not None
+
+
+def test_sweep_by_size(tmp_path):
+    """The oldest uploads are evicted until the store fits the size budget"""
+    digests = []
+    for i in range(3):
+        digests.append(storage.store_upload(str(tmp_path), bytes([i]) * 100, f"r{i}"))
+        path = storage.find_object(str(tmp_path), digests[-1])
+        os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+
+    assert storage.sweep(str(tmp_path), max_age=3600, max_bytes=150) == 2
+    assert storage.find_object(str(tmp_path), digests[0]) is None
+    assert storage.find_object(str(tmp_path), digests[1]) is None
+    assert storage.find_object(str(tmp_path), digests[2]) is not None
+
+
+def test_sweep_result_pages(tmp_path):
+    """Result pages are evicted by age, even with no uploads stored"""
+    old = storage.store_page(str(tmp_path), "receipt-1", b"<html>old</html>")
+    new = storage.store_page(str(tmp_path), "receipt-2", b"<html>new</html>")
+    os.utime(old, (time.time() - 7200, time.time() - 7200))
+
+    assert storage.sweep(str(tmp_path), max_age=3600, max_bytes=10**9) == 0
+    assert not os.path.exists(old)
+    assert storage.page_path(str(tmp_path), "receipt-2") == new
+    assert os.path.exists(new)
+
+
+def test_record_upload(tmp_path):
+    """Recorded uploads are saved as an image and a JSON manifest"""
+    storage.record_upload(
+        str(tmp_path), "r1", {"tip": "5", "num-people": "1"}, "photo.JPG", b"img"
+    )
+
+    assert (tmp_path / "r1.jpg").read_bytes() == b"img"
+    manifest = json.loads((tmp_path / "r1.json").read_text())
+    assert manifest == {
+        "image": "r1.jpg",
+        "filename": "photo.JPG",
+        "form": {"tip": "5", "num-people": "1"},
+    }